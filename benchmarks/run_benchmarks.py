@@ -0,0 +1,350 @@
+"""
+Benchmarks for DisjointDomainNet training and the dd_analysis pipeline, on CPU.
+
+Each benchmark is timed for every combination of its parameters (or just the first value of each
+with --quick). Results can be saved as a JSON baseline and compared against later, e.g.:
+
+    python benchmarks/run_benchmarks.py --quick --save benchmarks/results/before.json
+    (make changes)
+    python benchmarks/run_benchmarks.py --quick --compare benchmarks/results/before.json
+
+By default, results are compared against the baseline committed in benchmarks/results/baseline.json
+(measured on the reference configuration: CPU, 1 torch thread; see its "meta" for the machine), so
+timings from other machines are only roughly comparable. To update it, run all benchmarks with
+--save benchmarks/results/baseline.json on that configuration.
+
+Comparing exits with status 1 if any benchmark got slower by more than --threshold.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import itertools
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime as dt
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import disjoint_domain as dd  # noqa: E402
+import ddnet  # noqa: E402
+import dd_results  # noqa: E402
+import dd_analysis  # noqa: E402
+import dd_ensemble  # noqa: E402
+
+BENCHMARKS = {}
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'baseline.json')
+
+
+def benchmark(**grid):
+    """
+    Register a benchmark, which is run for each combination of the values in grid. The decorated function
+    does any setup for one combination of parameters and returns a function of no arguments to time.
+    """
+    def register(fn):
+        BENCHMARKS[fn.__name__[len('bench_'):]] = (fn, grid)
+        return fn
+    return register
+
+
+def make_net(n_domains=4, ctx_per_domain=4, attrs_per_context=60, hidden_units=32, dataset_cache=None, **net_params):
+    # (no dataset cache by default, so construction times include generating the attributes every time)
+    return ddnet.DisjointDomainNet(ctx_per_domain, attrs_per_context, n_domains, hidden_units=hidden_units,
+                                   rng_seed=0, device='cpu', dataset_cache=dataset_cache, **net_params)
+
+
+@benchmark(n_domains=[4, 16], ctx_per_domain=[4, 16], attrs_per_context=[60], hidden_units=[32],
+           vectorized_attrs=[False, True])
+def bench_construct(**params):
+    return lambda: make_net(**params)
+
+
+@benchmark(n_domains=[4, 16], batch_size=[16, 1, -1], calc_acc=[False, True], hidden_units=[32, 128],
+           compiled=[False])
+def bench_train_epoch(batch_size, calc_acc, compiled, **params):
+    net = make_net(**params)
+    if compiled:
+        net.compile_training()
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.01)
+    inds = torch.arange(net.n_inputs)
+
+    def train_epoch():
+        net.train_epoch(dd.choose_k(inds, len(inds)), batch_size, optimizer, calc_acc=calc_acc)
+    return train_epoch
+
+
+@benchmark(n_domains=[4], holdout_testing=['none', 'full'], snap_freq=[10, 100], num_epochs=[100])
+def bench_do_training(holdout_testing, snap_freq, num_epochs, **params):
+    net = make_net(**params)
+    initial_state = net.save_train_state(torch.optim.SGD(net.parameters(), lr=0.01))
+
+    def do_training():
+        net.restore_train_state(torch.optim.SGD(net.parameters(), lr=0.01), initial_state)
+        net.do_training(lr=0.01, num_epochs=num_epochs, batch_size=16, report_freq=num_epochs,
+                        snap_freq=snap_freq, holdout_testing=holdout_testing,
+                        test_thresh=0.97, test_max_epochs=100, reports_per_test=1)
+    return do_training
+
+
+@benchmark(n_domains=[4, 8], ctx_per_domain=[8], split=['full', 'domain', 'combo'])
+def bench_prepare_splits(split, **params):
+    net = make_net(**params)
+    holdout_testing = 'none' if split == 'combo' else split
+    return lambda: net.prepare_splits(holdout_testing, do_combo_testing=split == 'combo')
+
+
+def make_nets(n_nets, ensemble, n_domains=4, ctx_per_domain=4, attrs_per_context=60, hidden_units=32):
+    """n_nets nets with different seeds, as a DisjointDomainNetEnsemble or a list of separate nets"""
+    if ensemble:
+        return dd_ensemble.DisjointDomainNetEnsemble(n_nets, rng_seeds=list(range(n_nets)),
+                                                     ctx_per_domain=ctx_per_domain, attrs_per_context=attrs_per_context,
+                                                     n_domains=n_domains, hidden_units=hidden_units, device='cpu',
+                                                     dataset_cache=None)
+    return [ddnet.DisjointDomainNet(ctx_per_domain, attrs_per_context, n_domains, hidden_units=hidden_units,
+                                    rng_seed=seed, device='cpu', dataset_cache=None) for seed in range(n_nets)]
+
+
+# (ensemble=False trains the same nets one after another, for comparison)
+@benchmark(n_nets=[8, 16], batch_size=[16], ensemble=[False, True])
+def bench_ensemble_train_epoch(n_nets, batch_size, ensemble, **params):
+    nets = make_nets(n_nets, ensemble, **params)
+    if ensemble:
+        optimizer = torch.optim.SGD(nets.params.values(), lr=0.01)
+        return lambda: nets.train_epoch(torch.stack([torch.randperm(nets.n_inputs) for _ in range(n_nets)]),
+                                        batch_size, optimizer)
+
+    optimizers = [torch.optim.SGD(net.parameters(), lr=0.01) for net in nets]
+
+    def train_epochs():
+        for net, optimizer in zip(nets, optimizers):
+            net.train_epoch(torch.randperm(net.n_inputs), batch_size, optimizer)
+    return train_epochs
+
+
+@benchmark(n_nets=[8], holdout_testing=['none', 'full'], ensemble=[False, True], num_epochs=[100])
+def bench_ensemble_do_training(n_nets, holdout_testing, ensemble, num_epochs, **params):
+    nets = make_nets(n_nets, ensemble, **params)
+    train_params = dict(lr=0.01, num_epochs=num_epochs, batch_size=16, report_freq=num_epochs, snap_freq=num_epochs,
+                        holdout_testing=holdout_testing, test_thresh=0.97, test_max_epochs=100, reports_per_test=1)
+    if ensemble:
+        initial_params = {pname: p.detach().clone() for pname, p in nets.params.items()}
+
+        def do_training():
+            with torch.no_grad():
+                for pname, p in nets.params.items():
+                    p.copy_(initial_params[pname])
+            nets.do_training(**train_params)
+        return do_training
+
+    initial_states = [net.save_train_state(torch.optim.SGD(net.parameters(), lr=0.01)) for net in nets]
+
+    def do_training():
+        for net, initial_state in zip(nets, initial_states):
+            net.restore_train_state(torch.optim.SGD(net.parameters(), lr=0.01), initial_state)
+            net.do_training(**train_params)
+    return do_training
+
+
+def make_synthetic_results(path, n_runs, n_snaps, n_domains=4, ctx_per_domain=4, attrs_per_context=60):
+    """Save a result set of random snapshots and reports with realistic shapes"""
+    rng = np.random.default_rng(0)
+    n_items = dd.ITEMS_PER_DOMAIN * n_domains
+    n_contexts = ctx_per_domain * n_domains
+    n_reports = n_snaps
+
+    snaps = {
+        'item': rng.random((n_runs, n_snaps, n_items, 16)),
+        'context': rng.random((n_runs, n_snaps, n_contexts, 16)),
+        'item_hidden': rng.random((n_runs, n_snaps, n_items, 32)),
+        'context_hidden': rng.random((n_runs, n_snaps, n_contexts, 32))
+    }
+    reports = {rtype: rng.random((n_runs, n_reports)) for rtype in ['loss', 'accuracy', 'weighted_acc']}
+    ys = (rng.random((n_runs, n_items * ctx_per_domain, n_contexts * attrs_per_context)) < 0.1).astype(np.float32)
+
+    net_params = {'n_domains': n_domains, 'ctx_per_domain': ctx_per_domain, 'attrs_per_context': attrs_per_context,
+                  'attrs_set_per_item': 25, 'cluster_info': '4-2-2'}
+    train_params = {'num_epochs': (n_snaps - 1) * 50 + 1, 'report_freq': 50, 'snap_freq': 50,
+                    'snap_freq_scale': 'lin', 'reports_per_test': 1}
+    dd_results.save_results(path, snaps, reports, ys, net_params, train_params)
+
+
+@benchmark(n_runs=[8, 36], n_snaps=[21, 61], calc_all=[False, True])
+def bench_get_result_means(n_runs, n_snaps, calc_all, tmp_dir):
+    path = os.path.join(tmp_dir, f'means_{n_runs}_{n_snaps}')
+    if not os.path.exists(path):
+        make_synthetic_results(path, n_runs, n_snaps)
+    return lambda: dd_analysis.get_result_means(path, calc_all_repr_dists=calc_all)
+
+
+@benchmark(n_runs=[8, 36], n_snaps=[61], reuse_rdms=[False, True])
+def bench_get_rdm_projections(n_runs, n_snaps, reuse_rdms, tmp_dir):
+    path = os.path.join(tmp_dir, f'means_{n_runs}_{n_snaps}')
+    if not os.path.exists(path):
+        make_synthetic_results(path, n_runs, n_snaps)
+    res = dd_analysis.get_result_means(path, calc_all_repr_dists=False, include_individual_rdms=reuse_rdms)
+    return lambda: dd_analysis.get_rdm_projections(res, 'item_full')
+
+
+# modules the compute code (making data, training, sweeps and result/RDM computations) shouldn't load
+PLOTTING_MODULES = ['matplotlib', 'mpl_toolkits', 'sklearn', 'statsmodels', 'patsy']
+
+
+@benchmark(module=['dd_sweep', 'disjoint_domain', 'ddnet', 'dd_analysis'])
+def bench_import(module):
+    """Start a new interpreter and import module, as a sweep worker does (fails if it loads plotting modules)"""
+    repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    code = (f'import sys, {module}\n'
+            f'loaded = [m for m in {PLOTTING_MODULES!r} if m in sys.modules]\n'
+            f'assert not loaded, f"importing {module} loaded {{loaded}}"')
+
+    def import_module():
+        subprocess.run([sys.executable, '-c', code], cwd=repo_dir, check=True)
+    return import_module
+
+
+def time_fn(fn, repeat=5, min_time=0.2):
+    """
+    Time fn like timeit: find how many calls take at least min_time,
+    then return the time per call for each of repeat such loops.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1000:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(np.ceil(min_time / elapsed)))
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+
+def param_combos(grid, quick=False):
+    names = list(grid.keys())
+    values = [vals[:1] if quick else vals for vals in grid.values()]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def bench_key(name, params):
+    return name + '[' + ','.join(f'{pname}={val}' for pname, val in params.items()) + ']'
+
+
+def run_benchmarks(name_filter=None, quick=False, repeat=5, min_time=0.2, compile_step=False):
+    """Run all (matching) benchmarks and return a dict of timing stats for each"""
+    results = {}
+    tmp_dir = tempfile.mkdtemp(prefix='dd_bench_')
+    try:
+        for name, (fn, grid) in BENCHMARKS.items():
+            if compile_step and 'compiled' in grid:
+                grid = {**grid, 'compiled': [False, True]}
+
+            for params in param_combos(grid, quick):
+                key = bench_key(name, params)
+                if name_filter is not None and name_filter not in key:
+                    continue
+
+                extra = {'tmp_dir': tmp_dir} if 'tmp_dir' in fn.__code__.co_varnames else {}
+                # keep the progress printing of do_training etc. out of the way
+                with redirect_stdout(io.StringIO()):
+                    bench_fn = fn(**params, **extra)
+                    bench_fn()  # warm up (and compile, if applicable)
+                    times = time_fn(bench_fn, repeat, min_time)
+
+                results[key] = {'median': float(np.median(times)), 'min': float(np.min(times)), 'repeat': repeat}
+                print(f'{key:<90} {results[key]["median"] * 1000:10.3f} ms')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return results
+
+
+def get_meta():
+    """Information about what was benchmarked where"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        'commit': commit,
+        'date': f'{dt.now():%Y-%m-%d %H:%M:%S}',
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'processor': platform.processor(),
+        'threads': torch.get_num_threads()
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio of each time to the baseline's; return the keys that got slower by more than threshold"""
+    regressions = []
+    print(f'\nCompared to {baseline["meta"]["commit"]} ({baseline["meta"]["date"]}):')
+    for key, stats in results.items():
+        if key not in baseline['results']:
+            print(f'{key:<90} (new)')
+            continue
+
+        ratio = stats['median'] / baseline['results'][key]['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 / (1 + threshold):
+            flag = '  faster'
+        print(f'{key:<90} {ratio:6.2f}x{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', '--filter', default=None, help='only run benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='only the first value of each parameter')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per timing loop')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads (default 1, for stable timings)')
+    parser.add_argument('--compile', action='store_true', help='also time train_epoch with a compiled step')
+    parser.add_argument('--save', default=None, help='save results as a JSON baseline at this path')
+    parser.add_argument('--compare', default=DEFAULT_BASELINE,
+                        help='compare against a saved JSON baseline (default: the committed baseline)')
+    parser.add_argument('--no-compare', action='store_true', help="don't compare against any baseline")
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown counted as a regression')
+    args = parser.parse_args()
+
+    # (read before saving, which may replace it)
+    baseline_results = None
+    if not args.no_compare:
+        with open(args.compare) as f:
+            baseline_results = json.load(f)
+
+    torch.set_num_threads(args.threads)
+    dd.init_torch('cpu')
+    bench_results = run_benchmarks(args.filter, args.quick, args.repeat, args.min_time, args.compile)
+
+    if args.save is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({'meta': get_meta(), 'results': bench_results}, f, indent=1)
+        print(f'Saved {args.save}')
+
+    if baseline_results is not None:
+        if compare(bench_results, baseline_results, args.threshold):
+            sys.exit(1)
@@ -1,18 +1,16 @@
 """Useful functions for analyzing results of disjoint-domain net runs"""
 
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D # noqa
-from mpl_toolkits import axes_grid1
-from scipy.cluster import hierarchy
+import torch
 from scipy.spatial import distance
 from scipy.linalg import block_diag
 from scipy import stats
-from sklearn.manifold import MDS
-from statsmodels.regression.linear_model import OLS
-from patsy import dmatrices
 
 import disjoint_domain as dd
+import dd_results
+
+# matplotlib, sklearn (MDS) and statsmodels/patsy are imported by the plotting and regression functions
+# that use them, so the result and RDM computations can be used without loading (or installing) them
 
 report_titles = {
     'loss': 'Mean loss',
@@ -26,6 +24,83 @@ report_titles = {
 }
 
 
+def _prepare_for_dists(reprs, metric):
+    """
+    Transform representations (..., n_inputs, n_rep) into a float64 tensor such that calc_dists
+    can compute distances with a matrix multiply or cdist
+    """
+    if metric == 'spearman':
+        # spearman correlation is the correlation of ranks within each input
+        reprs = stats.rankdata(reprs, axis=-1)
+        metric = 'correlation'
+
+    x = torch.as_tensor(np.asarray(reprs), dtype=torch.float64)
+    if metric == 'correlation':
+        x = x - torch.mean(x, dim=-1, keepdim=True)
+    if metric in ['correlation', 'cosine']:
+        x = x / torch.linalg.norm(x, dim=-1, keepdim=True)
+    return x
+
+
+_cdist_p = {'euclidean': 2., 'cityblock': 1., 'chebyshev': float('inf')}
+
+
+def calc_dists(x, y, metric='euclidean'):
+    """
+    Distances between rows of two batches of representations (..., m, n_rep) and (..., n, n_rep)
+    that have been transformed by _prepare_for_dists. Rows with any nans have nan distances.
+    """
+    if metric in _cdist_p:
+        # don't use the matrix multiply trick, which can give slightly nonzero self-distances
+        return torch.cdist(x, y, p=_cdist_p[metric], compute_mode='donot_use_mm_for_euclid_dist')
+    elif metric in ['correlation', 'cosine', 'spearman']:
+        return 1 - x @ y.transpose(-1, -2)
+    else:
+        raise ValueError(f'Unsupported distance metric "{metric}"')
+
+
+def calc_rdms(reprs, metric='euclidean'):
+    """
+    Make distance matrices (RDMs) between the inputs of each set of representations, all at once.
+    reprs is an array of size (..., n_inputs, n_rep); returns an array of size (..., n_inputs, n_inputs).
+    metric can be 'euclidean', 'cityblock', 'chebyshev', 'correlation', 'cosine' or 'spearman'.
+    As with squareform(pdist(...)), the diagonal is always 0.
+    """
+    x = _prepare_for_dists(reprs, metric)
+    dists = calc_dists(x, x, metric)
+    torch.diagonal(dists, dim1=-2, dim2=-1).zero_()
+    return dists.numpy()
+
+
+def calc_mean_cross_epoch_rdm(repr_snaps, metric='euclidean', max_block_size=2**24):
+    """
+    Mean (over runs, ignoring nans) of the distances between all representations at all epochs,
+    i.e. an (n_snap_epochs * n_inputs) square matrix. To save memory, the matrix for each run is never
+    fully formed; distances are computed for a block of rows of all runs at a time (with at most
+    max_block_size entries) and summed over runs. Only blocks on or above the diagonal are computed.
+    """
+    n_runs, n_snap_epochs, n_inputs, n_rep = repr_snaps.shape
+    n_total = n_snap_epochs * n_inputs
+    x = _prepare_for_dists(np.reshape(repr_snaps, (n_runs, n_total, n_rep)), metric)
+
+    # distances involving a representation with nans are nan, so count the runs
+    # in which both representations of each pair are valid
+    b_valid = (~torch.any(torch.isnan(x), dim=-1)).to(torch.float64)
+    dist_count = b_valid.T @ b_valid
+    dist_count.fill_diagonal_(n_runs)
+
+    dist_sum = torch.empty((n_total, n_total), dtype=torch.float64)
+    block_rows = max(1, max_block_size // (n_runs * n_total))
+    for start in range(0, n_total, block_rows):
+        block = slice(start, start + block_rows)
+        block_sum = torch.nansum(calc_dists(x[:, block], x[:, start:], metric), dim=0)
+        dist_sum[block, start:] = block_sum
+        dist_sum[start:, block] = block_sum.T
+    dist_sum.fill_diagonal_(0)
+
+    return (dist_sum / dist_count).numpy()
+
+
 def get_mean_repr_dists(repr_snaps, metric='euclidean', calc_all=True,
                         include_individual=False):
     """
@@ -47,48 +122,21 @@ def get_mean_repr_dists(repr_snaps, metric='euclidean', calc_all=True,
     
     If include_individual is True, includes snaps_each which is not meaned across runs.
     """
+    # distances within each epoch, for all runs and epochs at once
+    dists_snaps = calc_rdms(repr_snaps, metric)
+    with np.errstate(invalid='ignore'):
+        b_valid = ~np.isnan(dists_snaps)
+        mean_dists_snaps = np.sum(np.where(b_valid, dists_snaps, 0), axis=0) / np.sum(b_valid, axis=0)
+
+    dists_out = {'snaps': mean_dists_snaps}
 
-    def dist_fn(snaps):
-        if metric == 'spearman':
-            return 1 - stats.spearmanr(snaps, axis=1)[0]
-        else:
-            return distance.squareform(distance.pdist(snaps, metric=metric))
-    
     if calc_all:
-        n_runs, n_snap_epochs, n_inputs, n_rep = repr_snaps.shape
-        snaps_flat = np.reshape(repr_snaps, (n_runs, n_snap_epochs * n_inputs, n_rep))        
-        dists_all = np.stack([dist_fn(run_snaps) for run_snaps in snaps_flat])
-        mean_dists_all = np.nanmean(dists_all, axis=0)
-
-        mean_dists_snaps = np.empty((n_snap_epochs, n_inputs, n_inputs))
-        for k_epoch in range(n_snap_epochs):
-            this_slice = slice(k_epoch * n_inputs, (k_epoch+1) * n_inputs)
-            mean_dists_snaps[k_epoch] = mean_dists_all[this_slice, this_slice]
-            
-        dists_out = {'all': mean_dists_all, 'snaps': mean_dists_snaps}
+        dists_out['all'] = calc_mean_cross_epoch_rdm(repr_snaps, metric)
         
-        if include_individual:
-            dists_snaps = np.empty((n_runs, n_snap_epochs, n_inputs, n_inputs))
-            for k_epoch in range(n_snap_epochs):
-                this_slice = slice(k_epoch * n_inputs, (k_epoch+1) * n_inputs)
-                dists_snaps[:, k_epoch] = dists_all[:, this_slice, this_slice]
+    if include_individual:
+        dists_out['snaps_each'] = dists_snaps
 
-            dists_out['snaps_each'] = dists_snaps
-            
-        return dists_out
-            
-    else:
-        # Directly calculate distances at each epoch
-        dists_snaps = np.stack([
-            np.stack([dist_fn(epoch_snaps) for epoch_snaps in run_snaps])
-            for run_snaps in repr_snaps
-        ])
-        mean_dists_snaps = np.nanmean(dists_snaps, axis=0)
-        
-        if include_individual:
-            return {'snaps': mean_dists_snaps, 'snaps_each': dists_snaps}
-        else:
-            return {'snaps': mean_dists_snaps}
+    return dists_out
 
 
 def get_mean_and_ci(series_set):
@@ -111,16 +159,13 @@ def get_result_means(res_path, subsample_snaps=1, runs=slice(None),
     If subsample_snaps is > 1, use only every nth snapshot
     Indexes into runs using the 'runs' argument
     """    
-    with np.load(res_path, allow_pickle=True) as resfile:
-        snaps = resfile['snapshots'].item()
-        reports = resfile['reports'].item()
-        net_params = resfile['net_params'].item()
-        train_params = resfile['train_params'].item()
-        ys = resfile['ys']
-        
-    # take subset of snaps and reports if necessary
-    snaps = {stype: snap[runs, ::subsample_snaps, ...] for stype, snap in snaps.items()}
-    reports = {rtype: report[runs, ...] for rtype, report in reports.items()}
+    # only the subset of snaps and reports that is used gets read from the file
+    with dd_results.open_results(res_path) as store:
+        snaps = store.get_group('snapshots', runs, subsample_snaps)
+        reports = store.get_group('reports', runs)
+        net_params = store.net_params
+        train_params = store.train_params
+        ys = store.get_ys()
 
     mean_repr_dists = {
         snap_type: get_mean_repr_dists(repr_snaps, metric=dist_metric,
@@ -155,7 +200,10 @@ def get_result_means(res_path, subsample_snaps=1, runs=slice(None),
 
     return {
         'path': res_path,
+        'runs': runs,
+        'subsample_snaps': subsample_snaps,
         'repr_dists': mean_repr_dists,
+        'dist_metric': dist_metric,
         'reports': report_means,
         'report_cis': report_cis,
         'net_params': net_params,
@@ -169,6 +217,8 @@ def get_result_means(res_path, subsample_snaps=1, runs=slice(None),
 
 def auto_subplots(n_rows, n_cols, ax_dims=(4, 4), prop_cycle=None):
     """Make subplots, automatically adjusting the figsize, and without squeezing"""
+    import matplotlib.pyplot as plt
+
     figsize = (ax_dims[0] * n_cols, ax_dims[1] * n_rows)
     fig, axs = plt.subplots(n_rows, n_cols, figsize=figsize, squeeze=False)
     for ax in axs.ravel():
@@ -192,6 +242,9 @@ def outside_legend(ax, **legend_params):
     
 def add_colorbar(im, aspect=20, pad_fraction=0.5, **kwargs):
     """Add a vertical color bar to an image plot. (source: https://stackoverflow.com/a/33505522)"""
+    import matplotlib.pyplot as plt
+    from mpl_toolkits import axes_grid1
+
     divider = axes_grid1.make_axes_locatable(im.axes)
     width = axes_grid1.axes_size.AxesY(im.axes, aspect=1./aspect)
     pad = axes_grid1.axes_size.Fraction(pad_fraction, width)
@@ -300,6 +353,8 @@ def plot_rsa(ax, res, snap_type, snap_ind, title_addon=None, item_order='domain-
 
 def plot_repr_dendrogram(ax, res, snap_type, snap_ind, title_addon=None):
     """Similar to plot_rsa, but show dendrogram rather than RSA matrix"""
+    from scipy.cluster import hierarchy
+
     input_names = _get_names_for_snapshots(snap_type, **res['net_params'])
 
     dists_compressed = distance.squareform(res['repr_dists'][snap_type]['snaps'][snap_ind])
@@ -313,6 +368,8 @@ def plot_repr_dendrogram(ax, res, snap_type, snap_ind, title_addon=None):
 
 def plot_repr_embedding(ax, res, snap_type, snap_ind, colors=None):
     """Similar to plot_rsa, but plot 2D embeddings of items or contexts using MDS"""
+    from sklearn.manifold import MDS
+
     input_names = _get_names_for_snapshots(snap_type, **res['net_params'])
     embedding = MDS(n_components=2, dissimilarity='precomputed')
     reprs_embedded = embedding.fit_transform(res['repr_dists'][snap_type]['snaps'][snap_ind])
@@ -328,6 +385,10 @@ def plot_repr_trajectories(res, snap_type, dims=2, title_label=''):
     using MDS. Can plot in 3D by settings dims to 3.
     Returns figure and axes.
     """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D # noqa
+    from sklearn.manifold import MDS
+
     embedding = MDS(n_components=dims, dissimilarity='precomputed')
     reprs_embedded = embedding.fit_transform(res['repr_dists'][snap_type]['all'])
 
@@ -387,11 +448,11 @@ def plot_hl_input_pattern_correlations(ax, res, run_num, snap_index, title_label
     each item/context pair.
     """
     
-    with np.load(res['path'], allow_pickle=True) as resfile:
-        if 'parameters' not in res or 'ys' not in resfile:
+    with dd_results.open_results(res['path']) as store:
+        if 'hidden_to_attr.weight' not in store.names('parameters'):
             raise RuntimeError("Selected results file doesn't have needed data.")
         
-        ha_weights = resfile['parameters'].item()['hidden_to_attr.weight'][run_num, snap_index, ...]
+        ha_weights = np.array(store.get_mmap('parameters', 'hidden_to_attr.weight')[run_num, snap_index, ...])
         ys = res['ys'][run_num]
         
     ys_norm = ys - np.mean(ys, axis=1, keepdims=True)
@@ -555,47 +616,51 @@ def get_rdm_projections(res, snap_type='item', normalize=True):
     before projecting onto each model matrix.
     'item_full' and 'context_full' are special "snap types" that combine (concatenate) all
     snapshots with item inputs and context inputs respectively (i.e. repr and hidden layers).
+    
+    If res has individual (euclidean) RDMs from get_result_means (include_individual_rdms=True) for all
+    runs and snapshots, uses those rather than loading the snapshots again. (Otherwise the projections
+    would not line up with the reports of each run and epoch, e.g. in make_dict_for_regression.)
     """
-    # Get the full snapshots (for each run)
-    with np.load(res['path'], allow_pickle=True) as resfile:
-        snap_dict = resfile['snapshots'].item()
-        if snap_type == 'item_full':
-            snaps = [snap_dict[key] for key in ['item', 'item_hidden'] if key in snap_dict]
-            snaps = np.concatenate(snaps, axis=3)
-        elif snap_type == 'context_full':
-            snaps = [snap_dict[key] for key in ['context', 'context_hidden'] if key in snap_dict]
-            snaps = np.concatenate(snaps, axis=3)
-        else:
-            try:
-                snaps = snap_dict[snap_type]
-            except KeyError:
+    repr_dists = res['repr_dists'].get(snap_type, {})
+    runs = res.get('runs')
+    all_runs_and_snaps = isinstance(runs, slice) and runs == slice(None) and res.get('subsample_snaps') == 1
+    if 'snaps_each' in repr_dists and res.get('dist_metric') == 'euclidean' and all_runs_and_snaps:
+        rdms = repr_dists['snaps_each']
+    else:
+        # Get the full snapshots (for each run)
+        with dd_results.open_results(res['path']) as store:
+            snap_names = store.names('snapshots')
+            if snap_type == 'item_full':
+                snaps = [store.get('snapshots', key) for key in ['item', 'item_hidden'] if key in snap_names]
+                snaps = np.concatenate(snaps, axis=3)
+            elif snap_type == 'context_full':
+                snaps = [store.get('snapshots', key) for key in ['context', 'context_hidden'] if key in snap_names]
+                snaps = np.concatenate(snaps, axis=3)
+            elif snap_type in snap_names:
+                snaps = store.get('snapshots', snap_type)
+            else:
                 raise ValueError(snap_type + ' snapshots not found for this dataset')
 
+        rdms = calc_rdms(snaps)
+
     if 'item' in snap_type:
         models = make_ortho_item_rsa_models(**res['net_params'])
     elif 'context' in snap_type:
         models = make_ortho_context_rsa_models(**res['net_params'])
     else:
         raise ValueError(f'Snapshot type {snap_type} not recognized')
-            
-    n_runs, n_snap_epochs = snaps.shape[:2]
-    projections = {dim: np.empty((n_runs, n_snap_epochs)) for dim in models}
-    projections['spread'] = np.empty((n_runs, n_snap_epochs))
-    
-    for k_run in range(n_runs):
-        for k_epoch in range(n_snap_epochs):
-            rdm = distance.squareform(distance.pdist(snaps[k_run, k_epoch]))
-            
-            # make special "spread" one which is the fro norm
-            normed_rdm = np.linalg.norm(rdm)
-            projections['spread'][k_run, k_epoch] = normed_rdm
-            
-            if normalize:
-                rdm /= normed_rdm
-            
-            for dim, model in models.items():
-                projections[dim][k_run, k_epoch] = np.nansum(rdm * model)
 
+    # make special "spread" one which is the fro norm
+    spread = np.linalg.norm(rdms, axis=(-2, -1))
+    if normalize:
+        rdms = rdms / spread[..., np.newaxis, np.newaxis]
+
+    # project all RDMs onto all models at once (nans don't contribute, like nansum)
+    model_mat = np.stack(list(models.values()))
+    proj_mat = np.einsum('reij,mij->mre', np.where(np.isnan(rdms), 0, rdms), model_mat)
+
+    projections = dict(zip(models.keys(), proj_mat))
+    projections['spread'] = spread
     return projections
 
 
@@ -645,8 +710,8 @@ def make_dict_for_regression(res_array):
         run_dict.update({('ctx_' + key): proj.ravel() for key, proj in get_rdm_projections(res, snap_type='context_full').items()})
         
         # add reports
-        with np.load(res['path'], allow_pickle=True) as resfile:
-            report_dict = resfile['reports'].item()            
+        with dd_results.open_results(res['path']) as store:
+            report_dict = store.get_group('reports')
         run_dict.update({key: report.ravel() for key, report in report_dict.items() if 'etg' not in key})
         
         for key in run_dict:
@@ -668,6 +733,9 @@ def fit_linear_model(formula, data_dict):
     variables in data_dict (created with make_dict_for_regression).
     Returns the statsmodels results object.
     """
+    from statsmodels.regression.linear_model import OLS
+    from patsy import dmatrices
+
     y, x = dmatrices(formula, data=data_dict, return_type='dataframe')
     model = OLS(y, x)
     return model.fit()
@@ -725,7 +793,7 @@ def get_svd_dist_mats(res):
     as a cityblock distance of their SVD loadings. This is supposed to capture info abount hierarchical position.
     """
     ys = res['ys']
-    item_mat = dd.make_io_mats(**res['net_params'])[0]
+    item_mat = dd.make_input_mats(**res['net_params'])[0]
     n_domains = res['net_params']['n_domains']
     return np.stack([
         distance.squareform(distance.pdist(dd.get_item_svd_loadings(item_mat, y, n_domains), metric='cityblock'))
@@ -0,0 +1,62 @@
+"""Checkpoints of DisjointDomainNet training, for resuming long runs after an interruption"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def get_rng_state(device=None):
+    """State of the global torch (and CUDA, if device is a CUDA device) and NumPy random number generators"""
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state()}
+    if device is not None and torch.device(device).type == 'cuda':
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restore random number generator state from get_rng_state"""
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    if 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(path, checkpoint):
+    """Save a checkpoint, writing it under another name and then renaming so the file is always complete"""
+    tmp_path = path + '.tmp'
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """Load a checkpoint saved by save_checkpoint (it holds numpy arrays, so it can't be loaded weights-only)"""
+    return torch.load(path, weights_only=False)
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints in a background thread, so training doesn't wait for them to be written.
+    The checkpoint passed to write must not be modified afterward (i.e. it should hold copies of the training state).
+    Only one write is in progress at a time - writing another checkpoint first waits for the last one to finish.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(1)
+        self.last_write = None
+
+    def wait(self):
+        """Wait for the last write to finish (raising any error that happened while writing)"""
+        if self.last_write is not None:
+            self.last_write.result()
+            self.last_write = None
+
+    def write(self, checkpoint):
+        self.wait()
+        self.last_write = self.executor.submit(save_checkpoint, self.path, checkpoint)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,159 @@
+"""Cache of generated DisjointDomainNet datasets, so nets built for the same data don't regenerate it"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+import disjoint_domain as dd
+
+# version of the files saved in a cache directory (files of other versions are ignored)
+CACHE_FILE_VERSION = 2
+
+
+def _rng_digest(rng_state):
+    return hashlib.sha1(rng_state.numpy().tobytes()).hexdigest()
+
+
+def dataset_key(ctx_per_domain=4, attrs_per_context=50, attrs_set_per_item=25, n_domains=4, cluster_info='4-2-2',
+                last_domain_cluster_info=None, repeat_attrs_over_domains=False, vectorized=False, generator=None,
+                rng_state=None, **_extra):
+    """
+    Key of the dataset that dd.make_domain_attrs would make with these parameters, starting from
+    rng_state (default: the current state of generator, or of the global torch RNG if it's None).
+    The attributes are all made with that RNG, so its state plays the role of the seed - it also reflects
+    anything done with the RNG after seeding, such as initializing a net's parameters.
+    """
+    if rng_state is None:
+        rng_state = torch.get_rng_state() if generator is None else generator.get_state()
+
+    cluster_info = dd.normalize_cluster_info(cluster_info)
+    if last_domain_cluster_info is not None:
+        last_domain_cluster_info = dd.normalize_cluster_info(last_domain_cluster_info)
+
+    return (ctx_per_domain, attrs_per_context, attrs_set_per_item, n_domains,
+            json.dumps(cluster_info, sort_keys=True), json.dumps(last_domain_cluster_info, sort_keys=True),
+            bool(repeat_attrs_over_domains), bool(vectorized), _rng_digest(rng_state))
+
+
+class DatasetCache:
+    """
+    Two-tier cache of the attributes made by dd.make_domain_attrs: the max_entries most recently used
+    datasets are kept in memory, and if cache_dir is given, every dataset is also saved there (as a small
+    .npz file of the distinct blocks of attributes) so it can be reused by other processes and later sessions.
+    Attributes are stored bit-packed (see dd.pack_attrs) and only unpacked when a net needs them.
+
+    Getting a dataset from the cache leaves the torch RNG (or the generator passed to make_domain_attrs)
+    in the same state as generating it would have, so e.g. the shuffling order of training afterward is the same either way.
+    The item and context matrices and names don't depend on the seed; they are shared through
+    dd.make_input_mats, dd.get_items and dd.get_contexts.
+    """
+
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + f'.v{CACHE_FILE_VERSION}.npz')
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _load(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as entry_file:
+            blocks = entry_file['blocks']
+            blocks.setflags(write=False)
+            return blocks, tuple(entry_file['domain_inds']), torch.from_numpy(entry_file['rng_state'])
+
+    def _save(self, key, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        blocks, domain_inds, rng_state = entry
+        path = self._path(key)
+        # write under another name and rename, so other processes never see a partial file
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz'
+        np.savez(tmp_path, blocks=blocks, domain_inds=np.array(domain_inds), rng_state=rng_state.numpy())
+        os.replace(tmp_path, path)
+
+    def get_entry(self, **params):
+        """
+        Get the distinct blocks of attributes (distinct domains x contexts x items x packed attrs, as from
+        dd.pack_attrs), the index of the block used by each domain and the RNG state after generating them,
+        making them if they aren't cached. params are the parameters of dd.make_domain_attrs.
+        """
+        generator = params.get('generator')
+        key = dataset_key(**params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+
+        if entry is None and self.cache_dir is not None:
+            entry = self._load(key)
+            if entry is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                self._remember(key, entry)
+
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            domain_attrs, domain_inds = dd.make_domain_attrs(**params)
+            blocks = dd.pack_attrs(np.stack([np.stack(attrs) for attrs in domain_attrs]))
+            blocks.setflags(write=False)
+            rng_state = torch.get_rng_state() if generator is None else generator.get_state()
+            entry = (blocks, tuple(domain_inds), rng_state)
+            self._remember(key, entry)
+            if self.cache_dir is not None:
+                self._save(key, entry)
+        elif generator is None:
+            torch.set_rng_state(entry[2])
+        else:
+            generator.set_state(entry[2])
+
+        return entry
+
+    def get_domain_attrs(self, **params):
+        """Drop-in replacement for dd.make_domain_attrs that gets the attributes from the cache if possible"""
+        blocks, domain_inds, _ = self.get_entry(**params)
+        attrs_per_context = params.get('attrs_per_context', 50)
+        return [list(dd.unpack_attrs(block, attrs_per_context)) for block in blocks], list(domain_inds)
+
+    def __getstate__(self):
+        # the datasets in memory and the lock aren't copied (e.g. along with a net that uses the cache)
+        state = self.__dict__.copy()
+        del state['lock']
+        state['entries'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """Forget the datasets in memory (those saved in cache_dir are kept)"""
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# (shared by the runs of dd_sweep; nets only use a cache if they're given one)
+default_cache = DatasetCache()
@@ -0,0 +1,339 @@
+"""Train a set of same-shaped DisjointDomainNets as one batched workload"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+import disjoint_domain as dd
+import ddnet
+
+
+class _MethodCall(nn.Module):
+    """Exposes one method of a network as its forward function, so it can be used with functional_call"""
+
+    def __init__(self, net, method):
+        super(_MethodCall, self).__init__()
+        self.net = net
+        self.method = method
+
+    def forward(self, *args, **kwargs):
+        return getattr(self.net, self.method)(*args, **kwargs)
+
+
+class DisjointDomainNetEnsemble:
+    """
+    A set of n_nets DisjointDomainNets with identical architecture, trained together.
+    The parameters of all replicas are stacked along a new first dimension and each training
+    step runs one vectorized (vmap) forward/backward pass over all replicas, which is much
+    cheaper than training the tiny nets one after another.
+
+    Each replica is an ordinary DisjointDomainNet (in self.nets) with its own seed and training data,
+    and gets its own shuffling order each epoch from a per-replica generator.
+
+    Measured on one CPU core against training the same nets one after another (see the ensemble
+    benchmarks in benchmarks/run_benchmarks.py), the speedup is well short of linear in n_nets:
+    about 1.5x for an epoch of 8 nets and 1.8x for 16, and about 1.4x for do_training of 8 nets
+    (1.5x with full holdout testing), since the stacked matrix products still do n_nets times the
+    work and only the per-call overhead is shared.
+    """
+
+    def __init__(self, n_nets, rng_seeds=None, **net_params):
+        if rng_seeds is None:
+            rng_seeds = [None] * n_nets
+        elif len(rng_seeds) != n_nets:
+            raise ValueError(f'Expected {n_nets} seeds, got {len(rng_seeds)}')
+
+        if net_params.get('index_inputs', False):
+            raise NotImplementedError('Ensembles do not support index inputs')
+        if net_params.get('block_attrs', False):
+            raise NotImplementedError('Ensembles do not support block attrs')
+        if net_params.get('output_mode', 'full') != 'full':
+            raise NotImplementedError('Ensembles only support the full output mode')
+
+        self.n_nets = n_nets
+        self.nets = []
+        self.generators = []
+        for seed in rng_seeds:
+            net = ddnet.DisjointDomainNet(rng_seed=seed, **net_params)
+            self.nets.append(net)
+            # shuffling orders for each replica depend only on its own seed
+            self.generators.append(torch.Generator().manual_seed(net.rng_seed))
+
+        self.base = self.nets[0]
+        self.device, self.torchfp = self.base.device, self.base.torchfp
+        self.params, _ = stack_module_state(self.nets)
+
+        # inputs are the same for each replica, only the attributes differ
+        self.x_item = self.base.x_item
+        self.x_context = self.base.x_context
+        self.ys = torch.stack([net.y for net in self.nets])
+        self.n_inputs = self.base.n_inputs
+        self.replica_inds = torch.arange(n_nets, device=self.ys.device)[:, np.newaxis]
+
+        self._forward = self._batched('forward', in_dims=(0, 0, 0))
+        self._saved_params = None  # buffers for saving the stacked parameters during generalization tests
+
+    def _batched(self, method, in_dims):
+        """Make a function that applies a method of the base net with each replica's parameters"""
+        caller = _MethodCall(self.base, method)
+
+        def call_method(params, *args, **kwargs):
+            return functional_call(caller, {'net.' + pname: p for pname, p in params.items()}, args, kwargs)
+
+        return vmap(call_method, in_dims=in_dims)
+
+    def sync_nets(self):
+        """Copy the current stacked parameters into each replica's own DisjointDomainNet"""
+        with torch.no_grad():
+            for k, net in enumerate(self.nets):
+                for pname, p in net.named_parameters():
+                    p.copy_(self.params[pname][k])
+
+    def train_epoch(self, orders, batch_size, optimizer):
+        """
+        Do training on batches of the given size, separately for each replica, of the examples
+        indexed by each row of orders (all rows must have the same length).
+        Returns the total loss, output accuracy and weighted accuracy for each replica and example
+        (n_nets x n_inputs, in index order); examples that are not used have nan accuracy.
+        """
+        total_loss = torch.zeros(self.n_nets, dtype=self.torchfp, device=self.device)
+        acc_each = torch.full((self.n_nets, self.n_inputs), np.nan, dtype=self.torchfp, device=self.device)
+        wacc_each = torch.full((self.n_nets, self.n_inputs), np.nan, dtype=self.torchfp, device=self.device)
+
+        for batch_inds in torch.split(orders, batch_size, dim=1) if batch_size > 0 else [orders]:
+            optimizer.zero_grad()
+            y = self.ys[self.replica_inds, batch_inds]
+            outputs = self._forward(self.params, self.x_item[batch_inds], self.x_context[batch_inds])
+            losses = torch.sum(nn.functional.binary_cross_entropy(outputs, y, reduction='none'), dim=(1, 2))
+            torch.sum(losses).backward()
+            optimizer.step()
+
+            with torch.no_grad():
+                total_loss += losses
+                b_correct = self.base.outputs_correct(outputs, y)
+                acc_each[self.replica_inds, batch_inds] = torch.mean(b_correct, dim=-1)
+                wacc_each[self.replica_inds, batch_inds] = self.base.weighted_acc_for_targets(outputs, y)
+
+        return total_loss, acc_each, wacc_each
+
+    def targets_wacc(self, target_inds):
+        """Mean weighted accuracy of each replica on its own target inputs (rows of target_inds; no training)"""
+        with torch.no_grad():
+            outputs = self._forward(self.params, self.x_item[target_inds], self.x_context[target_inds])
+            y = self.ys[self.replica_inds, target_inds]
+            return torch.mean(self.base.weighted_acc_for_targets(outputs, y), dim=1).cpu().numpy()
+
+    def generalize_tests(self, batch_size, optimizer, included_inds, targets, max_epochs=2000, thresh=0.99,
+                         mode='train', check_every=None):
+        """
+        Run DisjointDomainNet.generalize_test for all replicas at once: each epoch trains every replica
+        on its own included_inds (a list, one per replica, of the same length) with one vmapped pass,
+        until each replica reaches thresh on its own targets. Then restores the stacked parameters.
+        Returns the epoch counts as an array (max_epochs for replicas that never got there).
+
+        Training orders come from each replica's own generator, and a replica stops drawing from it once
+        it has reached the threshold, so each replica's results don't depend on the others.
+        Only the 'train' and 'eval' modes are supported.
+        """
+        if mode not in ['train', 'eval']:
+            raise NotImplementedError(f'Ensembles do not support generalize test mode "{mode}"')
+
+        target_inds = torch.stack([net.index.rows(t) for net, t in zip(self.nets, targets)]).to(self.ys.device)
+        n_included = len(included_inds[0])
+        if mode == 'train' or check_every is None or batch_size <= 0:
+            chunk_size = n_included
+        else:
+            chunk_size = check_every * batch_size
+
+        with torch.no_grad():
+            if self._saved_params is None:
+                self._saved_params = {pname: p.detach().clone() for pname, p in self.params.items()}
+            else:
+                for pname, p in self.params.items():
+                    self._saved_params[pname].copy_(p)
+
+        etgs = np.full(self.n_nets, max_epochs)
+        done = np.zeros(self.n_nets, dtype=bool)
+        for epoch in range(max_epochs):
+            # (replicas that are done keep training on a fixed order, to keep the batch shape)
+            orders = torch.stack([inds if done[k] else dd.choose_k(inds, n_included, generator=self.generators[k])
+                                  for k, inds in enumerate(included_inds)]).to(self.ys.device)
+
+            for start in range(0, n_included, chunk_size):
+                _, _, wacc_each = self.train_epoch(orders[:, start:start + chunk_size], batch_size, optimizer)
+                if mode == 'eval':
+                    reached = self.targets_wacc(target_inds) >= thresh
+                else:
+                    reached = torch.mean(wacc_each[self.replica_inds, target_inds], dim=1).cpu().numpy() >= thresh
+                etgs[reached & ~done] = epoch
+                done |= reached
+
+            if np.all(done):
+                break
+
+        with torch.no_grad():
+            for pname, p in self.params.items():
+                p.copy_(self._saved_params[pname])
+
+        return etgs
+
+    def do_training(self, lr, num_epochs, batch_size, report_freq,
+                    snap_freq, snap_freq_scale='lin', scheduler=None,
+                    holdout_testing='full', reports_per_test=1,
+                    test_thresh=0.99, test_max_epochs=2000, test_mode='train', test_check_every=None,
+                    do_combo_testing=False, param_snapshots=False):
+        """
+        Train all replicas for the specified number of epochs. Takes the same arguments as
+        DisjointDomainNet.do_training and returns a list with the dict it would return for each replica.
+
+        Generalization tests for holdout testing are batched over the replicas too (see generalize_tests),
+        except in 'search' mode, where they are done for each replica in turn, on its own net (with
+        training orders from the replica's own generator either way).
+        """
+        optimizer = torch.optim.SGD(self.params.values(), lr=lr)
+        test_optimizer = torch.optim.SGD(self.params.values(), lr=lr)
+
+        holdout_testing, do_holdout_testing, holdout_item, holdout_ctx = \
+            ddnet.DisjointDomainNet.parse_holdout_testing(holdout_testing)
+        splits = [net.prepare_splits(holdout_testing, do_combo_testing) for net in self.nets]
+
+        n_inputs_train = len(splits[0]['train_x_inds'])
+        if any(len(split['train_x_inds']) != n_inputs_train for split in splits):
+            raise RuntimeError('All replicas must train on the same number of inputs')
+        train_x_inds = [split['train_x_inds'] for split in splits]
+
+        if do_combo_testing:
+            test_x_inds = torch.stack([split['test_x_inds'] for split in splits]).to(self.ys.device)
+            test_y = self.ys[self.replica_inds, test_x_inds]
+
+        etg_digits = len(str(test_max_epochs)) + 2
+
+        # snapshots are stored separately for each replica but calculated all at once, for all items
+        # and contexts (items and contexts that are held out are put back to nan at the end).
+        snap_epochs = dd.calc_snap_epochs(snap_freq, snap_freq_scale, num_epochs)
+        epoch_digits = len(str(snap_epochs[-1]))
+        snap_fns = {}
+        if self.base.use_item_repr:
+            snap_fns['item'] = (self._batched('calc_item_repr', in_dims=(0, None)), self.base.items)
+        if self.base.use_ctx_repr:
+            snap_fns['context'] = (self._batched('calc_context_repr', in_dims=(0, None)), self.base.contexts)
+        calc_hidden = self._batched('calc_hidden', in_dims=(0, None, None))
+        snaps = {stype: [] for stype in [*snap_fns.keys(), 'item_hidden', 'context_hidden']}
+
+        params = {pname: [] for pname in self.params} if param_snapshots else {}
+        reports_each = [ddnet.DisjointDomainNet.prepare_reports(num_epochs, report_freq, reports_per_test,
+                                                                holdout_testing, do_combo_testing)
+                        for _ in range(self.n_nets)]
+
+        for epoch in range(num_epochs):
+
+            # collect snapshot
+            if epoch in snap_epochs:
+                with torch.no_grad():
+                    for stype, (snap_fn, inputs) in snap_fns.items():
+                        snaps[stype].append(snap_fn(self.params, inputs).cpu())
+
+                    snaps['item_hidden'].append(calc_hidden(self.params, self.base.items, None).cpu())
+                    snaps['context_hidden'].append(calc_hidden(self.params, None, self.base.contexts).cpu())
+
+                    for pname in params:
+                        params[pname].append(self.params[pname].detach().cpu().clone())
+
+            # do training
+            orders = torch.stack([dd.choose_k(inds, n_inputs_train, generator=gen)
+                                  for inds, gen in zip(train_x_inds, self.generators)]).to(self.ys.device)
+            loss, acc_each, wacc_each = self.train_epoch(orders, batch_size, optimizer)
+            if scheduler is not None:
+                scheduler.step()
+
+            # report progress
+            if epoch % report_freq == 0:
+                k_report = epoch // report_freq
+
+                mean_loss = loss.cpu().numpy() / n_inputs_train
+                mean_acc = torch.nansum(acc_each, dim=1).cpu().numpy() / n_inputs_train
+                mean_wacc = torch.nansum(wacc_each, dim=1).cpu().numpy() / n_inputs_train
+
+                report_str = (f'Epoch {epoch:{epoch_digits}d} end: mean loss = {np.mean(mean_loss):7.3f}, ' +
+                              f'mean weighted acc = {np.mean(mean_wacc):.3f}')
+
+                for k, reports in enumerate(reports_each):
+                    reports['loss'][k_report] = mean_loss[k]
+                    reports['accuracy'][k_report] = mean_acc[k]
+                    reports['weighted_acc'][k_report] = mean_wacc[k]
+
+                if do_holdout_testing and k_report % reports_per_test == 0:
+                    k_test = k_report // reports_per_test
+
+                    # training inputs and targets of each replica for each type of test
+                    tests = []
+                    if holdout_item:
+                        tests.append(('etg_item', [split['included_inds_item'] for split in splits],
+                                      [split['test_x_item_inds'] for split in splits]))
+                    if holdout_ctx:
+                        tests.append(('etg_context', [split['included_inds_ctx'] for split in splits],
+                                      [split['test_x_ctx_inds'] for split in splits]))
+                    if holdout_testing == 'domain':
+                        tests.append(('etg_domain', [net.index.rows() for net in self.nets],
+                                      [split['test_x_inds'] for split in splits]))
+
+                    for etg_type, included, targets in tests:
+                        # (tests can only be batched if every replica trains on as many inputs)
+                        if test_mode != 'search' and len({len(inds) for inds in included}) == 1:
+                            etgs = self.generalize_tests(batch_size, test_optimizer, included, targets,
+                                                         thresh=test_thresh, max_epochs=test_max_epochs,
+                                                         mode=test_mode, check_every=test_check_every)
+                        else:
+                            self.sync_nets()
+                            etgs = [net.generalize_test(batch_size, torch.optim.SGD(net.parameters(), lr=lr),
+                                                        inds, net_targets, thresh=test_thresh,
+                                                        max_epochs=test_max_epochs, generator=gen,
+                                                        mode=test_mode, check_every=test_check_every)[0]
+                                    for net, gen, inds, net_targets in zip(self.nets, self.generators,
+                                                                           included, targets)]
+                        for reports, etg in zip(reports_each, etgs):
+                            reports[etg_type][k_test] = etg
+
+                    for etg_type in ['etg_item', 'etg_context', 'etg_domain']:
+                        if etg_type in reports_each[0]:
+                            mean_etg = np.mean([reports[etg_type][k_test] for reports in reports_each]) + 1
+                            report_str += f', mean {etg_type} = {mean_etg:>{etg_digits}.1f}'
+
+                if do_combo_testing:
+                    with torch.no_grad():
+                        outputs = self._forward(self.params, self.x_item[test_x_inds], self.x_context[test_x_inds])
+                        test_acc = torch.mean(self.base.outputs_correct(outputs, test_y), dim=(1, 2)).cpu().numpy()
+                        test_wacc = torch.mean(self.base.weighted_acc_for_targets(outputs, test_y),
+                                               dim=1).cpu().numpy()
+
+                    report_str += f', mean test weighted acc = {np.mean(test_wacc):.3f}'
+                    for k, reports in enumerate(reports_each):
+                        reports['test_accuracy'][k_report] = test_acc[k]
+                        reports['test_weighted_acc'][k_report] = test_wacc[k]
+
+                print(report_str)
+
+        self.sync_nets()
+
+        # split everything up by replica
+        snaps = {stype: torch.stack(s, dim=1).numpy() for stype, s in snaps.items()}
+        params = {pname: torch.stack(p, dim=1).numpy() for pname, p in params.items()}
+
+        results = []
+        for k, (split, reports) in enumerate(zip(splits, reports_each)):
+            snaps_k = {stype: s[k].copy() for stype, s in snaps.items()}
+
+            # held-out items and contexts are never snapshotted during normal training
+            held_out_items = np.setdiff1d(np.arange(self.base.n_items), split['train_item_inds'])
+            held_out_contexts = np.setdiff1d(np.arange(self.base.n_contexts), split['train_ctx_inds'])
+            for stype, snap in snaps_k.items():
+                snap[:, held_out_items if 'item' in stype else held_out_contexts] = np.nan
+
+            ret_dict = {'snaps': snaps_k, 'reports': reports}
+            if param_snapshots:
+                ret_dict['params'] = {pname: p[k] for pname, p in params.items()}
+
+            results.append(ret_dict)
+
+        return results
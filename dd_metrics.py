@@ -0,0 +1,316 @@
+"""Timing and resource metrics for DisjointDomainNet.do_training, written as a stream of JSON lines"""
+
+import os
+import sys
+import json
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_memory(device=None):
+    """dict of peak memory use (in MB) of this process, and of the GPU if device is a CUDA device"""
+    peak = {}
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        peak['peak_rss_mb'] = maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+    if device is not None and torch.device(device).type == 'cuda':
+        peak['peak_cuda_mb'] = torch.cuda.max_memory_allocated(device) / 2**20
+    return peak
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        pass
+
+
+class NullMetrics:
+    """Does nothing - used by do_training when no metrics are requested, so timing costs nothing"""
+
+    _null_phase = _NullPhase()
+
+    def start(self, device=None, start_epoch=0, **info):
+        pass
+
+    def phase(self, name):
+        return self._null_phase
+
+    def epoch_start(self, epoch):
+        pass
+
+    def epoch_done(self, n_examples):
+        pass
+
+    def add_etg_epochs(self, n_epochs):
+        pass
+
+    def interval_done(self, epoch):
+        pass
+
+    def finish(self):
+        pass
+
+
+NO_METRICS = NullMetrics()
+
+
+class _Phase:
+    """Context manager that adds the wall and CPU time spent inside it to a phase of a TrainMetrics"""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        if self.metrics.profiler is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        self.metrics.interval_times[self.name][0] += wall
+        self.metrics.interval_times[self.name][1] += cpu
+        if self.metrics.profiler is not None:
+            self.record.__exit__(*exc)
+
+
+class TrainMetrics:
+    """
+    Records where the time goes in DisjointDomainNet.do_training (pass as its metrics argument).
+
+    Training is divided into phases (snapshot, train, scheduler, report, holdout_test, combo_test, checkpoint),
+    and the wall-clock and CPU time of each phase is accumulated between reports. At each report epoch,
+    one JSON object is appended to the file at path with the times of each phase since the last report,
+    the number of epochs and examples trained and the rates of each, the epochs of training done by
+    generalization tests, and peak memory use. The first line describes the run and the last one
+    (event 'end') has totals for the whole run, which are also kept in self.totals.
+
+    When training resumes from a checkpoint (start_epoch > 0), the records are appended to the existing file
+    after another 'start' record (with 'resumed': True), and the totals include the intervals recorded before
+    the interruption - so they count all the time spent on the run, including epochs that had to be redone.
+
+    CPU time is that of the whole process, so it includes e.g. torch's intra-op threads and other threads
+    running in the meantime, whereas wall time only counts time the training loop spends in each phase.
+
+    profile_epochs is an optional list of (start, stop) epoch ranges to run torch.profiler over; a
+    Chrome trace of each is saved as trace_<start>-<stop>.json in profile_dir (default: next to path).
+    """
+
+    PHASES = ['snapshot', 'train', 'scheduler', 'report', 'holdout_test', 'combo_test', 'checkpoint']
+
+    def __init__(self, path, profile_epochs=None, profile_dir=None):
+        self.path = path
+        self.profile_epochs = [] if profile_epochs is None else [tuple(window) for window in profile_epochs]
+        self.profile_dir = os.path.dirname(os.path.abspath(path)) if profile_dir is None else profile_dir
+        self.profiler = None
+        self.profile_window = None
+        self.file = None
+        self.totals = None
+
+        self.phases = {name: _Phase(self, name) for name in self.PHASES}
+        self.interval_times = {}
+        self.total_times = {}
+
+    def _reset_interval(self):
+        self.interval_start_epoch = self.next_epoch
+        self.interval_start_wall = time.perf_counter()
+        self.interval_start_cpu = time.process_time()
+        self.interval_times = {name: [0.0, 0.0] for name in self.phases}
+        self.interval_epochs = 0
+        self.interval_examples = 0
+        self.interval_etg_epochs = 0
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def start(self, device=None, start_epoch=0, **info):
+        """Called at the start of training (at start_epoch, if resuming), with information about the run to record"""
+        self.device = device
+        self.total_times = {name: [0.0, 0.0] for name in self.phases}
+        self.total_epochs = 0
+        self.total_examples = 0
+        self.total_etg_epochs = 0
+        self.prior_wall = 0.0
+        self.prior_cpu = 0.0
+
+        resumed = start_epoch > 0 and os.path.exists(self.path)
+        if resumed:
+            self._add_prior_intervals(load_metrics(self.path))
+        self.file = open(self.path, 'a' if resumed else 'w')
+        self._write({'event': 'start', 'time': time.time(), 'start_epoch': start_epoch, 'resumed': resumed, **info})
+
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.next_epoch = start_epoch
+        self._reset_interval()
+
+    def _add_prior_intervals(self, records):
+        # (intervals since the run last started from scratch, i.e. before this and any earlier resumption)
+        first = max([i for i, record in enumerate(records)
+                     if record['event'] == 'start' and not record.get('resumed', False)], default=0)
+        for record in records[first:]:
+            if record['event'] != 'interval':
+                continue
+            self.prior_wall += record['wall']
+            self.prior_cpu += record['cpu']
+            for name, times in record['phases'].items():
+                self.total_times.setdefault(name, [0.0, 0.0])
+                self.total_times[name][0] += times['wall']
+                self.total_times[name][1] += times['cpu']
+            self.total_epochs += record['n_epochs']
+            self.total_examples += record['n_examples']
+            self.total_etg_epochs += record['etg_epochs']
+
+    def phase(self, name):
+        """Context manager for a phase of training; phases should not be nested"""
+        return self.phases[name]
+
+    def epoch_start(self, epoch):
+        """Called at the start of each epoch, to start and stop profiling"""
+        if self.profiler is not None and epoch >= self.profile_window[1]:
+            self._stop_profiler()
+
+        if self.profiler is None:
+            for window in self.profile_epochs:
+                if window[0] == epoch:
+                    self._start_profiler(window)
+                    break
+
+    def _start_profiler(self, window):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device is not None and torch.device(self.device).type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profile_window = window
+        self.profiler = torch.profiler.profile(activities=activities)
+        self.profiler.__enter__()
+
+    def _stop_profiler(self):
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        start, stop = self.profile_window
+        self.profiler.export_chrome_trace(os.path.join(self.profile_dir, f'trace_{start}-{stop}.json'))
+        self.profiler = None
+        self.profile_window = None
+
+    def epoch_done(self, n_examples):
+        """Called after each epoch of training on n_examples examples"""
+        self.interval_epochs += 1
+        self.interval_examples += n_examples
+        self.next_epoch += 1
+
+    def add_etg_epochs(self, n_epochs):
+        """Count epochs of training done by a generalization test"""
+        self.interval_etg_epochs += n_epochs
+
+    @staticmethod
+    def _rates(wall, n_epochs, n_examples):
+        return {
+            'epochs_per_sec': n_epochs / wall if wall > 0 else None,
+            'examples_per_sec': n_examples / wall if wall > 0 else None
+        }
+
+    def interval_done(self, epoch):
+        """Write the record for the epochs since the last one, up to and including epoch"""
+        wall = time.perf_counter() - self.interval_start_wall
+        cpu = time.process_time() - self.interval_start_cpu
+        train_wall = self.interval_times['train'][0]
+
+        self._write({
+            'event': 'interval',
+            'epochs': [self.interval_start_epoch, epoch + 1],
+            'wall': wall,
+            'cpu': cpu,
+            'phases': {name: {'wall': w, 'cpu': c} for name, (w, c) in self.interval_times.items()},
+            'n_epochs': self.interval_epochs,
+            'n_examples': self.interval_examples,
+            **self._rates(wall, self.interval_epochs, self.interval_examples),
+            'train_examples_per_sec': self.interval_examples / train_wall if train_wall > 0 else None,
+            'etg_epochs': self.interval_etg_epochs,
+            **peak_memory(self.device)
+        })
+
+        for name, (w, c) in self.interval_times.items():
+            self.total_times[name][0] += w
+            self.total_times[name][1] += c
+        self.total_epochs += self.interval_epochs
+        self.total_examples += self.interval_examples
+        self.total_etg_epochs += self.interval_etg_epochs
+        self._reset_interval()
+
+    def finish(self):
+        """Called at the end of training - writes totals for the whole run and closes the file"""
+        if self.profiler is not None:
+            self._stop_profiler()
+        if self.interval_epochs > 0 or self.interval_etg_epochs > 0:
+            self.interval_done(self.next_epoch - 1)
+
+        wall = time.perf_counter() - self.start_wall + self.prior_wall
+        cpu = time.process_time() - self.start_cpu + self.prior_cpu
+        phase_wall = sum(w for w, _ in self.total_times.values())
+
+        self.totals = {
+            'wall': wall,
+            'cpu': cpu,
+            'phases': {name: {'wall': w, 'cpu': c, 'wall_fraction': w / wall if wall > 0 else None}
+                       for name, (w, c) in self.total_times.items()},
+            'other_wall': wall - phase_wall,
+            'n_epochs': self.total_epochs,
+            'n_examples': self.total_examples,
+            **self._rates(wall, self.total_epochs, self.total_examples),
+            'etg_epochs': self.total_etg_epochs,
+            **peak_memory(self.device)
+        }
+        self._write({'event': 'end', **self.totals})
+        self.file.close()
+        self.file = None
+        return self.totals
+
+
+def load_metrics(path):
+    """List of the records in a metrics file written by TrainMetrics"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_metrics(paths):
+    """
+    Add up the totals of several runs (e.g. all runs of a sweep) and print how much of the
+    wall time went to each phase. Runs that didn't finish are skipped. Returns the summed totals.
+    """
+    summary = {'n_runs': 0, 'wall': 0.0, 'cpu': 0.0, 'other_wall': 0.0, 'n_epochs': 0, 'n_examples': 0,
+               'etg_epochs': 0, 'phases': {name: {'wall': 0.0, 'cpu': 0.0} for name in TrainMetrics.PHASES}}
+    for path in paths:
+        records = load_metrics(path)
+        if len(records) == 0 or records[-1]['event'] != 'end':
+            continue
+        totals = records[-1]
+        summary['n_runs'] += 1
+        for key in ['wall', 'cpu', 'other_wall', 'n_epochs', 'n_examples', 'etg_epochs']:
+            summary[key] += totals[key]
+        for name, times in totals['phases'].items():
+            summary['phases'].setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            summary['phases'][name]['wall'] += times['wall']
+            summary['phases'][name]['cpu'] += times['cpu']
+
+    wall = summary['wall']
+    print(f'{summary["n_runs"]} runs, {wall:.1f} s wall, {summary["cpu"]:.1f} s CPU, ' +
+          f'{summary["n_epochs"]} epochs + {summary["etg_epochs"]} test epochs')
+    for name, times in [*summary['phases'].items(), ('other', {'wall': summary['other_wall'], 'cpu': None})]:
+        fraction = times['wall'] / wall if wall > 0 else 0
+        print(f'{name:>14}: {times["wall"]:9.1f} s wall ({fraction:6.1%})')
+
+    return summary
@@ -0,0 +1,433 @@
+"""Saving and loading results of sets of DisjointDomainNet runs"""
+
+import os
+import json
+import queue
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+FORMAT_VERSION = 3
+
+# groups of arrays with runs along the first dimension (and snapshots along the second, for
+# snapshots and parameters), which are saved as one .npy file per array in a subdirectory
+GROUPS = ['snapshots', 'reports', 'parameters']
+
+
+class _ParamEncoder(json.JSONEncoder):
+    """Encodes the torch and numpy objects that appear in net_params and train_params"""
+
+    def default(self, o):
+        if isinstance(o, torch.device):
+            return {'__torch_device__': str(o)}
+        if isinstance(o, torch.dtype):
+            return {'__torch_dtype__': str(o).replace('torch.', '')}
+        if isinstance(o, np.integer):
+            return int(o)
+        if isinstance(o, np.floating):
+            return float(o)
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        # e.g. a learning rate scheduler - only recorded for reference
+        return repr(o)
+
+
+def _decode_param(obj):
+    if '__torch_device__' in obj:
+        return torch.device(obj['__torch_device__'])
+    if '__torch_dtype__' in obj:
+        return getattr(torch, obj['__torch_dtype__'])
+    return obj
+
+
+def _write_meta(path, meta):
+    # write under another name and rename, so readers never see a partial file
+    tmp_path = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, cls=_ParamEncoder, indent=1)
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+
+def _read_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f, object_hook=_decode_param)
+
+
+def _is_binary(a):
+    return bool(np.all((a == 0) | (a == 1)))
+
+
+def save_results(path, snaps, reports, ys, net_params, train_params, parameters=None):
+    """
+    Save results of a set of runs as a directory at path, with each snapshot type, report type,
+    parameter and the ys array in its own .npy file (so they can be memory-mapped), and the
+    network and training parameters in meta.json.
+    If the ys are all 0 or 1 (as they are for DisjointDomainNets), they are saved bit-packed along the
+    attribute axis (as with np.packbits) in ys_packed.npy, which is 8 times smaller than bytes and
+    32 times smaller than float32.
+    The directory is written under another name and then renamed, so it is always complete if it exists.
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    groups = {'snapshots': snaps, 'reports': reports, 'parameters': parameters}
+    for group, arrays in groups.items():
+        if arrays is None:
+            continue
+        os.makedirs(os.path.join(tmp_path, group))
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, group, name + '.npy'), array)
+
+    ys = np.asarray(ys)
+    packed = _is_binary(ys)
+    if packed:
+        np.save(os.path.join(tmp_path, 'ys_packed.npy'), np.packbits(ys != 0, axis=-1))
+    else:
+        np.save(os.path.join(tmp_path, 'ys.npy'), ys)
+
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'n_runs': len(ys),
+        'complete': True,
+        'ys': {'packed': packed, 'n_attrs': ys.shape[-1], 'dtype': str(ys.dtype)},
+        'arrays': {group: list(arrays.keys()) for group, arrays in groups.items() if arrays is not None},
+        'net_params': net_params,
+        'train_params': train_params
+    }
+    _write_meta(tmp_path, meta)
+
+    os.replace(tmp_path, path)
+
+
+def is_complete(path):
+    """Whether path holds a complete set of results (not e.g. one still being written by a ResultWriter)"""
+    if not os.path.isdir(path):
+        return os.path.exists(path)  # (legacy .npz files are only saved once they are complete)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return False
+    return _read_meta(path).get('complete', True)
+
+
+def open_run_array(path, group, name, n_runs, shape, dtype):
+    """
+    Memory map of a whole array (n_runs x shape) of the result directory at path (group is one of GROUPS,
+    or None for ys), which is made (filled with zeros) if it doesn't exist yet. Any number of processes can
+    do this at once: the file is made under another name and linked into place, so exactly one of them
+    makes it and the rest open that one.
+    """
+    directory = path if group is None else os.path.join(path, group)
+    file_path = os.path.join(directory, name + '.npy')
+    shape = (n_runs, *shape)
+    dtype = np.dtype(dtype)
+
+    if not os.path.exists(file_path):
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape).flush()
+        try:
+            os.link(tmp_path, file_path)
+        except FileExistsError:
+            pass  # (made by another process in the meantime)
+        os.remove(tmp_path)
+
+    mmap = np.lib.format.open_memmap(file_path, mode='r+')
+    if mmap.shape != shape or mmap.dtype != dtype:
+        raise ValueError(f'{file_path} has shape {mmap.shape} and dtype {mmap.dtype}, not {shape} and {dtype}')
+    return mmap
+
+
+def write_run(path, n_runs, run_index, res, y, groups=GROUPS):
+    """
+    Write the results of one run - res as returned by DisjointDomainNet.do_training and y its attribute
+    matrix - into its slice of each array of the result directory at path (see open_run_array).
+    Only the given groups of res are written; e.g. snapshots written there during training by a
+    dd_snapshots.RunSliceSnapshotSink don't have to be written again.
+    Returns the info about the run that ResultWriter.add_written_run needs.
+    """
+    res_groups = {'snapshots': res['snaps'], 'reports': res['reports'], 'parameters': res.get('params')}
+    for group in groups:
+        for name, array in (res_groups[group] or {}).items():
+            array = np.asarray(array)
+            mmap = open_run_array(path, group, name, n_runs, array.shape, array.dtype)
+            mmap[run_index] = array
+            mmap.flush()
+
+    # (ys are saved packed if they are all 0 or 1, as in save_results)
+    y = np.asarray(y)
+    packed = _is_binary(y)
+    if packed:
+        y_packed = np.packbits(y != 0, axis=-1)
+        mmap = open_run_array(path, None, 'ys_packed', n_runs, y_packed.shape, np.uint8)
+        mmap[run_index] = y_packed
+    else:
+        mmap = open_run_array(path, None, 'ys', n_runs, y.shape, y.dtype)
+        mmap[run_index] = y
+    mmap.flush()
+
+    return {
+        'arrays': {group: list(arrays.keys()) for group, arrays in res_groups.items() if arrays is not None},
+        'ys': {'packed': packed, 'n_attrs': y.shape[-1], 'dtype': str(y.dtype)}
+    }
+
+
+class ResultWriter:
+    """
+    Writes the results of a set of n_runs runs to a directory at path, in the format of save_results,
+    one run at a time as they finish, so results never have to be gathered in memory and are on disk
+    as soon as possible. Runs are written in a background thread; write returns as soon as the run is
+    queued, unless max_pending runs are already waiting to be written, in which case it waits for room.
+
+    Each run is written into its own slice of arrays with runs along the first dimension (see write_run),
+    so runs can be written in any order - or by other processes, which then only report them with
+    add_written_run. meta.json lists the runs written so far and says whether all of them are, so the
+    results can be read with ResultStore while they are still being written (see ResultStore.runs_done).
+
+    An existing incomplete result directory at path (e.g. from an interrupted run) is replaced, unless
+    resume is True, in which case the runs it has (runs_done) are kept.
+    """
+
+    def __init__(self, path, n_runs, net_params, train_params, max_pending=2, resume=False):
+        self.path = path
+        self.n_runs = n_runs
+        self.meta = {
+            'format_version': FORMAT_VERSION,
+            'n_runs': n_runs,
+            'complete': False,
+            'runs_done': [],
+            'net_params': net_params,
+            'train_params': train_params
+        }
+
+        if os.path.exists(path):
+            if is_complete(path):
+                raise FileExistsError(f'Complete results already exist at {path}')
+            if resume and os.path.exists(os.path.join(path, 'meta.json')):
+                old_meta = _read_meta(path)
+                if old_meta['n_runs'] != n_runs:
+                    raise ValueError(f'Results at {path} are for {old_meta["n_runs"]} runs, not {n_runs}')
+                for key in ['runs_done', 'arrays', 'ys']:
+                    if key in old_meta:
+                        self.meta[key] = old_meta[key]
+            else:
+                shutil.rmtree(path)
+
+        self.error = None
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._write_queued, daemon=True)
+        self.thread.start()
+
+    @property
+    def runs_done(self):
+        """Runs that have been written (as of the last one the background thread finished)"""
+        return list(self.meta['runs_done'])
+
+    def _record_run(self, run_index, info):
+        if 'ys' not in self.meta:
+            self.meta['arrays'] = info['arrays']
+            self.meta['ys'] = info['ys']
+        elif info['ys']['packed'] != self.meta['ys']['packed']:
+            raise ValueError(f'Attributes of run {run_index} are {"" if info["ys"]["packed"] else "not "}all 0 or 1, '
+                             f'unlike those of earlier runs')
+
+        self.meta['runs_done'] = sorted({*self.meta['runs_done'], run_index})
+        os.makedirs(self.path, exist_ok=True)
+        _write_meta(self.path, self.meta)
+
+    def _write_queued(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:  # (after an error, runs are dropped so write never blocks forever)
+                try:
+                    run_index, res, y, info = item
+                    if info is None:
+                        info = write_run(self.path, self.n_runs, run_index, res, y)
+                    self._record_run(run_index, info)
+                except Exception as e:
+                    self.error = e
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError(f'Writing results to {self.path} failed') from self.error
+
+    def _check_index(self, run_index):
+        if not 0 <= run_index < self.n_runs:
+            raise ValueError(f'Run index {run_index} out of range for {self.n_runs} runs')
+
+    def write(self, run_index, res, y):
+        """
+        Queue the results of run run_index to be written: res as returned by DisjointDomainNet.do_training
+        and y its attribute matrix (as a numpy array). They must not be modified afterward.
+        """
+        self._check_error()
+        self._check_index(run_index)
+        self.queue.put((run_index, res, y, None))
+
+    def add_written_run(self, run_index, info):
+        """Record that run run_index has been written to path by someone else (info is from write_run)"""
+        self._check_error()
+        self._check_index(run_index)
+        self.queue.put((run_index, None, None, info))
+
+    def close(self):
+        """
+        Wait for all queued runs to be written, then mark the results complete if every run was written
+        (otherwise they are left readable but incomplete). Raises any error that happened while writing.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check_error()
+        if os.path.exists(os.path.join(self.path, 'meta.json')):
+            self.meta['complete'] = len(self.meta['runs_done']) == self.n_runs
+            _write_meta(self.path, self.meta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+
+class ResultStore:
+    """
+    Read-only access to results saved by save_results or a ResultWriter. Arrays are memory-mapped, so slicing
+    out some runs or snapshots (with get) only reads those from disk.
+
+    Results still being written (or left incomplete) by a ResultWriter can be read too: runs_done is the
+    array of runs written when the store was opened (complete says whether that is all of them), and getting
+    all runs (the default, runs=slice(None)) only gets those. Other run indices are always indices into all
+    n_runs runs, and runs that haven't been written read as zeros.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        meta = _read_meta(path)
+
+        if meta['format_version'] > FORMAT_VERSION:
+            raise RuntimeError(f'Result format version {meta["format_version"]} is too new')
+
+        self.n_runs = meta['n_runs']
+        self.complete = meta.get('complete', True)
+        self.runs_done = np.array(meta.get('runs_done', range(self.n_runs)), dtype=int)
+        # (until a ResultWriter has written its first run, there are no arrays)
+        self.arrays = meta.get('arrays', {})
+        self.net_params = meta['net_params']
+        self.train_params = meta['train_params']
+        # (format version 1 always saved unpacked ys)
+        self.ys_info = meta.get('ys', {'packed': False})
+
+    def _runs(self, runs):
+        """Index of the given runs into the arrays (all runs means only those written, if incomplete)"""
+        if not self.complete and isinstance(runs, slice) and runs == slice(None):
+            return self.runs_done
+        return runs
+
+    def names(self, group):
+        """Names of the arrays in a group (empty if the group wasn't saved)"""
+        return self.arrays.get(group, [])
+
+    def has_group(self, group):
+        return group in self.arrays
+
+    def get_mmap(self, group, name):
+        """Memory map of a whole array (group is one of GROUPS, or None for ys)"""
+        fname = name + '.npy'
+        path = os.path.join(self.path, fname) if group is None else os.path.join(self.path, group, fname)
+        if not os.path.exists(path):
+            raise KeyError(f'{group}/{name} not found in {self.path}')
+        return np.load(path, mmap_mode='r')
+
+    def get(self, group, name, runs=slice(None), subsample_snaps=1):
+        """
+        Load an array of a group for the given runs (index or slice) into memory.
+        For snapshots and parameters, only every subsample_snaps-th snapshot is loaded.
+        """
+        mmap = self.get_mmap(group, name)
+        runs = self._runs(runs)
+        if group in ['snapshots', 'parameters']:
+            return np.array(mmap[runs, ::subsample_snaps])
+        return np.array(mmap[runs])
+
+    def get_group(self, group, runs=slice(None), subsample_snaps=1):
+        """dict of all arrays in a group (or None if the group wasn't saved)"""
+        if not self.has_group(group):
+            return None
+        return {name: self.get(group, name, runs, subsample_snaps) for name in self.names(group)}
+
+    def get_ys(self, runs=slice(None), packed=False):
+        """
+        Load the attribute matrix of each of the given runs. If packed is True, they are returned bit-packed
+        along the last axis (see save_results), otherwise as the array that was saved.
+        """
+        runs = self._runs(runs)
+        if self.ys_info['packed']:
+            ys_packed = np.array(self.get_mmap(None, 'ys_packed')[runs])
+            if packed:
+                return ys_packed
+            return np.unpackbits(ys_packed, axis=-1, count=self.ys_info['n_attrs']).astype(self.ys_info['dtype'])
+
+        ys = np.array(self.get_mmap(None, 'ys')[runs])
+        return np.packbits(ys != 0, axis=-1) if packed else ys
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+
+class LegacyResultStore(ResultStore):
+    """
+    Same interface as ResultStore, for the old format of one .npz file holding pickled dicts of arrays.
+    Each group is unpickled (completely) the first time it is used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.resfile = np.load(path, allow_pickle=True)
+        self.net_params = self.resfile['net_params'].item()
+        self.train_params = self.resfile['train_params'].item()
+        self.n_runs = len(self.resfile['ys']) if 'ys' in self.resfile else None
+        self.complete = True
+        self.runs_done = None if self.n_runs is None else np.arange(self.n_runs)
+        self.ys_info = {'packed': False}
+        self.groups = {}
+
+    def _load_group(self, group):
+        if group not in self.groups:
+            self.groups[group] = self.resfile[group].item() if group in self.resfile else None
+        return self.groups[group]
+
+    def names(self, group):
+        arrays = self._load_group(group)
+        return [] if arrays is None else list(arrays.keys())
+
+    def has_group(self, group):
+        return self._load_group(group) is not None
+
+    def get_mmap(self, group, name):
+        if group is None:
+            return self.resfile[name]
+
+        arrays = self._load_group(group)
+        if arrays is None or name not in arrays:
+            raise KeyError(f'{group}/{name} not found in {self.path}')
+        return arrays[name]
+
+    def close(self):
+        self.resfile.close()
+
+
+def open_results(path):
+    """Open saved results in either the directory format of save_results or the legacy .npz format"""
+    if os.path.isdir(path):
+        return ResultStore(path)
+    return LegacyResultStore(path)
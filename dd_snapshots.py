@@ -0,0 +1,203 @@
+"""Places to store representation and parameter snapshots as they are taken during training"""
+
+import os
+import json
+
+import numpy as np
+import torch
+
+import dd_results
+
+
+class InMemorySnapshotSink:
+    """
+    Keeps all snapshots in preallocated nan-filled tensors (on the training device),
+    and converts them to numpy arrays at the end. This is the default for DisjointDomainNet.do_training.
+    Snapshots are organized in groups ('snaps' for representations, 'params' for parameters).
+    """
+
+    def __init__(self):
+        self.arrays = {}
+
+    def allocate(self, group, name, shape, dtype=None, device=None):
+        """Make space for a snapshot type with shape (n_snaps, ...)"""
+        self.arrays.setdefault(group, {})[name] = torch.full(shape, np.nan, dtype=dtype, device=device)
+
+    def write(self, group, name, k_snap, values, inds=slice(None)):
+        """Store rows inds of snapshot k_snap"""
+        self.arrays[group][name][k_snap][inds] = values
+
+    def snapshot_done(self, k_snap):
+        """Called after all types of snapshot k_snap have been written"""
+        pass
+
+    def checkpoint_state(self):
+        """Copy of the snapshots taken so far, to be saved in a training checkpoint"""
+        return {group: {name: a.cpu().clone() for name, a in arrays.items()} for group, arrays in self.arrays.items()}
+
+    def load_checkpoint_state(self, state):
+        """Put back snapshots from checkpoint_state (after allocating space for them)"""
+        for group, arrays in state.items():
+            for name, a in arrays.items():
+                self.arrays[group][name].copy_(a)
+
+    def finalize(self):
+        """Returns dict of groups, each a dict of numpy arrays"""
+        return {group: {name: a.cpu().numpy() for name, a in arrays.items()}
+                for group, arrays in self.arrays.items()}
+
+
+class MemmapSnapshotSink:
+    """
+    Streams each snapshot to disk as it is taken, so long runs don't hold all snapshots in memory
+    and everything up to the last snapshot survives an interruption.
+
+    Each snapshot type is a memory-mapped .npy file at <directory>/<group>/<name>.npy, preallocated with nans
+    and flushed after every snapshot. <directory>/progress.json records how many snapshots are complete.
+    finalize returns read-only memory maps of the files.
+
+    The files themselves hold the snapshots of a checkpointed run, so to resume training from a checkpoint,
+    make the sink with resume=True, which keeps the existing files instead of allocating new ones.
+    """
+
+    def __init__(self, directory, resume=False):
+        self.directory = directory
+        self.resume = resume
+        self.arrays = {}
+
+    def _path(self, group, name):
+        return os.path.join(self.directory, group, name + '.npy')
+
+    def allocate(self, group, name, shape, dtype=None, device=None):
+        """Make space for a snapshot type with shape (n_snaps, ...) (always in memory-mapped files, whatever the device)"""
+        os.makedirs(os.path.join(self.directory, group), exist_ok=True)
+        np_dtype = torch.empty((), dtype=dtype, device='cpu').numpy().dtype
+        path = self._path(group, name)
+
+        if self.resume:
+            mm = np.lib.format.open_memmap(path, mode='r+')
+            if mm.shape != tuple(shape) or mm.dtype != np_dtype:
+                raise ValueError(f'Existing snapshots in {path} do not match the run being resumed')
+        else:
+            mm = np.lib.format.open_memmap(path, mode='w+', dtype=np_dtype, shape=tuple(shape))
+            mm[...] = np.nan
+            self._write_progress(0)
+        self.arrays.setdefault(group, {})[name] = mm
+
+    def write(self, group, name, k_snap, values, inds=slice(None)):
+        """Store rows inds of snapshot k_snap"""
+        if isinstance(inds, torch.Tensor):
+            inds = inds.cpu().numpy()
+        self.arrays[group][name][k_snap, inds] = values.detach().cpu().numpy()
+
+    def snapshot_done(self, k_snap):
+        """Called after all types of snapshot k_snap have been written - flushes everything to disk"""
+        for arrays in self.arrays.values():
+            for mm in arrays.values():
+                mm.flush()
+        self._write_progress(k_snap + 1)
+
+    def _write_progress(self, n_done):
+        tmp_path = os.path.join(self.directory, 'progress.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'snaps_done': n_done}, f)
+        os.replace(tmp_path, os.path.join(self.directory, 'progress.json'))
+
+    def checkpoint_state(self):
+        """Nothing to save in a training checkpoint, since the snapshots are already on disk"""
+        return None
+
+    def load_checkpoint_state(self, state):
+        """The snapshots of the run being resumed are already in place"""
+        if not self.resume:
+            raise ValueError('To resume from a checkpoint, make the MemmapSnapshotSink with resume=True')
+
+    def finalize(self):
+        """Returns dict of groups, each a dict of read-only memory-mapped arrays"""
+        out = {}
+        for group, arrays in self.arrays.items():
+            for mm in arrays.values():
+                mm.flush()
+            out[group] = {name: np.load(self._path(group, name), mmap_mode='r') for name in arrays}
+        self.arrays = {}
+        return out
+
+
+class RunSliceSnapshotSink:
+    """
+    Writes each snapshot straight into run run_index's slice of the arrays of a result directory
+    (dd_results format, with runs along the first dimension), so runs trained in separate processes
+    don't have to send their snapshots anywhere - the arrays are shared through the files (see
+    dd_results.open_run_array and dd_results.write_run for the rest of each run's results).
+
+    The run's slices are filled with nans when they are allocated, and flushed after every snapshot.
+    As with MemmapSnapshotSink, to resume training from a checkpoint, make the sink with resume=True.
+    finalize returns read-only memory maps of the run's slices.
+    """
+
+    # groups of snapshots in do_training -> groups of arrays in the result directory
+    GROUPS = {'snaps': 'snapshots', 'params': 'parameters'}
+
+    def __init__(self, path, run_index, n_runs, resume=False):
+        self.path = path
+        self.run_index = run_index
+        self.n_runs = n_runs
+        self.resume = resume
+        self.arrays = {}
+
+    def allocate(self, group, name, shape, dtype=None, device=None):
+        """Make space for a snapshot type with shape (n_snaps, ...) (always in memory-mapped files, whatever the device)"""
+        np_dtype = torch.empty((), dtype=dtype, device='cpu').numpy().dtype
+        mm = dd_results.open_run_array(self.path, self.GROUPS[group], name, self.n_runs, shape, np_dtype)
+        if not self.resume:
+            mm[self.run_index] = np.nan
+        self.arrays.setdefault(group, {})[name] = mm
+
+    def write(self, group, name, k_snap, values, inds=slice(None)):
+        """Store rows inds of snapshot k_snap"""
+        if isinstance(inds, torch.Tensor):
+            inds = inds.cpu().numpy()
+        self.arrays[group][name][self.run_index, k_snap, inds] = values.detach().cpu().numpy()
+
+    def snapshot_done(self, k_snap):
+        """Called after all types of snapshot k_snap have been written - flushes everything to disk"""
+        for arrays in self.arrays.values():
+            for mm in arrays.values():
+                mm.flush()
+
+    def checkpoint_state(self):
+        """Nothing to save in a training checkpoint, since the snapshots are already on disk"""
+        return None
+
+    def load_checkpoint_state(self, state):
+        """The snapshots of the run being resumed are already in place"""
+        if not self.resume:
+            raise ValueError('To resume from a checkpoint, make the RunSliceSnapshotSink with resume=True')
+
+    def finalize(self):
+        """Returns dict of groups, each a dict of read-only memory-mapped arrays (this run's slices)"""
+        out = {}
+        for group, arrays in self.arrays.items():
+            out[group] = {}
+            for name, mm in arrays.items():
+                mm.flush()
+                out[group][name] = np.load(mm.filename, mmap_mode='r')[self.run_index]
+        self.arrays = {}
+        return out
+
+
+def load_snapshot_dir(directory):
+    """
+    Read snapshots written by a MemmapSnapshotSink (possibly from an interrupted run) as memory-mapped arrays.
+    Returns dict of groups and the number of complete snapshots.
+    """
+    with open(os.path.join(directory, 'progress.json')) as f:
+        n_done = json.load(f)['snaps_done']
+
+    out = {}
+    for group in os.listdir(directory):
+        group_dir = os.path.join(directory, group)
+        if os.path.isdir(group_dir):
+            out[group] = {fname[:-4]: np.load(os.path.join(group_dir, fname), mmap_mode='r')
+                          for fname in os.listdir(group_dir) if fname.endswith('.npy')}
+    return out, n_done
@@ -0,0 +1,360 @@
+"""Run sets of DisjointDomainNet training runs and save the results"""
+
+import os
+import argparse
+import json
+import traceback
+import multiprocessing as mp
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime as dt
+
+import numpy as np
+import torch
+
+import disjoint_domain as dd
+import ddnet
+import dd_results
+import dd_metrics
+import dd_checkpoint
+import dd_datasets
+import dd_snapshots
+
+
+def get_default_params(net_params=None, train_params=None, device=None, set_default=False):
+    """
+    Fill in defaults for the DisjointDomainNet constructor and do_training parameters.
+    If set_default is True, the default device and dtype also become torch's process-wide defaults
+    (see dd.init_torch), as code written before nets set them explicitly expects.
+    """
+    (ctx_per_domain, n_domains, n_items, n_ctx, attrs_per_context,
+     attrs_set_per_item) = dd.get_net_dims(attrs_per_context=60)
+    device, torchfp = dd.init_torch(device, set_default=set_default)
+
+    net_defaults = {
+        'ctx_per_domain': ctx_per_domain,
+        'attrs_per_context': attrs_per_context,
+        'attrs_set_per_item': attrs_set_per_item,
+        'n_domains': n_domains,
+        'device': device,
+        'torchfp': torchfp,
+        'param_init_scale': 0.01,
+        'cluster_info': '4-2-2',
+        'repeat_attrs_over_domains': False
+    }
+    if net_params is None:
+        net_params = {}
+    net_params = {**net_defaults, **net_params}
+
+    train_defaults = {
+        'lr': 0.01,
+        'scheduler': None,
+        'num_epochs': 3001,
+        'batch_size': 16,
+        'report_freq': 50,
+        'snap_freq': 50,
+        'snap_freq_scale': 'lin',
+        'holdout_testing': 'none',
+        'test_thresh': 0.97,
+        'test_max_epochs': 10000,
+        'reports_per_test': 4,
+        'do_combo_testing': False
+    }
+    if train_params is None:
+        train_params = {}
+    train_params = {**train_defaults, **train_params}
+
+    return net_params, train_params
+
+
+def run_seed(sweep_seed, run_index):
+    """Seed for one run of a sweep, derived from the sweep seed and the index of the run"""
+    return int(np.random.SeedSequence([sweep_seed, run_index]).generate_state(1)[0])
+
+
+def make_run_generator(sweep_seed, run_index, device='cpu'):
+    """
+    Generator for one run of a sweep, seeded with run_seed(sweep_seed, run_index). A net made with it
+    (DisjointDomainNet's generator argument) draws everything random from this stream alone, so each run
+    gives the same result however many runs are going on at once and in whatever order.
+    """
+    return torch.Generator(device=device).manual_seed(run_seed(sweep_seed, run_index))
+
+
+def train_n_dd_nets(n=36, run_type='', net_params=None, train_params=None, checkpoint_dir=None, sweep_seed=None):
+    """
+    Train n networks in sequence and save the results in 'data'. Returns the result path and last net.
+    Unless checkpoint_dir is given, each run's results are written to the result directory (by a
+    dd_results.ResultWriter) as soon as it finishes, so they can be looked at before the last run is done.
+
+    If sweep_seed is given, run i uses make_run_generator(sweep_seed, i), so its results are the same as
+    those of run i of run_sweep with that seed (and the same parameters, on the same device).
+
+    If checkpoint_dir is given, each finished run is saved there (as in run_sweep) and the current run
+    is checkpointed periodically (see DisjointDomainNet.do_training). Calling this again with the same
+    arguments after an interruption skips the finished runs and resumes the current one from its checkpoint.
+    """
+    # (notebooks that call this build tensors afterward that rely on the net's device and dtype being the defaults)
+    net_params, train_params = get_default_params(net_params, train_params, set_default=True)
+    if net_params['device'].type == 'cuda':
+        print('Using CUDA')
+    else:
+        print('Using CPU')
+
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        run_paths = [os.path.join(checkpoint_dir, f'run_{i:03d}.npz') for i in range(n)]
+
+    if run_type != '':
+        run_type += '_'
+
+    save_name = f'data/{run_type}dd_res_{dt.now():%Y-%m-%d_%H-%M-%S}'
+    net = None
+
+    # (with a checkpoint_dir, runs are saved there instead, and collected into the results at the end)
+    with (dd_results.ResultWriter(save_name, n, net_params, train_params) if checkpoint_dir is None
+          else nullcontext()) as writer:
+        for i in range(n):
+            if checkpoint_dir is not None and os.path.exists(run_paths[i]):
+                print(f'Iteration {i+1} already done')
+                continue
+
+            print(f'Training Iteration {i+1}')
+            print('---------------------')
+
+            # (runs of the same dataset, e.g. after an interruption, share it through the dataset cache)
+            run_net_params = {**net_params, 'dataset_cache': dd_datasets.default_cache}
+            if sweep_seed is not None:
+                run_net_params = {**run_net_params, 'rng_seed': None,
+                                  'generator': make_run_generator(sweep_seed, i)}
+
+            if checkpoint_dir is None:
+                net = ddnet.DisjointDomainNet(**run_net_params)
+                res = net.do_training(**train_params)
+                writer.write(i, res, net.get_y().cpu().numpy())
+            else:
+                # make the same net again if this run was interrupted
+                checkpoint_path = os.path.join(checkpoint_dir, f'run_{i:03d}.ckpt')
+                rng_seed = run_net_params.get('rng_seed')
+                if os.path.exists(checkpoint_path) and sweep_seed is None:
+                    rng_seed = dd_checkpoint.load_checkpoint(checkpoint_path)['rng_seed']
+
+                net = ddnet.DisjointDomainNet(**{**run_net_params, 'rng_seed': rng_seed})
+                res = net.do_training(**train_params, checkpoint_path=checkpoint_path)
+                _save_run(run_paths[i], res, net.get_y().cpu().numpy())
+                os.remove(checkpoint_path)
+
+            print('')
+
+    if checkpoint_dir is not None:
+        _collect_runs(save_name, run_paths, net_params, train_params)
+
+    return save_name, net
+
+
+def _init_worker(dataset_cache_dir=None):
+    """Each worker process trains one net at a time on one core"""
+    torch.set_num_threads(1)
+    dd_datasets.default_cache.cache_dir = dataset_cache_dir
+
+
+def _save_run(path, res, y):
+    """Save the results of one run to its own file (with the attribute matrix y bit-packed)"""
+    # write under another name and rename, so a file that exists is always complete
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, res=res, y_packed=dd.pack_attrs(y), n_attrs=y.shape[-1], y_dtype=str(y.dtype))
+    os.replace(tmp_path, path)
+
+
+def _run_job(job):
+    """
+    Train one net of a sweep, writing its results directly into its slice of the arrays of the result directory
+    job['res_path'] (snapshots as they are taken, then reports and the attribute matrix), so nothing but a
+    summary is sent back. Returns the run type, run index, traceback string if training failed (else None)
+    and the info from dd_results.write_run (None if training failed).
+    """
+    try:
+        # (generators can't be sent to the workers, so each run's is made here from its seed)
+        generator = None if job['rng_seed'] is None else torch.Generator().manual_seed(job['rng_seed'])
+        net = ddnet.DisjointDomainNet(generator=generator, dataset_cache=dd_datasets.default_cache,
+                                      **job['net_params'])
+        metrics = None if job['metrics_path'] is None else dd_metrics.TrainMetrics(job['metrics_path'])
+        snap_sink = dd_snapshots.RunSliceSnapshotSink(job['res_path'], job['run_index'], job['n_runs'])
+        res = net.do_training(**job['train_params'], metrics=metrics, snap_sink=snap_sink)
+        info = dd_results.write_run(job['res_path'], job['n_runs'], job['run_index'], res,
+                                    net.get_y().cpu().numpy(), groups=['reports'])
+    except Exception:
+        return job['run_type'], job['run_index'], traceback.format_exc(), None
+
+    return job['run_type'], job['run_index'], None, info
+
+
+def _run_jobs_in_threads(jobs, n_workers, dataset_cache_dir=None):
+    """
+    Run sweep jobs in a pool of n_workers threads in this process, yielding the results of _run_job as they
+    finish. The runs share the process's dataset cache and torch's pool of intra-op threads, which is
+    split evenly between them while they run (torch only has a process-wide setting for it).
+    """
+    n_threads = torch.get_num_threads()
+    old_cache_dir = dd_datasets.default_cache.cache_dir
+    torch.set_num_threads(max(1, n_threads // n_workers))
+    dd_datasets.default_cache.cache_dir = dataset_cache_dir
+    try:
+        with ThreadPoolExecutor(n_workers) as executor:
+            for future in as_completed([executor.submit(_run_job, job) for job in jobs]):
+                yield future.result()
+    finally:
+        torch.set_num_threads(n_threads)
+        dd_datasets.default_cache.cache_dir = old_cache_dir
+
+
+def _collect_runs(res_path, run_paths, net_params, train_params):
+    """Combine per-run files of one sweep configuration into one result directory and delete them"""
+    # (one run is loaded at a time, while the last one is written)
+    with dd_results.ResultWriter(res_path, len(run_paths), net_params, train_params) as writer:
+        for i, path in enumerate(run_paths):
+            with np.load(path, allow_pickle=True) as runfile:
+                res = runfile['res'].item()
+                if 'y_packed' in runfile:
+                    y = dd.unpack_attrs(runfile['y_packed'], int(runfile['n_attrs']), str(runfile['y_dtype']))
+                else:  # saved before ys were packed
+                    y = runfile['y']
+            writer.write(i, res, y)
+
+    for path in run_paths:
+        os.remove(path)
+    os.rmdir(os.path.dirname(run_paths[0]))
+
+
+def run_sweep(configs, n_runs=36, out_dir='data', n_workers=None, sweep_seed=None, metrics_dir=None,
+              dataset_cache_dir=None, use_threads=False):
+    """
+    Train n_runs nets for each configuration in configs, spread over a pool of worker processes.
+    configs maps each run type (used for the result file name) to a dict with optional 'net_params' and
+    'train_params' entries, which override the defaults from get_default_params (nets are always trained on CPU).
+
+    The results of each configuration go to out_dir/<run_type>_dd_res (see dd_results). Its arrays are memory-mapped
+    files shared by all workers, which write each run's snapshots, reports and attributes directly into that
+    run's slice as it trains (see dd_snapshots.RunSliceSnapshotSink), so results are never copied between
+    processes or gathered in memory; this process only records which runs are done (with a dd_results.ResultWriter).
+    Running the same sweep again skips configurations and runs that are already done, so an interrupted sweep
+    can be resumed; a run that fails is reported and leaves its configuration incomplete without affecting the others.
+
+    If sweep_seed is given, run i of each configuration draws everything random from its own generator
+    (see make_run_generator), so results are reproducible, don't depend on how runs are spread over workers,
+    match train_n_dd_nets with the same sweep_seed, and configurations can be compared run by run.
+    If metrics_dir is given, timing metrics of each run are written to metrics_dir/<run_type>_run_<i>.jsonl
+    (see dd_metrics.TrainMetrics), and dd_metrics.summarize_metrics of all of them is printed at the end.
+    If dataset_cache_dir is given, the datasets of all runs are cached there (see dd_datasets.DatasetCache),
+    so with a sweep_seed, configurations that only differ in training parameters (and later sweeps) reuse them.
+
+    If use_threads is True, the runs are trained in a pool of threads in this process instead of worker processes,
+    which avoids starting the processes and pickling the jobs, and lets the runs share datasets in memory.
+    Nets keep their dtype and device to themselves, so configurations can also use different ones (through
+    'torchfp' and 'device' in their net_params). Every run then has its own generator; if sweep_seed isn't
+    given, a random one is chosen (and printed) so the runs can't disturb each other's random numbers.
+    Returns a dict of result paths (or None for incomplete configurations) for each run type.
+    """
+    if metrics_dir is not None:
+        os.makedirs(metrics_dir, exist_ok=True)
+    if use_threads and sweep_seed is None:
+        sweep_seed = int(np.random.SeedSequence().generate_state(1)[0])
+        print(f'Sweep seed: {sweep_seed}')
+
+    jobs = []
+    res_paths = {}
+    writers = {}
+    runs_left = {}
+    for run_type, config in configs.items():
+        net_params, train_params = get_default_params(config.get('net_params'), config.get('train_params'),
+                                                      device='cpu')
+
+        res_paths[run_type] = os.path.join(out_dir, f'{run_type}_dd_res')
+        if dd_results.is_complete(res_paths[run_type]):
+            print(f'Skipping {run_type} (already done)')
+            continue
+
+        writers[run_type] = dd_results.ResultWriter(res_paths[run_type], n_runs, net_params, train_params, resume=True)
+        runs_done = set(writers[run_type].runs_done)
+        runs_left[run_type] = n_runs - len(runs_done)
+
+        for i in range(n_runs):
+            if i not in runs_done:
+                jobs.append({
+                    'run_type': run_type,
+                    'run_index': i,
+                    'res_path': res_paths[run_type],
+                    'n_runs': n_runs,
+                    'rng_seed': None if sweep_seed is None else run_seed(sweep_seed, i),
+                    'metrics_path': None if metrics_dir is None else os.path.join(metrics_dir,
+                                                                                  f'{run_type}_run_{i:03d}.jsonl'),
+                    'net_params': net_params,
+                    'train_params': train_params
+                })
+
+    failed = set()
+
+    def finish_config(run_type):
+        writers.pop(run_type).close()
+        if run_type in failed:
+            print(f'{run_type} incomplete (some runs failed)')
+            res_paths[run_type] = None
+        else:
+            print(f'Saved {res_paths[run_type]}')
+
+    def finish_job(run_type, run_index, error, info):
+        if error is not None:
+            print(f'{run_type} run {run_index} failed:\n{error}')
+            failed.add(run_type)
+        else:
+            writers[run_type].add_written_run(run_index, info)
+            print(f'{run_type} run {run_index} done')
+
+        runs_left[run_type] -= 1
+        if runs_left[run_type] == 0:
+            finish_config(run_type)
+
+    try:
+        # configurations whose runs were all done already
+        for run_type, n_left in runs_left.items():
+            if n_left == 0:
+                finish_config(run_type)
+
+        print(f'Running {len(jobs)} jobs')
+        if use_threads:
+            for result in _run_jobs_in_threads(jobs, n_workers or os.cpu_count(), dataset_cache_dir):
+                finish_job(*result)
+        else:
+            with mp.get_context('spawn').Pool(n_workers, initializer=_init_worker,
+                                              initargs=(dataset_cache_dir,)) as pool:
+                for result in pool.imap_unordered(_run_job, jobs):
+                    finish_job(*result)
+    finally:
+        # (if interrupted, record the runs that did finish, so running the sweep again skips them)
+        for writer in writers.values():
+            writer.close()
+
+    if metrics_dir is not None:
+        dd_metrics.summarize_metrics([os.path.join(metrics_dir, fname) for fname in sorted(os.listdir(metrics_dir))
+                                      if fname.endswith('.jsonl')])
+
+    return res_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a sweep of DisjointDomainNet configurations')
+    parser.add_argument('grid', help='JSON file mapping run types to {"net_params": ..., "train_params": ...}')
+    parser.add_argument('-n', '--n-runs', type=int, default=36, help='runs per configuration')
+    parser.add_argument('-o', '--out-dir', default='data', help='where to save results')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes (or threads)')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='sweep seed')
+    parser.add_argument('-m', '--metrics-dir', default=None, help='where to write timing metrics of each run')
+    parser.add_argument('-d', '--dataset-cache', default=None, help='directory to cache generated datasets in')
+    parser.add_argument('-t', '--threads', action='store_true', help='train in threads instead of worker processes')
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+
+    run_sweep(grid, n_runs=args.n_runs, out_dir=args.out_dir, n_workers=args.workers, sweep_seed=args.seed,
+              metrics_dir=args.metrics_dir, dataset_cache_dir=args.dataset_cache, use_threads=args.threads)
@@ -1,9 +1,13 @@
+import os
 import torch
 import torch.nn as nn
 import numpy as np
 from copy import deepcopy
 
 import disjoint_domain as dd
+from dd_snapshots import InMemorySnapshotSink
+from dd_metrics import NO_METRICS
+from dd_checkpoint import CheckpointWriter, load_checkpoint, get_rng_state, set_rng_state
 
 
 class DisjointDomainNet(nn.Module):
@@ -13,22 +17,85 @@ class DisjointDomainNet(nn.Module):
     item_repr_compression: 
     Contains separate item representation and context representation layers,
     unless "merged" is True, in which case there is a common representation layer.
+    
+    If index_inputs is True, items and contexts are given to the network as integer indices
+    rather than one-hot vectors, and the input layers are sparse embeddings instead of dense
+    matrix multiplies (with identical outputs). Then x_item, x_context, items and contexts
+    all hold indices.
+    
+    If block_attrs is True, the attributes (targets) are kept as a dd.BlockAttrs object in self.attrs,
+    which only stores each input's block of attributes within its context, and self.y is None.
+    Use get_y to get rows of the full attribute matrix. The training data is the same as otherwise,
+    but memory use no longer grows quadratically with the number of domains.
+    
+    output_mode controls how the loss is computed during training (each input's targets are all 0
+    except within the attrs_per_context attributes of its context):
+    'full' - BCE loss on the outputs for all attributes (default)
+    'exact' - the same loss computed from the output logits, using the fact that outside each input's
+              block of attributes the loss is just softplus(logit), so the full targets are never needed.
+              It still computes the logits of all attributes (softplus has no closed-form sum over the
+              off-block ones), so it doesn't make steps cheaper; it is a reference for checking 'sampled'
+              against (see test_output_mode_validity), and useful with block_attrs.
+    'sampled' - exact loss for each input's block of attributes plus an unbiased estimate of the rest from
+                n_off_block_samples attributes sampled per batch, either uniformly or (if off_block_sampling
+                is 'bias') in proportion to softplus of their biases. Then the cost of each step scales with
+                attrs_per_context + n_off_block_samples rather than the total number of attributes.
+
+    If generator (a torch.Generator) is given, everything random about the net - its parameters, attributes,
+    holdout splits and training orders - is drawn from it instead of the global torch RNG, which is never
+    touched. Nets with their own generators can then be made and trained in any order, or concurrently in
+    threads, with the same results as one at a time. rng_seed seeds the generator if given; otherwise the
+    generator's own seed is recorded (so it should be freshly seeded to be able to make the net again).
+    This makes different parameters for a given seed than using the global RNG, and the 'default'
+    param_init_type can't be used, since nn.Linear always initializes itself from the global RNG.
+
+    If vectorized_attrs is True, the attributes are generated with dd.make_attr_vecs_batch, which is faster
+    for many domains and contexts but makes different attributes for a given seed than the default.
+
+    If dataset_cache (a dd_datasets.DatasetCache, e.g. the in-memory dd_datasets.default_cache that
+    dd_sweep's runs use) is given, the attributes are taken from it when the same dataset has been made
+    before, e.g. by another net with the same seed and parameters; the result is the same as making them
+    again. By default they are always made.
     """
 
     def gen_training_tensors(self):
-        """Make PyTorch x and y tensors for training DisjointDomainNet"""
+        """
+        Make PyTorch x and y tensors for training DisjointDomainNet
+        (if block_attrs is True, y is a dd.BlockAttrs object instead)
+        """
 
-        item_mat, context_mat, attr_mat = dd.make_io_mats(
+        make_domain_attrs = (dd.make_domain_attrs if self.dataset_cache is None
+                             else self.dataset_cache.get_domain_attrs)
+        domain_attrs, domain_inds = make_domain_attrs(
             ctx_per_domain=self.ctx_per_domain, attrs_per_context=self.attrs_per_context,
             attrs_set_per_item=self.attrs_set_per_item,
-            n_domains=self.n_domains, cluster_info=self.cluster_info, 
+            n_domains=self.n_domains, cluster_info=self.cluster_info,
             last_domain_cluster_info=self.last_domain_cluster_info,
-            repeat_attrs_over_domains=self.repeat_attrs_over_domains)
+            repeat_attrs_over_domains=self.repeat_attrs_over_domains,
+            vectorized=self.vectorized_attrs, generator=self.generator)
+
+        if self.block_attrs:
+            attrs = dd.BlockAttrs(domain_attrs, domain_inds, dtype=self.torchfp, device=self.device)
+
+            x_item = attrs.item_inds()
+            x_context = attrs.context_inds()
+            if not self.index_inputs:
+                x_item = nn.functional.one_hot(x_item, self.n_items).to(self.torchfp)
+                x_context = nn.functional.one_hot(x_context, self.n_contexts).to(self.torchfp)
+
+            return x_item, x_context, attrs
+
+        item_mat, context_mat = dd.make_input_mats(self.ctx_per_domain, self.n_domains)
+        attr_mat = dd.make_attr_mat(domain_attrs, domain_inds)
 
         x_item = torch.tensor(item_mat, dtype=self.torchfp, device=self.device)
         x_context = torch.tensor(context_mat, dtype=self.torchfp, device=self.device)
         y = torch.tensor(attr_mat, dtype=self.torchfp, device=self.device)
 
+        if self.index_inputs:
+            x_item = torch.argmax(x_item, dim=1)
+            x_context = torch.argmax(x_context, dim=1)
+
         return x_item, x_context, y
 
     def __init__(self, ctx_per_domain, attrs_per_context, n_domains, attrs_set_per_item=25,
@@ -36,7 +103,9 @@ class DisjointDomainNet(nn.Module):
                  torchfp=None, device=None, merged_repr=False, use_item_repr=True,
                  use_ctx_repr=True, cluster_info='4-2-2', last_domain_cluster_info=None,
                  param_init_type='normal', param_init_scale=0.01, fix_biases=False,
-                 fixed_bias=-2, repeat_attrs_over_domains=False):
+                 fixed_bias=-2, repeat_attrs_over_domains=False, index_inputs=False, block_attrs=False,
+                 output_mode='full', n_off_block_samples=64, off_block_sampling='uniform', vectorized_attrs=False,
+                 dataset_cache=None, generator=None):
         super(DisjointDomainNet, self).__init__()
         
         assert (not merged_repr) or (use_item_repr and use_ctx_repr), "Can't both skip and merge repr layers"
@@ -54,16 +123,39 @@ class DisjointDomainNet(nn.Module):
         self.cluster_info = cluster_info
         self.last_domain_cluster_info = last_domain_cluster_info
         self.repeat_attrs_over_domains = repeat_attrs_over_domains
+        self.index_inputs = index_inputs
+        self.block_attrs = block_attrs
+        self.vectorized_attrs = vectorized_attrs
+        self.dataset_cache = dataset_cache
+        self.generator = generator
+        if output_mode not in ['full', 'exact', 'sampled']:
+            raise ValueError(f'Unrecognized output mode "{output_mode}"')
+        if off_block_sampling not in ['uniform', 'bias']:
+            raise ValueError(f'Unrecognized off-block sampling "{off_block_sampling}"')
+        self.output_mode = output_mode
+        self.n_off_block_samples = n_off_block_samples
+        self.off_block_sampling = off_block_sampling
         
-        self.dummy_item = torch.zeros((1, self.n_items))
-        self.dummy_ctx = torch.zeros((1, self.n_contexts))
-
-        if rng_seed is None:
-            torch.seed()
+        if generator is not None:
+            if param_init_type == 'default':
+                raise ValueError('Default parameter init draws from the global RNG, so can\'t be used with a generator')
+            if rng_seed is not None:
+                generator.manual_seed(rng_seed)
+            self.rng_seed = generator.initial_seed()
         else:
-            torch.manual_seed(rng_seed)
+            if rng_seed is None:
+                torch.seed()
+            else:
+                torch.manual_seed(rng_seed)
+            self.rng_seed = torch.initial_seed()  # (makes the same net again, e.g. to resume from a checkpoint)
 
-        self.device, self.torchfp = dd.init_torch(device, torchfp)
+        # (the dtype and device are passed to every tensor made, rather than set as process-wide defaults,
+        # so nets with different ones can be used at once)
+        self.device, self.torchfp = dd.init_torch(device, torchfp, set_default=False)
+        factory = {'dtype': self.torchfp, 'device': self.device}
+
+        self.dummy_item = torch.zeros((1, self.n_items), **factory)
+        self.dummy_ctx = torch.zeros((1, self.n_contexts), **factory)
 
         self.item_repr_size = item_repr_units
         self.ctx_repr_size = ctx_repr_units
@@ -84,49 +176,84 @@ class DisjointDomainNet(nn.Module):
         def make_bias(n_units):
             """Make bias for a layer, either a constant or trainable parameter"""
             if fix_biases:
-                return torch.full((n_units,), fixed_bias, device=device)
+                return torch.full((n_units,), fixed_bias, **factory)
             else:
-                return nn.Parameter(torch.empty((n_units,), device=device))
+                return nn.Parameter(torch.empty((n_units,), **factory))
         
+        def make_linear(n_in, n_out):
+            """Make a weight layer (left uninitialized with a generator, since it's initialized from it below)"""
+            if generator is None:
+                return nn.Linear(n_in, n_out, bias=False, **factory)
+            return nn.utils.skip_init(nn.Linear, n_in, n_out, bias=False, **factory)
+
         # define layers
-        self.item_to_rep = (nn.Linear(self.n_items, self.item_repr_size, bias=False).to(device)
+        self.item_to_rep = (make_linear(self.n_items, self.item_repr_size)
                             if self.use_item_repr else nn.Identity())
         self.item_rep_bias = (make_bias(self.item_repr_size)
-                              if self.use_item_repr else torch.zeros((self.n_items,)))
+                              if self.use_item_repr else torch.zeros((self.n_items,), **factory))
         
-        self.ctx_to_rep = (nn.Linear(self.n_contexts, self.ctx_repr_size, bias=False).to(device)
+        self.ctx_to_rep = (make_linear(self.n_contexts, self.ctx_repr_size)
                            if self.use_ctx_repr else nn.Identity())
         self.ctx_rep_bias = (make_bias(self.ctx_repr_size)
-                             if self.use_ctx_repr else torch.zeros((self.n_contexts,)))
+                             if self.use_ctx_repr else torch.zeros((self.n_contexts,), **factory))
         
-        self.rep_to_hidden = nn.Linear(self.repr_size, self.hidden_size, bias=False).to(device)
+        self.rep_to_hidden = make_linear(self.repr_size, self.hidden_size)
         self.hidden_bias = make_bias(self.hidden_size)
-        self.hidden_to_attr = nn.Linear(self.hidden_size, self.n_attributes, bias=False).to(device)
+        self.hidden_to_attr = make_linear(self.hidden_size, self.n_attributes)
         self.attr_bias = make_bias(self.n_attributes)
 
         # make weights start small
         if param_init_type != 'default':
             with torch.no_grad():
                 for p in self.parameters():
+                    # (a generator's values are drawn on its own device, then copied)
+                    vals = p.data if generator is None else torch.empty(p.shape, dtype=p.dtype, device=generator.device)
                     if param_init_type == 'normal':
-                        nn.init.normal_(p.data, std=param_init_scale)
+                        nn.init.normal_(vals, std=param_init_scale, generator=generator)
                     elif param_init_type == 'uniform':
-                        nn.init.uniform_(p.data, a=-param_init_scale, b=param_init_scale)
+                        nn.init.uniform_(vals, a=-param_init_scale, b=param_init_scale, generator=generator)
                     else:
                         raise ValueError('Unrecognized param init type')
+                    if generator is not None:
+                        p.copy_(vals)
+
+        if index_inputs:
+            # looking up a row of the weights is the same as multiplying by a one-hot vector
+            if self.use_item_repr:
+                self.item_to_rep = nn.Embedding.from_pretrained(self.item_to_rep.weight.detach().t().clone(),
+                                                                freeze=False, sparse=True)
+            if self.use_ctx_repr:
+                self.ctx_to_rep = nn.Embedding.from_pretrained(self.ctx_to_rep.weight.detach().t().clone(),
+                                                               freeze=False, sparse=True)
 
         # make some data
-        self.x_item, self.x_context, self.y = self.gen_training_tensors()
-        self.n_inputs = len(self.y)
+        if block_attrs:
+            self.x_item, self.x_context, self.attrs = self.gen_training_tensors()
+            self.y = None
+            self.wacc_weights = None
+        else:
+            self.x_item, self.x_context, self.y = self.gen_training_tensors()
+            self.attrs = None
+            self.wacc_weights = self.calc_wacc_weights(self.y)
+        self.n_inputs = len(self.x_item)
+        self.index = dd.DatasetIndex(n_domains, ctx_per_domain)  # rows of each item, context and domain
 
         # individual item/context tensors for evaluating the network
         self.items, self.item_names = dd.get_items(
             n_domains=n_domains, cluster_info=self.cluster_info,
-            last_domain_cluster_info=self.last_domain_cluster_info)
+            last_domain_cluster_info=self.last_domain_cluster_info, **factory)
         self.contexts, self.context_names = dd.get_contexts(
-            n_domains=n_domains, ctx_per_domain=ctx_per_domain)
+            n_domains=n_domains, ctx_per_domain=ctx_per_domain, **factory)
+        if index_inputs:
+            self.items = torch.arange(self.n_items, device=self.device)
+            self.contexts = torch.arange(self.n_contexts, device=self.device)
 
         self.criterion = nn.BCELoss(reduction='sum')
+        self._batch_loss = None  # compiled version of batch_loss, if requested
+        
+        # off-block attributes are sampled with a separate generator so the shuffling order doesn't change
+        self.sample_generator = torch.Generator(device=self.device).manual_seed(self.rng_seed)
+        self._saved_params = {}  # buffers for saving parameters during generalize_test
 
     def calc_item_repr(self, item):
         assert self.use_item_repr, 'No item representation to calculate'
@@ -136,7 +263,28 @@ class DisjointDomainNet(nn.Module):
         assert self.use_ctx_repr, 'No context representation to calculate'
         return torch.sigmoid(self.ctx_to_rep(context) + self.ctx_rep_bias)
 
+    def _index_input_to_rep(self, layer, inds, n_inputs, n_rows):
+        """
+        Equivalent of applying an input layer to one-hot inputs, for index inputs.
+        If inds is None, the input is all zeros.
+        """
+        if isinstance(layer, nn.Identity):
+            one_hot = torch.zeros((n_rows, n_inputs), dtype=self.torchfp, device=self.device)
+            if inds is not None:
+                one_hot[torch.arange(n_rows, device=self.device), inds] = 1
+            return one_hot
+
+        if inds is None:
+            return torch.zeros((n_rows, layer.embedding_dim), dtype=self.torchfp, device=self.device)
+        return layer(inds)
+
     def calc_hidden(self, item=None, context=None):
+        if self.index_inputs:
+            n_rows = len(item) if item is not None else len(context) if context is not None else 1
+            irep = self._index_input_to_rep(self.item_to_rep, item, self.n_items, n_rows) + self.item_rep_bias
+            crep = self._index_input_to_rep(self.ctx_to_rep, context, self.n_contexts, n_rows) + self.ctx_rep_bias
+            return self._hidden_from_rep(irep, crep)
+
         if item is None:
             item = self.dummy_item.repeat((context.shape[0] if context is not None else 1), 1)
         if context is None:
@@ -144,7 +292,10 @@ class DisjointDomainNet(nn.Module):
             
         irep = self.item_to_rep(item) + self.item_rep_bias
         crep = self.ctx_to_rep(context) + self.ctx_rep_bias
+        return self._hidden_from_rep(irep, crep)
 
+    def _hidden_from_rep(self, irep, crep):
+        """Hidden layer activity given the item and context representation layer inputs"""
         if self.merged_repr:
             rep = irep + crep
         else:
@@ -157,14 +308,45 @@ class DisjointDomainNet(nn.Module):
         attr = torch.sigmoid(self.hidden_to_attr(hidden) + self.attr_bias)
         return attr
 
+    @staticmethod
+    def outputs_correct(outputs, y):
+        """Element-wise function to find which outputs are correct, given the targets"""
+        return torch.lt(torch.abs(outputs - y), 0.1).to(outputs.dtype)
+
+    def get_y(self, inds=None):
+        """Rows of the attribute matrix for the given inputs (all inputs if inds is None)"""
+        if self.attrs is not None:
+            return self.attrs.gather(inds)
+        return self.y if inds is None else self.y[inds]
+
+    def get_y_blocks(self, inds):
+        """
+        For the given inputs, each one's block of attrs_per_context targets (the rest are all 0)
+        and the attribute index where it starts
+        """
+        if self.attrs is not None:
+            return self.attrs.gather_blocks(inds)
+
+        # inputs are ordered by context (see dd.BlockAttrs)
+        inds = torch.as_tensor(inds, dtype=torch.long, device=self.device)
+        col_starts = inds // dd.ITEMS_PER_DOMAIN * self.attrs_per_context
+        cols = col_starts[:, np.newaxis] + torch.arange(self.attrs_per_context, device=self.device)
+        return torch.gather(self.y[inds], 1, cols), col_starts
+
+    def get_wacc_weights(self, inds):
+        """Weighted accuracy weights (see calc_wacc_weights) for the given inputs"""
+        if self.wacc_weights is None:
+            return self.calc_wacc_weights(self.get_y(inds))
+        return self.wacc_weights[inds]
+
     def b_outputs_correct(self, outputs, batch_inds):
         """Element-wise function to find which outputs are correct for a batch"""
-        return torch.lt(torch.abs(outputs - self.y[batch_inds]), 0.1).to(self.torchfp)
-    
-    def weighted_acc(self, outputs, batch_inds):
+        return self.outputs_correct(outputs, self.get_y(batch_inds))
+
+    def calc_wacc_weights(self, y):
         """
-        For each item in the batch, find the average of accuracy for 0s and accuracy for 1s
-        (i.e. correct for unbalanced ground truth output)
+        Weights of each output for the weighted accuracy, such that the 1s and 0s of each input
+        (last axis is attributes) contribute equally
         """
         total_attrs = self.attrs_per_context * self.n_contexts
         set_attrs = 25
@@ -173,36 +355,208 @@ class DisjointDomainNet(nn.Module):
         set_weight = 0.5 / set_attrs
         unset_weight = 0.5 / unset_attrs
         
-        weights = torch.where(self.y[batch_inds].to(bool), set_weight, unset_weight)
-        b_correct = self.b_outputs_correct(outputs, batch_inds)
-        return torch.sum(weights * b_correct, dim=1)
+        return torch.where(y.to(bool), set_weight, unset_weight).to(y.dtype)
+
+    def weighted_acc_for_targets(self, outputs, y, weights=None):
+        """
+        For each input (last axis is attributes), find the average of accuracy for 0s and accuracy for 1s
+        (i.e. correct for unbalanced ground truth output)
+        """
+        if weights is None:
+            weights = self.calc_wacc_weights(y)
+        b_correct = self.outputs_correct(outputs, y)
+        return torch.sum(weights * b_correct, dim=-1)
+
+    def weighted_acc(self, outputs, batch_inds):
+        """
+        For each item in the batch, find the average of accuracy for 0s and accuracy for 1s
+        (i.e. correct for unbalanced ground truth output)
+        """
+        return self.weighted_acc_for_targets(outputs, self.get_y(batch_inds), self.get_wacc_weights(batch_inds))
+
+    def batch_loss(self, x_item, x_context, y):
+        """
+        Outputs and (summed) loss for one batch of inputs.
+        Unless output_mode is 'full', y is a tuple of target blocks and where they start (from get_y_blocks),
+        and outputs are None in 'sampled' mode.
+        """
+        if self.output_mode != 'full':
+            return self.block_batch_loss(x_item, x_context, *y)
+
+        outputs = self(x_item, x_context)
+        return self.criterion(outputs, y), outputs
+
+    def off_block_probs(self):
+        """Probability of sampling each attribute as an off-block attribute in 'sampled' output mode"""
+        if self.off_block_sampling == 'uniform':
+            return torch.full((self.n_attributes,), 1 / self.n_attributes, dtype=self.torchfp, device=self.device)
+
+        # sample attributes in proportion to their loss when the hidden layer contributes nothing
+        weights = nn.functional.softplus(self.attr_bias.detach())
+        return weights / torch.sum(weights)
+
+    def block_batch_loss(self, x_item, x_context, block_targets, col_starts):
+        """Loss for one batch in the 'exact' and 'sampled' output modes (see class docstring)"""
+        hidden = self.calc_hidden(x_item, x_context)
+        block_cols = col_starts[:, np.newaxis] + torch.arange(self.attrs_per_context, device=col_starts.device)
+
+        if self.output_mode == 'exact':
+            # BCE(sigmoid(z), y) = softplus(z) - y * z (still over all attributes - this mode is for reference)
+            logits = self.hidden_to_attr(hidden) + self.attr_bias
+            block_logits = torch.gather(logits, 1, block_cols)
+            loss = torch.sum(nn.functional.softplus(logits)) - torch.sum(block_targets * block_logits)
+            return loss, torch.sigmoid(logits)
+
+        weight = self.hidden_to_attr.weight
+        block_logits = torch.einsum('bh,bah->ba', hidden, weight[block_cols]) + self.attr_bias[block_cols]
+        block_loss = torch.sum(nn.functional.softplus(block_logits) - block_targets * block_logits)
+
+        # sample attributes for the whole batch and ignore the ones in each input's own block
+        probs = self.off_block_probs()
+        cols = torch.multinomial(probs, self.n_off_block_samples, replacement=True, generator=self.sample_generator)
+        sample_logits = hidden @ weight[cols].T + self.attr_bias[cols]
+        b_off_block = ((cols[np.newaxis, :] < col_starts[:, np.newaxis]) |
+                       (cols[np.newaxis, :] >= col_starts[:, np.newaxis] + self.attrs_per_context))
+        sample_weights = b_off_block / (self.n_off_block_samples * probs[cols])
+        off_block_loss = torch.sum(sample_weights * nn.functional.softplus(sample_logits))
+
+        return block_loss + off_block_loss, None
 
-    def train_epoch(self, order, batch_size, optimizer):
+    def compile_training(self):
+        """Compile the per-batch forward pass and loss with torch.compile (used by train_epoch from then on)"""
+        self._batch_loss = torch.compile(self.batch_loss)
+
+    def train_epoch(self, order, batch_size, optimizer, calc_acc=True):
         """
         Do training on batches of given size of the examples indexed by order.
         Return the total loss and output accuracy for each example (in index order).
         Accuracy for any example that is not used will be nan.
+        If calc_acc is False, accuracy is not calculated and None is returned for both accuracies.
         """
-        total_loss = torch.tensor(0.0)
-        acc_each = torch.full((self.n_inputs,), np.nan)
-        wacc_each = torch.full((self.n_inputs,), np.nan)
         if type(order) != torch.Tensor:
             order = torch.tensor(order, device='cpu', dtype=torch.long)
+        n_batch = len(order)
+        batch_size = batch_size if batch_size > 0 else n_batch
+        batch_loss = self._batch_loss if self._batch_loss is not None else self.batch_loss
+
+        # put the whole epoch's examples in order up front, so each batch is a contiguous slice
+        # (except for block attrs and target blocks, which are gathered one batch at a time)
+        x_item = self.x_item[order]
+        x_context = self.x_context[order]
+        y = self.y[order] if self.attrs is None and self.output_mode == 'full' else None
+
+        total_loss = torch.tensor(0.0, dtype=self.torchfp, device=self.device)
+        outputs_all = torch.empty_like(y) if calc_acc and y is not None else None
+        if calc_acc:
+            acc_each = torch.full((self.n_inputs,), np.nan, dtype=self.torchfp, device=self.device)
+            wacc_each = torch.full((self.n_inputs,), np.nan, dtype=self.torchfp, device=self.device)
         
-        for batch_inds in torch.split(order, batch_size) if batch_size > 0 else [order]:
+        for start in range(0, n_batch, batch_size):
+            batch = slice(start, start + batch_size)
+            if y is not None:
+                targets = y[batch]
+            elif self.output_mode == 'full':
+                targets = self.get_y(order[batch])
+            else:
+                targets = self.get_y_blocks(order[batch])
+
             optimizer.zero_grad()
-            outputs = self(self.x_item[batch_inds], self.x_context[batch_inds])
-            loss = self.criterion(outputs, self.y[batch_inds])
+            loss, outputs = batch_loss(x_item[batch], x_context[batch], targets)
+            if calc_acc and outputs is None:
+                with torch.no_grad():
+                    outputs = self(x_item[batch], x_context[batch])
             loss.backward()
             optimizer.step()
 
             with torch.no_grad():
                 total_loss += loss
-                acc_each[batch_inds] = torch.mean(self.b_outputs_correct(outputs, batch_inds), dim=1)
-                wacc_each[batch_inds] = self.weighted_acc(outputs, batch_inds)
+                if calc_acc and y is not None:
+                    outputs_all[batch] = outputs
+                elif calc_acc:
+                    y_batch = targets if self.output_mode == 'full' else self.get_y(order[batch])
+                    acc_each[order[batch]] = torch.mean(self.outputs_correct(outputs, y_batch), dim=1)
+                    wacc_each[order[batch]] = self.weighted_acc_for_targets(outputs, y_batch)
+
+        if not calc_acc:
+            return total_loss, None, None
+
+        if y is not None:
+            with torch.no_grad():
+                acc_each[order] = torch.mean(self.outputs_correct(outputs_all, y), dim=1)
+                wacc_each[order] = self.weighted_acc_for_targets(outputs_all, y, self.wacc_weights[order])
 
         return total_loss, acc_each, wacc_each
 
+    def inputs_match(self, x, value):
+        """Find which rows of x (x_item or x_context) are the given item or context"""
+        if self.index_inputs:
+            return x.eq(value)
+        return x.eq(value).all(axis=1)
+
+    def named_snapshot_parameters(self):
+        """
+        Like named_parameters, but embedding weights (for index inputs) are transposed so that
+        parameter snapshots have the same layout as with one-hot inputs.
+        """
+        for pname, p in self.named_parameters():
+            module_name = pname.rpartition('.')[0]
+            if module_name and isinstance(self.get_submodule(module_name), nn.Embedding):
+                yield pname, p.t()
+            else:
+                yield pname, p
+
+    @staticmethod
+    def parse_holdout_testing(holdout_testing):
+        """
+        Normalize the holdout_testing argument of do_training.
+        Returns it along with whether to do holdout testing at all and whether to hold out an item and a context.
+        """
+        if holdout_testing is not None:
+            holdout_testing = holdout_testing.lower()
+        do_holdout_testing = holdout_testing is not None and holdout_testing != 'none'
+        holdout_item = holdout_testing in ['full', 'item']
+        holdout_ctx = holdout_testing in ['full', 'context', 'ctx']
+        return holdout_testing, do_holdout_testing, holdout_item, holdout_ctx
+
+    def prepare_splits(self, holdout_testing='none', do_combo_testing=False):
+        """
+        Choose which items, contexts and inputs are used for training and which are held out
+        for testing, as specified by the holdout_testing and do_combo_testing arguments of do_training.
+        Returns a dict of index tensors - entries that don't apply to this kind of testing are None.
+        """
+        holdout_testing, do_holdout_testing, holdout_item, holdout_ctx = self.parse_holdout_testing(holdout_testing)
+
+        if do_holdout_testing and do_combo_testing:
+            raise NotImplementedError("That's too much, man - I'm not doing both holdout and combo testing!")
+
+        split = {
+            'train_item_inds': torch.arange(self.n_items, device='cpu'),
+            'train_ctx_inds': torch.arange(self.n_contexts, device='cpu'),
+            'train_x_inds': self.index.rows(),
+            'test_x_item_inds': None,  # for holdout testing
+            'test_x_ctx_inds': None,
+            'included_inds_item': None,
+            'included_inds_ctx': None,
+            'test_x_inds': None  # for domain holdout and combo testing
+        }
+
+        if do_holdout_testing:
+            if holdout_testing == 'domain':
+                (split['train_item_inds'], split['train_ctx_inds'],
+                 split['train_x_inds'], split['test_x_inds']) = self.prepare_domain_holdout()
+            else:
+                (split['train_item_inds'], split['train_ctx_inds'], split['train_x_inds'],
+                 split['test_x_item_inds'], split['test_x_ctx_inds']) = self.prepare_holdout(holdout_item, holdout_ctx)
+
+                # which indices to use during testing
+                split['included_inds_item'] = torch.cat([split['train_x_inds'], split['test_x_item_inds']])
+                split['included_inds_ctx'] = torch.cat([split['train_x_inds'], split['test_x_ctx_inds']])
+
+        elif do_combo_testing:
+            split['train_x_inds'], split['test_x_inds'] = self.prepare_combo_testing()
+
+        return split
+
     def prepare_holdout(self, holdout_item=True, holdout_context=True):
         """
         Pick an item and context to hold out during regular training. Then, at each epoch,
@@ -211,38 +565,35 @@ class DisjointDomainNet(nn.Module):
 
         Returns vectors of indices into items, contexts, and x/y that will still be used. 
         """
-        ho_item_domain, ho_ctx_domain = dd.choose_k_inds(self.n_domains, 2)
-        ho_item_ind = ho_item_domain * dd.ITEMS_PER_DOMAIN + dd.choose_k_inds(dd.ITEMS_PER_DOMAIN, 1)
+        gen = self.generator
+        ho_item_domain, ho_ctx_domain = dd.choose_k_inds(self.n_domains, 2, generator=gen)
+        ho_item_ind = ho_item_domain * dd.ITEMS_PER_DOMAIN + dd.choose_k_inds(dd.ITEMS_PER_DOMAIN, 1, generator=gen)
         if holdout_item:
             print(f'Holding out item: {self.item_names[ho_item_ind]}')
-        ho_ctx_ind = ho_ctx_domain * self.ctx_per_domain + dd.choose_k_inds(self.ctx_per_domain, 1)
+        ho_ctx_ind = ho_ctx_domain * self.ctx_per_domain + dd.choose_k_inds(self.ctx_per_domain, 1, generator=gen)
         if holdout_context:
             print(f'Holding out context: {self.context_names[ho_ctx_ind]}')
 
-        train_item_inds = np.setdiff1d(range(self.n_items), ho_item_ind) if holdout_item else np.arange(self.n_items)
-        train_ctx_inds = np.setdiff1d(range(self.n_contexts), ho_ctx_ind) if holdout_context else np.arange(self.n_contexts)
+        no_inds = torch.zeros(0, dtype=torch.long, device='cpu')
+        ho_items = ho_item_ind if holdout_item else no_inds
+        ho_contexts = ho_ctx_ind if holdout_context else no_inds
+        train_item_inds = self.index.complement(ho_items, n=self.n_items)
+        train_ctx_inds = self.index.complement(ho_contexts, n=self.n_contexts)
 
         # figure out which inputs are held out (item/context combinations)
-        ho_item = self.items[ho_item_ind]
-        ho_context = self.contexts[ho_ctx_ind]
-        b_x_item_ho = self.x_item.eq(ho_item).all(axis=1).cpu()
-        b_x_ctx_ho = self.x_context.eq(ho_context).all(axis=1).cpu()
-        test_x_item_inds = torch.flatten(torch.nonzero(b_x_item_ho)) if holdout_item else []
-        test_x_ctx_inds = torch.flatten(torch.nonzero(b_x_ctx_ho)) if holdout_context else []
-        
-        # prepare array of which items to use during training
-        train_x_inds = np.setdiff1d(np.arange(self.n_inputs), np.concatenate([test_x_item_inds, test_x_ctx_inds]))
+        test_x_item_inds = self.index.item_rows(ho_items)
+        test_x_ctx_inds = self.index.context_rows(ho_contexts)
+        train_x_inds = self.index.complement(test_x_item_inds, test_x_ctx_inds)
 
         return train_item_inds, train_ctx_inds, train_x_inds, test_x_item_inds, test_x_ctx_inds
     
     def prepare_domain_holdout(self):
         """Similar to prepare_holdout, but just hold out the last domain"""
         print(f'Holding out domain {dd.domain_name(self.n_domains-1)}')
-        train_item_inds = np.arange(self.n_items - dd.ITEMS_PER_DOMAIN)
-        train_ctx_inds = np.arange(self.n_contexts - self.ctx_per_domain)
-        train_x_inds = np.arange(self.n_inputs - dd.ITEMS_PER_DOMAIN * self.ctx_per_domain)
-        test_x_inds = np.arange(len(train_x_inds), self.n_inputs)
-        
+        train_item_inds = torch.arange(self.n_items - dd.ITEMS_PER_DOMAIN, device='cpu')
+        train_ctx_inds = torch.arange(self.n_contexts - self.ctx_per_domain, device='cpu')
+        train_x_inds, test_x_inds = self.index.domain_split(self.n_domains - 1)
+
         return train_item_inds, train_ctx_inds, train_x_inds, test_x_inds
     
     def prepare_combo_testing(self):
@@ -252,85 +603,280 @@ class DisjointDomainNet(nn.Module):
         """
         item_domain_starts = torch.arange(self.n_domains, device='cpu') * dd.ITEMS_PER_DOMAIN
         ctx_domain_starts = torch.arange(self.n_domains, device='cpu') * self.ctx_per_domain
-        ho_items = item_domain_starts + dd.choose_k_inds(dd.ITEMS_PER_DOMAIN, self.n_domains)
-        ho_contexts = ctx_domain_starts + dd.choose_k_inds(self.ctx_per_domain, self.n_domains)
+        gen = self.generator
+        ho_items = item_domain_starts + dd.choose_k_inds(dd.ITEMS_PER_DOMAIN, self.n_domains, generator=gen)
+        ho_contexts = ctx_domain_starts + dd.choose_k_inds(self.ctx_per_domain, self.n_domains, generator=gen)
         print('Holding out: ' + ', '.join(
             [f'{self.item_names[ii]}/{self.context_names[ci]}' for ii, ci in zip(ho_items, ho_contexts)]
         ))
-        
-        train_x_inds = np.arange(self.n_inputs)
-        test_x_inds = np.zeros(self.n_domains)
-        
-        # Find indices of held out combos in full input arrays
-        for k_domain in range(self.n_domains):
-            b_x_item_ho = self.x_item.eq(self.items[ho_items[k_domain]]).all(axis=1).cpu()
-            b_x_ctx_ho = self.x_context.eq(self.contexts[ho_contexts[k_domain]]).all(axis=1).cpu()
-            b_x_ho = b_x_item_ho & b_x_ctx_ho
-            
-            assert torch.sum(b_x_ho) == 1, 'Uh-oh'            
-            ind = torch.flatten(torch.nonzero(b_x_ho))[0]
-            train_x_inds = np.setdiff1d(train_x_inds, ind)
-            test_x_inds[k_domain] = ind
 
-        return train_x_inds, test_x_inds
+        return self.index.combo_split(ho_items, ho_contexts)
             
-    def prepare_snapshots(self, snap_freq, snap_freq_scale, num_epochs):
-        """Make tensors to hold representation snapshots and return some relevant info"""
+    def snapshot_shapes(self, n_snaps, param_snapshots=False):
+        """
+        Shapes of the arrays that hold each type of snapshot, as a dict of groups
+        ('snaps' for representations and 'params' for parameters, if param_snapshots is true)
+        """
+        shapes = {'snaps': {}}
+        if self.use_item_repr:
+            shapes['snaps']['item'] = (n_snaps, self.n_items, self.item_repr_size)
+        if self.use_ctx_repr:
+            shapes['snaps']['context'] = (n_snaps, self.n_contexts, self.ctx_repr_size)
+
+        shapes['snaps']['item_hidden'] = (n_snaps, self.n_items, self.hidden_size)
+        shapes['snaps']['context_hidden'] = (n_snaps, self.n_contexts, self.hidden_size)
+
+        if param_snapshots:
+            shapes['params'] = {pname: (n_snaps, *p.shape) for pname, p in self.named_snapshot_parameters()}
+
+        return shapes
+
+    def prepare_snapshots(self, snap_freq, snap_freq_scale, num_epochs, param_snapshots=False, sink=None):
+        """
+        Allocate space for snapshots in the given sink (by default, an InMemorySnapshotSink)
+        and return some relevant info along with the sink.
+        """
 
         # Find exactly which epochs to take snapshots (could be on log scale)
         snap_epochs = dd.calc_snap_epochs(snap_freq, snap_freq_scale, num_epochs)
 
         epoch_digits = len(str(snap_epochs[-1]))
         n_snaps = len(snap_epochs)
+
+        if sink is None:
+            sink = InMemorySnapshotSink()
+
+        for group, shapes in self.snapshot_shapes(n_snaps, param_snapshots).items():
+            for name, shape in shapes.items():
+                sink.allocate(group, name, shape, dtype=self.torchfp, device=self.device)
         
-        snaps = {}
-        if self.use_item_repr:
-            snaps['item'] = torch.full((n_snaps, self.n_items, self.item_repr_size), np.nan)
-        if self.use_ctx_repr:
-            snaps['context'] = torch.full((n_snaps, self.n_contexts, self.ctx_repr_size), np.nan)
+        return snap_epochs, epoch_digits, sink
+
 
-        snaps['item_hidden'] = torch.full((n_snaps, self.n_items, self.hidden_size), np.nan)
-        snaps['context_hidden'] = torch.full((n_snaps, self.n_contexts, self.hidden_size), np.nan)
+    @staticmethod
+    def prepare_reports(num_epochs, report_freq, reports_per_test=1, holdout_testing='none', do_combo_testing=False):
+        """Make arrays to hold training reports (loss, accuracy, test results) for each report epoch"""
+        holdout_testing, _, holdout_item, holdout_ctx = DisjointDomainNet.parse_holdout_testing(holdout_testing)
+
+        n_report = (num_epochs-1) // report_freq + 1
+        n_etg = (n_report-1) // reports_per_test + 1
+        reports = dict()
+        reports['loss'] = np.zeros(n_report)
+        reports['accuracy'] = np.zeros(n_report)
+        reports['weighted_acc'] = np.zeros(n_report)
         
-        return snap_epochs, epoch_digits, snaps
+        if holdout_item:
+            reports['etg_item'] = np.zeros(n_etg, dtype=int) # "epochs to generalize"
+            
+        if holdout_ctx:
+            reports['etg_context'] = np.zeros(n_etg, dtype=int)
+            
+        if holdout_testing == 'domain':
+            reports['etg_domain'] = np.zeros(n_etg, dtype=int)
+        
+        if do_combo_testing:
+            reports['test_accuracy'] = np.zeros(n_report)
+            reports['test_weighted_acc'] = np.zeros(n_report)
+
+        return reports
+
+    def make_train_checkpoint(self, epoch, run_args, split, optimizer, scheduler, reports, snap_sink):
+        """
+        Copy everything needed to continue do_training from the start of the given epoch,
+        to be saved with dd_checkpoint.save_checkpoint (or a CheckpointWriter).
+        """
+        return {
+            'epoch': epoch,
+            'rng_seed': self.rng_seed,
+            'run_args': run_args,
+            'split': split,
+            'params': {pname: p.detach().cpu().clone() for pname, p in self.state_dict().items()},
+            'optimizer': deepcopy(optimizer.state_dict()),
+            'scheduler': None if scheduler is None else deepcopy(scheduler.state_dict()),
+            'rng_state': get_rng_state(self.device),
+            'sample_generator': self.sample_generator.get_state(),
+            'generator': None if self.generator is None else self.generator.get_state(),
+            'reports': {rtype: r.copy() for rtype, r in reports.items()},
+            'snapshots': snap_sink.checkpoint_state()
+        }
+
+    def load_train_checkpoint(self, checkpoint, optimizer, scheduler, reports, snap_sink):
+        """Restore the training state saved by make_train_checkpoint. Returns the epoch to continue from."""
+        self.load_state_dict(checkpoint['params'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if scheduler is not None:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        set_rng_state(checkpoint['rng_state'])
+        self.sample_generator.set_state(checkpoint['sample_generator'])
+        if self.generator is not None:
+            self.generator.set_state(checkpoint['generator'])
+
+        for rtype, r in checkpoint['reports'].items():
+            reports[rtype][:] = r
+        snap_sink.load_checkpoint_state(checkpoint['snapshots'])
+
+        return checkpoint['epoch']
+
+    def save_train_state(self, optimizer, slot='test'):
+        """
+        Save the parameters (into buffers that are allocated once per slot and then reused) and optimizer
+        state, to be restored by restore_train_state. Each slot holds one saved state at a time.
+        """
+        with torch.no_grad():
+            if slot not in self._saved_params:
+                self._saved_params[slot] = [p.detach().clone() for p in self.parameters()]
+            else:
+                for buf, p in zip(self._saved_params[slot], self.parameters()):
+                    buf.copy_(p)
+
+        # hyperparameters and per-parameter state (empty for plain SGD)
+        groups = [{key: val for key, val in group.items() if key != 'params'} for group in optimizer.param_groups]
+        state = {p: deepcopy(p_state) for p, p_state in optimizer.state.items()}
+        return groups, state
 
+    def restore_train_state(self, optimizer, saved_state, slot='test'):
+        """Put back parameters and optimizer state saved by save_train_state"""
+        with torch.no_grad():
+            for buf, p in zip(self._saved_params[slot], self.parameters()):
+                p.copy_(buf)
 
-    def generalize_test(self, batch_size, optimizer, included_inds, targets, max_epochs=2000, thresh=0.99):
+        groups, state = saved_state
+        for group, saved_group in zip(optimizer.param_groups, groups):
+            group.update(saved_group)
+        optimizer.state.clear()
+        optimizer.state.update(state)
+
+    def targets_wacc(self, target_inds):
+        """Mean weighted accuracy of the current network on the given inputs (no training)"""
+        with torch.no_grad():
+            outputs = self(self.x_item[target_inds], self.x_context[target_inds])
+            return torch.mean(self.weighted_acc(outputs, target_inds)).item()
+
+    def train_until(self, order, batch_size, optimizer, target_inds, thresh, check_every=None):
+        """
+        Train on the examples indexed by order (as in train_epoch), checking accuracy on the target inputs
+        after every check_every batches (or only at the end, if it is None). Stops as soon as it reaches thresh.
+        Returns whether it did.
+        """
+        if check_every is None or batch_size <= 0:
+            chunk_size = len(order)
+        else:
+            chunk_size = check_every * batch_size
+
+        for start in range(0, len(order), chunk_size):
+            self.train_epoch(order[start:start + chunk_size], batch_size, optimizer, calc_acc=False)
+            if self.targets_wacc(target_inds) >= thresh:
+                return True
+        return False
+
+    def search_etg(self, batch_size, optimizer, included_inds, target_inds, max_epochs, thresh, generator=None):
+        """
+        Find the number of epochs of training needed to reach thresh on the target inputs by checking
+        after 1, 2, 4, 8... epochs and then doing a binary search between the last two checks, going back
+        to a saved state and replaying the recorded training orders. Assumes that once the threshold is
+        reached, it stays reached. Returns the same count as generalize_test (max_epochs if never reached).
+        Leaves the network in an arbitrary trained state.
+        """
+        orders = []
+
+        def train_to(n_from, n_to):
+            while len(orders) < n_to:
+                orders.append(dd.choose_k(included_inds, len(included_inds), generator=generator))
+            for order in orders[n_from:n_to]:
+                self.train_epoch(order, batch_size, optimizer, calc_acc=False)
+            return self.targets_wacc(target_inds) >= thresh
+
+        # at least one epoch is always trained, so 0 epochs counts as below threshold
+        lo, hi = 0, None
+        lo_state = self.save_train_state(optimizer, slot='search')
+        while lo < max_epochs:
+            n_next = min(max(2 * lo, 1), max_epochs)
+            if train_to(lo, n_next):
+                hi = n_next
+                break
+            lo = n_next
+            lo_state = self.save_train_state(optimizer, slot='search')
+
+        if hi is None:
+            return max_epochs
+
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            self.restore_train_state(optimizer, lo_state, slot='search')
+            if train_to(lo, mid):
+                hi = mid
+            else:
+                lo = mid
+                lo_state = self.save_train_state(optimizer, slot='search')
+
+        return hi - 1
+
+    def generalize_test(self, batch_size, optimizer, included_inds, targets, max_epochs=2000, thresh=0.99,
+                        generator=None, restore_state=True, mode='train', check_every=None):
         """
         See how long it takes the network to reach accuracy threshold on target inputs,
-        when training on items specified by included_inds. Then restore the parameters.
+        when training on items specified by included_inds. Then restore the parameters
+        (unless restore_state is False).
         
         'targets' can be an array of indices or a logical mask into the full set of inputs.
+        Training orders are drawn from generator (default: the net's own generator, or the global RNG).
+        
+        mode determines how accuracy on the targets is checked:
+        'train' - use the outputs for the targets during each epoch of training (so targets must be
+                  among the included inputs)
+        'eval' - after each epoch, or after every check_every batches, do a forward pass on just the targets,
+                 and stop as soon as the threshold is reached
+        'search' - as for 'eval', but only check at some epoch counts (see search_etg)
+        'eval' and 'search' measure accuracy after parameter updates rather than during the epoch, so they
+        can give (slightly) lower epoch counts than 'train'.
         """
+        if mode not in ['train', 'eval', 'search']:
+            raise ValueError(f'Unrecognized generalize test mode "{mode}"')
+        if generator is None:
+            generator = self.generator
 
         # Save original state of network to restore later
-        net_state_dict = deepcopy(self.state_dict())
-        optim_state_dict = deepcopy(optimizer.state_dict())
+        if restore_state:
+            saved_state = self.save_train_state(optimizer)
 
-        epochs = 0
-        while epochs < max_epochs:
-            order = dd.choose_k(included_inds, len(included_inds))
-            _, _, wacc_each = self.train_epoch(order, batch_size, optimizer)
+        target_inds = self.index.rows(targets)
 
-            acc_targets = torch.mean(wacc_each[targets])
-            if acc_targets >= thresh:
-                break
+        if mode == 'search':
+            epochs = self.search_etg(batch_size, optimizer, included_inds, target_inds,
+                                     max_epochs, thresh, generator=generator)
+        else:
+            epochs = 0
+            while epochs < max_epochs:
+                order = dd.choose_k(included_inds, len(included_inds), generator=generator)
 
-            epochs += 1
+                if mode == 'eval':
+                    if self.train_until(order, batch_size, optimizer, target_inds, thresh, check_every):
+                        break
+                else:
+                    _, _, wacc_each = self.train_epoch(order, batch_size, optimizer)
+                    acc_targets = torch.mean(wacc_each[target_inds])
+                    if acc_targets >= thresh:
+                        break
+
+                epochs += 1
 
         # Restore old state of network
-        self.load_state_dict(net_state_dict)
-        optimizer.load_state_dict(optim_state_dict)
+        if restore_state:
+            self.restore_train_state(optimizer, saved_state)
 
-        etg_string = '= ' + str(epochs + 1) if epochs < max_epochs else '> ' + str(max_epochs)
-        return epochs, etg_string
+        return epochs, self.etg_string(epochs, max_epochs)
 
+    @staticmethod
+    def etg_string(epochs, max_epochs):
+        """How to print the result of generalize_test"""
+        return '= ' + str(epochs + 1) if epochs < max_epochs else '> ' + str(max_epochs)
 
     def do_training(self, lr, num_epochs, batch_size, report_freq,
                     snap_freq, snap_freq_scale='lin', scheduler=None,
                     holdout_testing='full', reports_per_test=1,
-                    test_thresh=0.99, test_max_epochs=2000,
-                    do_combo_testing=False, param_snapshots=False):
+                    test_thresh=0.99, test_max_epochs=2000, test_mode='train', test_check_every=None,
+                    do_combo_testing=False, param_snapshots=False, compile_step=False, snap_sink=None,
+                    metrics=None, checkpoint_path=None, checkpoint_freq=1000):
         """
         Train the network for the specified number of epochs, etc.
         Return representation snapshots, training reports, and snapshot/report epochs.
@@ -341,45 +887,68 @@ class DisjointDomainNet(nn.Module):
         periodically (every `reports_per_test` reports) test how many epochs are needed
         to train network up to obtaining test_thresh accuracy on the held out inputs.
         If holdout_testing is 'domain', hold out and test on the last domain.
+        test_mode and test_check_every choose how accuracy is checked in these tests (see generalize_test).
         
         Combo testing: For each domain, hold out one item/context pair. At each report time,
         test the accuracy of the network on the held-out items and contexts.
         
         If param snapshots is true, also returns all weights and biases of the network at
         each snapshot epoch.
-        """
         
-        optimizer = torch.optim.SGD(self.parameters(), lr=lr)
+        If compile_step is true, the forward pass and loss of each batch are compiled with torch.compile.
         
-        if holdout_testing is not None:
-            holdout_testing = holdout_testing.lower()
-        do_holdout_testing = holdout_testing is not None and holdout_testing != 'none'
-        holdout_item = holdout_testing in ['full', 'item']
-        holdout_ctx = holdout_testing in ['full', 'context', 'ctx']
+        snap_sink determines where snapshots are stored as they are taken - by default, they are kept in
+        memory, but e.g. a dd_snapshots.MemmapSnapshotSink streams them to disk instead.
         
-        if do_holdout_testing and do_combo_testing:
-            raise NotImplementedError("That's too much, man - I'm not doing both holdout and combo testing!")
+        metrics can be a dd_metrics.TrainMetrics to record the time spent in each phase of training
+        (snapshots, training, reports, generalization tests etc.) to a JSON lines file.
         
-        train_item_inds = np.arange(self.n_items)
-        train_ctx_inds = np.arange(self.n_contexts)
-        train_x_inds = np.arange(self.n_inputs)
-        test_x_item_inds = test_x_ctx_inds = None # for holdout testing
-        included_inds_item = included_inds_ctx = None # for holdout testing
-        test_x_inds = None # for combo testing
+        If checkpoint_path is given, the training state (parameters, optimizer and scheduler state, random
+        number generator state, the holdout split, and reports and snapshots so far) is saved there every
+        checkpoint_freq epochs and at the end of training. Checkpoints are written in a background thread.
+        If a checkpoint already exists at checkpoint_path, training resumes from it and continues exactly
+        as the interrupted run would have. This requires a network made with the same parameters and seed
+        (net.rng_seed) as the checkpointed one and the same training arguments (and, with a MemmapSnapshotSink,
+        the same directory with resume=True).
+        """
+        if metrics is None:
+            metrics = NO_METRICS
         
-        if do_holdout_testing:
-            if holdout_testing == 'domain':
-                train_item_inds, train_ctx_inds, train_x_inds, test_x_inds = self.prepare_domain_holdout()
-            else:
-                (train_item_inds, train_ctx_inds, train_x_inds,
-                 test_x_item_inds, test_x_ctx_inds) = self.prepare_holdout(holdout_item, holdout_ctx)
-                
-                # which indices to use during testing
-                included_inds_item = np.concatenate([train_x_inds, test_x_item_inds])
-                included_inds_ctx = np.concatenate([train_x_inds, test_x_ctx_inds])
-                
-        elif do_combo_testing:
-            train_x_inds, test_x_inds = self.prepare_combo_testing()
+        optimizer = torch.optim.SGD(self.parameters(), lr=lr)
+        if compile_step:
+            self.compile_training()
+        
+        holdout_testing, do_holdout_testing, holdout_item, holdout_ctx = self.parse_holdout_testing(holdout_testing)
+
+        # training arguments that have to match to resume from a checkpoint
+        run_args = {
+            'lr': lr, 'num_epochs': num_epochs, 'batch_size': batch_size, 'report_freq': report_freq,
+            'snap_freq': snap_freq, 'snap_freq_scale': snap_freq_scale, 'scheduler': scheduler is not None,
+            'holdout_testing': holdout_testing, 'reports_per_test': reports_per_test, 'test_thresh': test_thresh,
+            'test_max_epochs': test_max_epochs, 'test_mode': test_mode, 'test_check_every': test_check_every,
+            'do_combo_testing': do_combo_testing, 'param_snapshots': param_snapshots
+        }
+        checkpoint = None
+        checkpoint_writer = None
+        if checkpoint_path is not None:
+            if os.path.exists(checkpoint_path):
+                checkpoint = load_checkpoint(checkpoint_path)
+                if checkpoint['rng_seed'] != self.rng_seed:
+                    raise ValueError(f'Checkpoint {checkpoint_path} is for a network with a different seed')
+                if checkpoint['run_args'] != run_args:
+                    raise ValueError(f'Checkpoint {checkpoint_path} is for different training arguments')
+            checkpoint_writer = CheckpointWriter(checkpoint_path)
+
+        # (the split is chosen randomly, so when resuming it comes from the checkpoint)
+        split = self.prepare_splits(holdout_testing, do_combo_testing) if checkpoint is None else checkpoint['split']
+        # (as long tensors, which splits in checkpoints from before DatasetIndex weren't)
+        split = {key: None if inds is None else self.index.rows(inds) for key, inds in split.items()}
+        train_item_inds = split['train_item_inds']
+        train_ctx_inds = split['train_ctx_inds']
+        train_x_inds = split['train_x_inds']
+        test_x_item_inds, test_x_ctx_inds = split['test_x_item_inds'], split['test_x_ctx_inds']
+        included_inds_item, included_inds_ctx = split['included_inds_item'], split['included_inds_ctx']
+        test_x_inds = split['test_x_inds']
             
         # (for snapshots)
         train_items = self.items[train_item_inds]
@@ -389,65 +958,80 @@ class DisjointDomainNet(nn.Module):
             
         n_inputs_train = len(train_x_inds)
 
-        snap_epochs, epoch_digits, snaps = self.prepare_snapshots(snap_freq, snap_freq_scale, num_epochs)
-        n_snaps = len(snap_epochs)
+        snap_epochs, epoch_digits, snap_sink = self.prepare_snapshots(snap_freq, snap_freq_scale, num_epochs,
+                                                                      param_snapshots, snap_sink)
 
-        params = {}
-        if param_snapshots:
-            params = {pname: torch.empty((n_snaps, *p.shape)) for pname, p in self.named_parameters()}
+        reports = self.prepare_reports(num_epochs, report_freq, reports_per_test, holdout_testing, do_combo_testing)
 
-        n_report = (num_epochs-1) // report_freq + 1
-        n_etg = (n_report-1) // reports_per_test + 1
-        reports = dict()
-        reports['loss'] = np.zeros(n_report)
-        reports['accuracy'] = np.zeros(n_report)
-        reports['weighted_acc'] = np.zeros(n_report)
-        
+        # generalization tests: report key, description, training inputs, and test inputs
+        tests = []
         if holdout_item:
-            reports['etg_item'] = np.zeros(n_etg, dtype=int) # "epochs to generalize"
-            
+            tests.append(('etg_item', 'epochs for new item =', included_inds_item, test_x_item_inds))
         if holdout_ctx:
-            reports['etg_context'] = np.zeros(n_etg, dtype=int)
-            
+            tests.append(('etg_context', 'epochs for new context =', included_inds_ctx, test_x_ctx_inds))
         if holdout_testing == 'domain':
-            reports['etg_domain'] = np.zeros(n_etg, dtype=int)
-        
-        if do_combo_testing:
-            reports['test_accuracy'] = np.zeros(n_report)
-            reports['test_weighted_acc'] = np.zeros(n_report)
+            tests.append(('etg_domain', 'epochs for new domain', self.index.rows(), test_x_inds))
+
+        start_epoch = 0
+        if checkpoint is not None:
+            start_epoch = self.load_train_checkpoint(checkpoint, optimizer, scheduler, reports, snap_sink)
+            print(f'Resuming from epoch {start_epoch}')
 
-        for epoch in range(num_epochs):
+        def write_checkpoint(epoch):
+            with metrics.phase('checkpoint'):
+                checkpoint_writer.write(self.make_train_checkpoint(epoch, run_args, split, optimizer, scheduler,
+                                                                   reports, snap_sink))
+
+        metrics.start(device=self.device, start_epoch=start_epoch, num_epochs=num_epochs, batch_size=batch_size, n_inputs_train=n_inputs_train,
+                      holdout_testing=holdout_testing, do_combo_testing=do_combo_testing,
+                      n_snaps=len(snap_epochs))
+
+        for epoch in range(start_epoch, num_epochs):
+            metrics.epoch_start(epoch)
+
+            if checkpoint_writer is not None and epoch > start_epoch and epoch % checkpoint_freq == 0:
+                write_checkpoint(epoch)
 
             # collect snapshot
             if epoch in snap_epochs:
                 k_snap = snap_epochs.index(epoch)
 
-                with torch.no_grad():
+                with metrics.phase('snapshot'), torch.no_grad():
                     
-                    if 'item' in snaps:
-                        snaps['item'][k_snap][train_item_inds] = self.calc_item_repr(train_items)
+                    if self.use_item_repr:
+                        snap_sink.write('snaps', 'item', k_snap, self.calc_item_repr(train_items), train_item_inds)
                         
-                    if 'context' in snaps:
-                        snaps['context'][k_snap][train_ctx_inds] = self.calc_context_repr(train_contexts)
+                    if self.use_ctx_repr:
+                        snap_sink.write('snaps', 'context', k_snap,
+                                        self.calc_context_repr(train_contexts), train_ctx_inds)
                     
-                    snaps['item_hidden'][k_snap][train_item_inds] = self.calc_hidden(item=train_items)
-                    snaps['context_hidden'][k_snap][train_ctx_inds] = self.calc_hidden(context=train_contexts)
+                    snap_sink.write('snaps', 'item_hidden', k_snap, self.calc_hidden(item=train_items), train_item_inds)
+                    snap_sink.write('snaps', 'context_hidden', k_snap,
+                                    self.calc_hidden(context=train_contexts), train_ctx_inds)
                     
                     if param_snapshots:
-                        for pname, p in self.named_parameters():
-                            params[pname][k_snap] = p
+                        for pname, p in self.named_snapshot_parameters():
+                            snap_sink.write('params', pname, k_snap, p)
+
+                    snap_sink.snapshot_done(k_snap)
 
             # do training
-            order = dd.choose_k(train_x_inds, n_inputs_train)
-            loss, acc_each, wacc_each = self.train_epoch(order, batch_size, optimizer)
+            with metrics.phase('train'):
+                order = dd.choose_k(train_x_inds, n_inputs_train, generator=self.generator)
+                # (accuracy is only needed for reports)
+                loss, acc_each, wacc_each = self.train_epoch(order, batch_size, optimizer,
+                                                             calc_acc=(epoch % report_freq == 0))
+            metrics.epoch_done(n_inputs_train)
+
             if scheduler is not None:
-                scheduler.step()
+                with metrics.phase('scheduler'):
+                    scheduler.step()
 
             # report progress
             if epoch % report_freq == 0:
                 k_report = epoch // report_freq
                 
-                with torch.no_grad():
+                with metrics.phase('report'), torch.no_grad():
                     mean_loss = loss.item() / n_inputs_train
                     mean_acc = torch.nansum(acc_each).item() / n_inputs_train
                     mean_wacc = torch.nansum(wacc_each).item() / n_inputs_train
@@ -461,33 +1045,20 @@ class DisjointDomainNet(nn.Module):
                 if do_holdout_testing and k_report % reports_per_test == 0:
                     k_test = k_report // reports_per_test
                     
-                    # Do item and context generalize tests separately
-                    if holdout_item:
-                        item_etg, item_etg_string = self.generalize_test(
-                            batch_size, optimizer, included_inds_item, test_x_item_inds,
-                            thresh=test_thresh, max_epochs=test_max_epochs
-                        )
-                        report_str += f', epochs for new item = {item_etg_string:>{etg_digits}}'
-                        reports['etg_item'][k_test] = item_etg
-                    
-                    if holdout_ctx:
-                        ctx_etg, ctx_etg_string = self.generalize_test(
-                            batch_size, optimizer, included_inds_ctx, test_x_ctx_inds,
-                            thresh=test_thresh, max_epochs=test_max_epochs
-                        )
-                        report_str += f', epochs for new context = {ctx_etg_string:>{etg_digits}}'
-                        reports['etg_context'][k_test] = ctx_etg
-                        
-                    if holdout_testing == 'domain':
-                        domain_etg, domain_etg_string = self.generalize_test(
-                            batch_size, optimizer, np.arange(self.n_inputs), test_x_inds,
-                            thresh=test_thresh, max_epochs=test_max_epochs
-                        )
-                        report_str += f', epochs for new domain {domain_etg_string:>{etg_digits}}'
-                        reports['etg_domain'][k_test] = domain_etg
+                    with metrics.phase('holdout_test'):
+                        # Do item and context generalize tests separately
+                        for etg_type, label, included_inds, targets in tests:
+                            etg, etg_string = self.generalize_test(
+                                batch_size, optimizer, included_inds, targets,
+                                thresh=test_thresh, max_epochs=test_max_epochs,
+                                mode=test_mode, check_every=test_check_every
+                            )
+                            report_str += f', {label} {etg_string:>{etg_digits}}'
+                            reports[etg_type][k_test] = etg
+                            metrics.add_etg_epochs(min(etg + 1, test_max_epochs))
                         
                 if do_combo_testing:
-                    with torch.no_grad():
+                    with metrics.phase('combo_test'), torch.no_grad():
                         outputs = self(self.x_item[test_x_inds], self.x_context[test_x_inds])
                         test_acc = torch.mean(self.b_outputs_correct(outputs, test_x_inds)).item()
                         test_wacc = torch.mean(self.weighted_acc(outputs, test_x_inds)).item()
@@ -497,11 +1068,64 @@ class DisjointDomainNet(nn.Module):
                         reports['test_weighted_acc'][k_report] = test_wacc
                                         
                 print(report_str)
+                metrics.interval_done(epoch)
+
+        if checkpoint_writer is not None:
+            write_checkpoint(num_epochs)
+            checkpoint_writer.close()
+
+        with metrics.phase('snapshot'):
+            snapshots = snap_sink.finalize()
+        metrics.finish()
 
-        snaps_cpu = {stype: s.cpu().numpy() for stype, s in snaps.items()}
-        ret_dict = {'snaps': snaps_cpu, 'reports': reports}
+        ret_dict = {'snaps': snapshots['snaps'], 'reports': reports}
         
         if param_snapshots:
-            ret_dict['params'] = {pname: p.cpu().numpy() for pname, p in params.items()}
+            ret_dict['params'] = snapshots['params']
         
         return ret_dict
+
+
+def test_output_mode_validity(n_domains=4, batch_size=16, n_samples=2000, **net_params):
+    """
+    Make sure the 'exact' output mode gives the same loss and gradients as DisjointDomainNet.forward
+    with nn.BCELoss, and that the 'sampled' mode's loss is an unbiased estimate of it
+    (raises AssertionError if not)
+    """
+    net_params = {'ctx_per_domain': 4, 'attrs_per_context': 60, 'n_domains': n_domains,
+                  'rng_seed': 0, **net_params}
+    full_net = DisjointDomainNet(output_mode='full', **net_params)
+    exact_net = DisjointDomainNet(output_mode='exact', **net_params)
+    sampled_net = DisjointDomainNet(output_mode='sampled', **net_params)
+    inds = dd.choose_k_inds(full_net.n_inputs, batch_size)
+
+    def loss_and_grads(net, targets):
+        net.zero_grad()
+        loss, _ = net.batch_loss(net.x_item[inds], net.x_context[inds], targets)
+        loss.backward()
+        return loss.item(), [(p.grad.to_dense() if p.grad.is_sparse else p.grad).clone() for p in net.parameters()]
+
+    full_loss, full_grads = loss_and_grads(full_net, full_net.get_y(inds))
+    exact_loss, exact_grads = loss_and_grads(exact_net, exact_net.get_y_blocks(inds))
+
+    if not np.isclose(full_loss, exact_loss, rtol=1e-5):
+        raise AssertionError(f'Exact mode loss ({exact_loss}) does not match full loss ({full_loss})')
+    print('Exact mode loss matches full loss.')
+
+    if not all(torch.allclose(g_full, g_exact, rtol=1e-4, atol=1e-6) for g_full, g_exact in zip(full_grads, exact_grads)):
+        raise AssertionError('Exact mode gradients do not match full gradients')
+    print('Exact mode gradients match full gradients.')
+
+    with torch.no_grad():
+        sampled_losses = np.array([
+            sampled_net.batch_loss(sampled_net.x_item[inds], sampled_net.x_context[inds],
+                                   sampled_net.get_y_blocks(inds))[0].item()
+            for _ in range(n_samples)
+        ])
+    mean_loss = np.mean(sampled_losses)
+    stderr = np.std(sampled_losses) / np.sqrt(n_samples)
+
+    if abs(mean_loss - full_loss) > 4 * stderr:
+        raise AssertionError(f'Mean sampled loss ({mean_loss:.3f} +/- {stderr:.3f}) is off from '
+                             f'full loss ({full_loss:.3f})')
+    print(f'Mean sampled loss ({mean_loss:.3f} +/- {stderr:.3f}) matches full loss ({full_loss:.3f}).')
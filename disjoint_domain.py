@@ -1,33 +1,38 @@
+from functools import lru_cache
+
 import numpy as np
 from scipy.linalg import block_diag, svd
-from scipy.cluster import hierarchy
-from scipy.spatial import distance
-import matplotlib.pyplot as plt
 import torch
 from typing import Dict, Any
 
+# matplotlib and the scipy modules only needed for plotting and testing are imported by the functions
+# that use them, so making datasets and training (e.g. in sweep workers) doesn't pay for loading them
+
 ITEMS_PER_DOMAIN = 8
 
 
-def choose_k_inds(n, k=1):
-    """Get random permutation of k indices in range(n)"""
+def choose_k_inds(n, k=1, generator=None):
+    """
+    Get random permutation of k indices in range(n)
+    (uses the global PyTorch rng unless a torch.Generator is given)
+    """
     if k > n:
         raise ValueError(f'Cannot pick {k} unique indices from range({n})')
-    return torch.randperm(n, device='cpu')[:k]
+    return torch.randperm(n, device='cpu', generator=generator)[:k]
 
 
-def choose_k(a, k=1):
+def choose_k(a, k=1, generator=None):
     """
     Get permutation of k items from a using PyTorch
     (want to make sure we use the same rng for everything so it's deterministic given the seed)
     """
     # need to use .numpy() here, or else a vector of length 1 will become a scalar
-    return a[choose_k_inds(len(a), k).numpy()]
+    return a[choose_k_inds(len(a), k, generator=generator).numpy()]
 
 
-def choose_k_set_bits(a, k=1):
+def choose_k_set_bits(a, k=1, generator=None):
     """Get permutation of k indices of a that are set (a should be a boolean array)"""
-    return choose_k(np.flatnonzero(a), k)
+    return choose_k(np.flatnonzero(a), k, generator=generator)
 
 
 def get_cluster_sizes(clusters):
@@ -39,7 +44,7 @@ def get_cluster_sizes(clusters):
     return sizes
 
 
-def _make_n_dist_d_attr_vecs(centroid, n=4, d=4):
+def _make_n_dist_d_attr_vecs(centroid, n=4, d=4, generator=None):
     """
     Useful for making 'circles' and similar structures in other attr cluster settings
     Here d is the *Hamming* distance between vectors, which is the square of Euclidean distance
@@ -52,8 +57,8 @@ def _make_n_dist_d_attr_vecs(centroid, n=4, d=4):
         raise ValueError('Distance times n must be a multiple of 4')
 
     try:
-        all_set_bits = choose_k_set_bits(1 - centroid, round(n * d // 4))
-        all_unset_bits = choose_k_set_bits(centroid, round(n * d // 4))
+        all_set_bits = choose_k_set_bits(1 - centroid, round(n * d // 4), generator)
+        all_unset_bits = choose_k_set_bits(centroid, round(n * d // 4), generator)
     except ValueError:
         raise ValueError(f'Not enough attributes to make {n} vectors of dist {d} from each other')
 
@@ -67,8 +72,27 @@ def _make_n_dist_d_attr_vecs(centroid, n=4, d=4):
     return similar_vecs
 
 
+def _check_3_group_params(attrs_per_context, attrs_set_per_item, clusters, intragroup_dists, intergroup_dist):
+    """Validate parameters of _make_3_group_attr_vecs; returns cluster sizes and intragroup distances"""
+    max_disjoint_bits = max(attrs_set_per_item, attrs_per_context - attrs_set_per_item)
+
+    if intergroup_dist % 2 != 0 or intergroup_dist // 2 > max_disjoint_bits:
+        raise ValueError(f'Invalid intergroup distance - must be even and <= {max_disjoint_bits * 2}')
+
+    clust_sizes = get_cluster_sizes(clusters)
+    if len(clust_sizes) != 3 or sum(clust_sizes) != 8:
+        raise ValueError('Invalid clust_sizes')
+    n_squares = clust_sizes[1]
+
+    if intragroup_dists is None:
+        default_sq_dist = 4 * (n_squares-1)/n_squares  # hack to allow all but 1 to be 2 away from the centroid
+        intragroup_dists = [4, 12, default_sq_dist, 10]
+
+    return clust_sizes, intragroup_dists
+
+
 def _make_3_group_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item,
-                            clusters='4-2-2', intragroup_dists=None, intergroup_dist=40, **_extra):
+                            clusters='4-2-2', intragroup_dists=None, intergroup_dist=40, generator=None, **_extra):
     """
     Make some attribute vectors that conform to the Euclidean distance plot (Figure R3, bottom).
     There are 8 items. Outputs a list of ctx_per_domain 8 x attrs_per_context matrices.
@@ -86,21 +110,9 @@ def _make_3_group_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_ite
     clust_sizes: 3-item list of # of circles, squares, and stars. Currently # of stars must be 2.
 
     """
-    # Validate everything first
-    max_disjoint_bits = max(attrs_set_per_item, attrs_per_context - attrs_set_per_item)
-
-    if intergroup_dist % 2 != 0 or intergroup_dist // 2 > max_disjoint_bits:
-        raise ValueError(f'Invalid intergroup distance - must be even and <= {max_disjoint_bits * 2}')
-
-    clust_sizes = get_cluster_sizes(clusters)
-    if len(clust_sizes) != 3 or sum(clust_sizes) != 8:
-        raise ValueError('Invalid clust_sizes')
+    clust_sizes, intragroup_dists = _check_3_group_params(attrs_per_context, attrs_set_per_item,
+                                                          clusters, intragroup_dists, intergroup_dist)
     n_circles, n_squares, n_stars = clust_sizes
-
-    if intragroup_dists is None:
-        default_sq_dist = 4 * (n_squares-1)/n_squares  # hack to allow all but 1 to be 2 away from the centroid
-        intragroup_dists = [4, 12, default_sq_dist, 10]
-
     circ_dist, sqst_dist, square_dist, star_dist = intragroup_dists
 
     attrs = [np.empty((ITEMS_PER_DOMAIN, attrs_per_context)) for _ in range(ctx_per_domain)]
@@ -109,45 +121,41 @@ def _make_3_group_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_ite
         # first, handle circles
         # choose centroid randomly
         circ_centroid = np.zeros(attrs_per_context)
-        circ_centroid_set = choose_k(np.arange(attrs_per_context), attrs_set_per_item)
+        circ_centroid_set = choose_k(np.arange(attrs_per_context), attrs_set_per_item, generator)
         circ_centroid_unset = np.setdiff1d(range(attrs_per_context), circ_centroid_set, assume_unique=True)
         circ_centroid[circ_centroid_set] = 1
 
         # now choose bits to flip for each of the 'circle' vectors, keeping total # set the same
-        attr_mat[:n_circles] = _make_n_dist_d_attr_vecs(circ_centroid, n_circles, circ_dist)
+        attr_mat[:n_circles] = _make_n_dist_d_attr_vecs(circ_centroid, n_circles, circ_dist, generator)
 
         # pick centroid for other items, which should be 40 bits away from this centroid.
         # (or overridden by setting intergroup_dist)
         other_centroid = circ_centroid.copy()
-        other_centroid[choose_k(circ_centroid_unset, intergroup_dist // 2)] = 1
-        other_centroid[choose_k(circ_centroid_set, intergroup_dist // 2)] = 0
+        other_centroid[choose_k(circ_centroid_unset, intergroup_dist // 2, generator)] = 1
+        other_centroid[choose_k(circ_centroid_set, intergroup_dist // 2, generator)] = 0
 
         # now square and star centroids, which are centered on other_centroid and differ by 12 bits (by default)
-        square_centroid, star_centroid = _make_n_dist_d_attr_vecs(other_centroid, 2, sqst_dist)
+        square_centroid, star_centroid = _make_n_dist_d_attr_vecs(other_centroid, 2, sqst_dist, generator)
 
         # squares differ by just 2 bits (by default). be a little imprecise and let one of them be the centroid.
-        attr_mat[n_circles + np.arange(n_squares)] = _make_n_dist_d_attr_vecs(square_centroid, n_squares, square_dist)
+        attr_mat[n_circles + np.arange(n_squares)] = _make_n_dist_d_attr_vecs(square_centroid, n_squares,
+                                                                              square_dist, generator)
 
         # stars differ by 10 bits (by default).
         # again be a little imprecise, let one differ from centroid by 4 and the other by 6 (all unique)
-        attr_mat[-n_stars:] = _make_n_dist_d_attr_vecs(star_centroid, n_stars, star_dist)
+        attr_mat[-n_stars:] = _make_n_dist_d_attr_vecs(star_centroid, n_stars, star_dist, generator)
 
     return attrs
 
 
-def _make_2_group_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item,
-                            clusters='4-4', intragroup_dists=None, intergroup_dist=40, **_extra):
-    """
-    Make attribute vectors with 2 clusters in a systematic way. All distances are Hamming and
-    should be divisible by 4 (2 in the case of intergroup)
-    """
+def _check_2_group_params(attrs_per_context, attrs_set_per_item, clusters, intragroup_dists, intergroup_dist):
+    """Validate parameters of _make_2_group_attr_vecs; returns cluster sizes and intragroup distances"""
     if intragroup_dists is None:
         intragroup_dists = [4, 12]
 
     clust_sizes = get_cluster_sizes(clusters)
     max_disjoint_bits = max(attrs_set_per_item, attrs_per_context - attrs_set_per_item)
 
-    # Validate everything first
     if intergroup_dist % 2 != 0 or intergroup_dist // 2 > max_disjoint_bits:
         raise ValueError(f'Invalid intergroup distance - must be even and <= {max_disjoint_bits * 2}')
 
@@ -156,37 +164,44 @@ def _make_2_group_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_ite
     if any([dist // 4 * n > max_disjoint_bits for dist, n in zip(intragroup_dists, clust_sizes)]):
         raise ValueError('Not enough attributes per cluster for these sizes and intragroup distances')
 
+    return clust_sizes, intragroup_dists
+
+
+def _make_2_group_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item,
+                            clusters='4-4', intragroup_dists=None, intergroup_dist=40, generator=None, **_extra):
+    """
+    Make attribute vectors with 2 clusters in a systematic way. All distances are Hamming and
+    should be divisible by 4 (2 in the case of intergroup)
+    """
+    clust_sizes, intragroup_dists = _check_2_group_params(attrs_per_context, attrs_set_per_item,
+                                                          clusters, intragroup_dists, intergroup_dist)
+
     attrs = [np.empty((ITEMS_PER_DOMAIN, attrs_per_context)) for _ in range(ctx_per_domain)]
 
     for attr_mat in attrs:
         circ_centroid = np.zeros(attrs_per_context)
-        circ_centroid_set = choose_k(np.arange(attrs_per_context), attrs_set_per_item)
+        circ_centroid_set = choose_k(np.arange(attrs_per_context), attrs_set_per_item, generator)
         circ_centroid_unset = np.setdiff1d(range(attrs_per_context), circ_centroid_set, assume_unique=True)
         circ_centroid[circ_centroid_set] = 1
 
         # make cirlces
         n_circles, n_squares = clust_sizes
         circ_dists, square_dists = intragroup_dists
-        attr_mat[:n_circles] = _make_n_dist_d_attr_vecs(circ_centroid, n_circles, circ_dists)
+        attr_mat[:n_circles] = _make_n_dist_d_attr_vecs(circ_centroid, n_circles, circ_dists, generator)
 
         # make square centroid
         square_centroid = circ_centroid.copy()
-        square_centroid[choose_k(circ_centroid_unset, intergroup_dist // 2)] = 1
-        square_centroid[choose_k(circ_centroid_set, intergroup_dist // 2)] = 0
+        square_centroid[choose_k(circ_centroid_unset, intergroup_dist // 2, generator)] = 1
+        square_centroid[choose_k(circ_centroid_set, intergroup_dist // 2, generator)] = 0
 
         # make squares
-        attr_mat[n_circles:] = _make_n_dist_d_attr_vecs(square_centroid, n_squares, square_dists)
+        attr_mat[n_circles:] = _make_n_dist_d_attr_vecs(square_centroid, n_squares, square_dists, generator)
 
     return attrs
 
 
-def _make_equidistant_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item,
-                                intragroup_dists=None, **_extra):
-    """
-    Make attribute vectors that are all equidistant from each other with Hamming distance `dist`. 
-    attrs_per_context must be at least attrs_set_per_item + (dist/2) * (ITEMS_PER_DOMAIN-1)
-    (by default, at least 60). Also, dist must be even.
-    """
+def _check_equidistant_params(attrs_per_context, attrs_set_per_item, intragroup_dists):
+    """Validate parameters of _make_equidistant_attr_vecs; returns half the distance between vectors"""
     if intragroup_dists is None:
         dist = 10
     else:
@@ -199,6 +214,17 @@ def _make_equidistant_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per
     if attrs_per_context < attrs_set_per_item + half_dist * (ITEMS_PER_DOMAIN-1):
         raise ValueError(f'Need more attrs to get equidistant vecs with distance {dist}')
 
+    return half_dist
+
+
+def _make_equidistant_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item,
+                                intragroup_dists=None, generator=None, **_extra):
+    """
+    Make attribute vectors that are all equidistant from each other with Hamming distance `dist`. 
+    attrs_per_context must be at least attrs_set_per_item + (dist/2) * (ITEMS_PER_DOMAIN-1)
+    (by default, at least 60). Also, dist must be even.
+    """
+    half_dist = _check_equidistant_params(attrs_per_context, attrs_set_per_item, intragroup_dists)
     n_rot = half_dist * ITEMS_PER_DOMAIN  # portion of vector that rotates for each item
     n_fixed_set = attrs_set_per_item - half_dist
 
@@ -206,7 +232,7 @@ def _make_equidistant_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per
 
     for attr_mat in attrs:
         # pick fixed set and rotating indices
-        fixed_set_and_rot_inds = choose_k_inds(attrs_per_context, n_fixed_set + n_rot)
+        fixed_set_and_rot_inds = choose_k_inds(attrs_per_context, n_fixed_set + n_rot, generator)
         fixed_set_inds, rot_inds = fixed_set_and_rot_inds.split([n_fixed_set, n_rot])
         rot_inds_each = rot_inds.split(half_dist)
 
@@ -294,7 +320,7 @@ def _make_eq_freq_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_ite
     return [attr_template.copy() for _ in range(ctx_per_domain)]
 
 
-def _shuffle_attr_vec_mat(attr_vecs):
+def _shuffle_attr_vec_mat(attr_vecs, generator=None):
     """
     Given a matrix of attr_vecs (y), shuffles them in such a way
     as to destroy the group hierarchy but preserve the mean frequency per item.
@@ -324,7 +350,7 @@ def _shuffle_attr_vec_mat(attr_vecs):
             # choose remainder from items that may or may not be included here
             n_to_choose = num_items - len(items_to_set)
             items_to_choose_from = np.flatnonzero((num_to_assign > 0) & (skips_left > 0))
-            items_to_set = np.append(items_to_set, choose_k(items_to_choose_from, n_to_choose))
+            items_to_set = np.append(items_to_set, choose_k(items_to_choose_from, n_to_choose, generator))
 
             vec[items_to_set] = 1
             num_to_assign[items_to_set] -= 1
@@ -336,7 +362,7 @@ def _shuffle_attr_vec_mat(attr_vecs):
     return new_attr_vecs
 
 
-def _resample_attr_vec_mat(attr_vecs, item_weights=None):
+def _resample_attr_vec_mat(attr_vecs, item_weights=None, generator=None):
     """
     Given a matrix of attr vecs (y), make a new one that preserves the same distribution of
     attribute frequencies. Proceeding from most to least frequent attribute in the original matrix,
@@ -362,18 +388,121 @@ def _resample_attr_vec_mat(attr_vecs, item_weights=None):
     freq_freqs = [np.sum(attr_freqs == n) for n in n_item_seq]
     attr_starts = np.cumsum(np.concatenate([[0], freq_freqs[:-1]]))
 
-    new_attr_vecs = torch.zeros(attr_vecs.shape, device='cpu')
+    new_attr_vecs = torch.zeros(attr_vecs.shape, dtype=torch.float, device='cpu')
 
     for n_items, n_attrs, start_i in zip(n_item_seq, freq_freqs, attr_starts):
         for i_attr in range(start_i, start_i + n_attrs):
             item_weights[item_remaining_attrs == 0] = 0
-            these_items = torch.multinomial(item_weights, n_items)
+            these_items = torch.multinomial(item_weights, n_items, generator=generator)
             new_attr_vecs[these_items, i_attr] = 1.
             item_remaining_attrs[these_items] -= 1
 
     return new_attr_vecs.numpy()
 
 
+def _select_ranked(keys, n):
+    """
+    Boolean mask of the n[b] entries with the lowest keys in each row b of keys
+    (as if taking the first n[b] after sorting each row)
+    """
+    ranks = torch.argsort(torch.argsort(keys, dim=1), dim=1)
+    return ranks < n[:, np.newaxis]
+
+
+def shuffle_attr_vecs_batch(attr_vecs, generator=None):
+    """
+    Same as _shuffle_attr_vec_mat, for a stack of matrices (... x ITEMS_PER_DOMAIN x attrs) at once.
+    To make many shuffled versions of one matrix, pass copies of it (e.g. np.repeat(mat[np.newaxis], n, axis=0)).
+
+    Each new matrix keeps the frequency (number of items) of each attribute and, within each frequency class,
+    the number of attributes each item has. Rather than handling the classes one at a time, all columns are
+    assigned in one pass, with the randomness for all matrices at each step drawn at once.
+    """
+    attr_vecs = np.asarray(attr_vecs)
+    batch_shape = attr_vecs.shape[:-2]
+    mats = torch.tensor(attr_vecs.reshape(-1, *attr_vecs.shape[-2:]), device='cpu').round().to(torch.long)
+    n_mats, n_items, n_attrs = mats.shape
+    mat_inds = torch.arange(n_mats, device='cpu')
+
+    # frequency class of each attribute, and for each class, how many attributes each item has in it
+    freqs = torch.sum(mats, dim=1)
+    class_onehot = torch.nn.functional.one_hot(freqs, n_items + 1)  # mats x attrs x classes
+    num_to_assign = torch.einsum('mia,mac->mci', mats, class_onehot)
+    skips_left = torch.sum(class_onehot, dim=1)[:, :, np.newaxis] - num_to_assign
+
+    new_mats = torch.zeros_like(mats)
+    for i_attr in range(n_attrs):
+        n_set = freqs[:, i_attr]
+        to_assign = num_to_assign[mat_inds, n_set]
+        skips = skips_left[mat_inds, n_set]
+
+        # include all items that must be included to not run out of attributes,
+        # then choose the remainder from items that may or may not be included here
+        must_set = skips == 0
+        assert torch.all(torch.sum(must_set, dim=1) <= n_set), "Oops, something's wrong"
+        keys = torch.rand((n_mats, n_items), dtype=torch.double, device='cpu', generator=generator)
+        keys[must_set] = -1
+        keys[(to_assign == 0) & ~must_set] = 2
+        items_to_set = _select_ranked(keys, n_set)
+
+        new_mats[:, :, i_attr] = items_to_set
+        num_to_assign[mat_inds, n_set] -= items_to_set.long()
+        skips_left[mat_inds, n_set] -= (~items_to_set).long()
+
+    assert torch.all(num_to_assign == 0), "Oops, something's wrong"
+    return new_mats.double().numpy().reshape(*batch_shape, n_items, n_attrs)
+
+
+def resample_attr_vecs_batch(attr_vecs, item_weights=None, generator=None):
+    """
+    Same as _resample_attr_vec_mat, for a stack of matrices (... x ITEMS_PER_DOMAIN x attrs) at once.
+    To make many resampled versions of one matrix, pass copies of it (e.g. np.repeat(mat[np.newaxis], n, axis=0)).
+
+    Choosing n items without replacement with probability proportional to item_weights is done with the
+    Gumbel-top-k trick (the n items with the highest log weight + Gumbel noise), which has the same
+    distribution as torch.multinomial and lets each attribute be assigned for all matrices at once.
+    The one difference is when too few items have attributes left for an attribute's frequency, which can happen
+    near the end: then _resample_attr_vec_mat gives the extra attributes to the same items every time (an artifact
+    of torch.multinomial), and this function to random ones, so numbers of attributes per item differ slightly.
+    """
+    if item_weights is None:
+        item_weights = np.repeat(1 / ITEMS_PER_DOMAIN, ITEMS_PER_DOMAIN)
+
+    if len(item_weights) != ITEMS_PER_DOMAIN:
+        raise ValueError(f'item_p must be a list/tuple of length {ITEMS_PER_DOMAIN}')
+
+    if sum(item_weights) <= 0 or any([wt < 0 for wt in item_weights]):
+        raise ValueError('Invalid item weights - must be nonnegative and have positive sum')
+
+    attr_vecs = np.asarray(attr_vecs)
+    batch_shape = attr_vecs.shape[:-2]
+    mats = torch.tensor(attr_vecs.reshape(-1, *attr_vecs.shape[-2:]), device='cpu').round().to(torch.long)
+    n_mats, n_items, n_attrs = mats.shape
+
+    item_weights = torch.tensor(item_weights, dtype=torch.double, device='cpu')
+    log_weights = torch.log(item_weights)
+    item_remaining_attrs = torch.sum(mats, dim=2)
+    # new attributes go from most to least frequent
+    attr_freqs = torch.sort(torch.sum(mats, dim=1), dim=1, descending=True).values
+
+    new_mats = torch.zeros_like(mats)
+    for i_attr in range(n_attrs):
+        n_set = attr_freqs[:, i_attr]
+        uniform = torch.rand((n_mats, n_items), dtype=torch.double, device='cpu', generator=generator)
+        keys = torch.log(-torch.log(uniform)) - log_weights  # negative Gumbel-perturbed log weights
+
+        # once there aren't enough items with nonzero weight (i.e. with attributes left), the rest are chosen
+        # uniformly from those without (torch.multinomial also falls back to them, but always in the same order)
+        no_weight = (item_remaining_attrs <= 0) | (item_weights == 0)
+        keys[no_weight] = 1e10 + uniform[no_weight]
+        these_items = _select_ranked(keys, n_set)
+
+        new_mats[:, :, i_attr] = these_items
+        item_remaining_attrs -= these_items.long()
+
+    return new_mats.double().numpy().reshape(*batch_shape, n_items, n_attrs)
+
+
 def normalize_cluster_info(cluster_info):
     """
     Get a dict that specifies information about the attribute clusters.
@@ -391,36 +520,52 @@ def normalize_cluster_info(cluster_info):
     return cluster_info
 
 
-def make_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item, cluster_info):
-    """Wrapper to make any set of attr vectors (returns a list of one matrix per context)"""
-    if attrs_set_per_item > attrs_per_context:
-        raise ValueError('Cannot set more attrs per item than # allocated to each context')
-
-    cluster_info = normalize_cluster_info(cluster_info)
-
+def _get_attr_vec_fn(cluster_info, batched=False):
+    """
+    Pick the function that makes attr vectors for the given (normalized) cluster info,
+    either the one for one set of contexts or the batched version
+    """
     # special case for equalized attribute frequency
     if 'eq-freq' in cluster_info['special']:
         if cluster_info['clusters'] != '4-2-2':
             raise ValueError('eq-freq attributes are only defined for 4-2-2 clusters')
 
-        attr_vec_fn = _make_eq_freq_attr_vecs
-    else:
-        n_clusts = len(get_cluster_sizes(cluster_info['clusters']))
-        try:
-            attr_vec_fn = {
-                1: _make_equidistant_attr_vecs,
-                2: _make_2_group_attr_vecs,
-                3: _make_3_group_attr_vecs
+        return _make_eq_freq_attr_vecs_batch if batched else _make_eq_freq_attr_vecs
+
+    n_clusts = len(get_cluster_sizes(cluster_info['clusters']))
+    try:
+        if batched:
+            return {
+                1: _make_equidistant_attr_vecs_batch,
+                2: _make_2_group_attr_vecs_batch,
+                3: _make_3_group_attr_vecs_batch
             }[n_clusts]
-        except KeyError:
-            raise ValueError('Invalid clusters specification')
+        return {
+            1: _make_equidistant_attr_vecs,
+            2: _make_2_group_attr_vecs,
+            3: _make_3_group_attr_vecs
+        }[n_clusts]
+    except KeyError:
+        raise ValueError('Invalid clusters specification')
 
-    attr_vecs = attr_vec_fn(ctx_per_domain, attrs_per_context, attrs_set_per_item, **cluster_info)
+
+def make_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item, cluster_info, generator=None):
+    """
+    Wrapper to make any set of attr vectors (returns a list of one matrix per context).
+    Random draws come from generator (a torch.Generator on the CPU) if given, else the global torch RNG.
+    """
+    if attrs_set_per_item > attrs_per_context:
+        raise ValueError('Cannot set more attrs per item than # allocated to each context')
+
+    cluster_info = normalize_cluster_info(cluster_info)
+    attr_vec_fn = _get_attr_vec_fn(cluster_info)
+    attr_vecs = attr_vec_fn(ctx_per_domain, attrs_per_context, attrs_set_per_item, generator=generator,
+                            **cluster_info)
 
     # special case for shuffled attribute-item assignments keeping same mean
     # attr frequency for each item
     if 'shuffled' in cluster_info['special']:
-        attr_vecs = [_shuffle_attr_vec_mat(mat) for mat in attr_vecs]
+        attr_vecs = [_shuffle_attr_vec_mat(mat, generator) for mat in attr_vecs]
 
     # "resample" special case, to disrupt hierarchical structure
     if 'resample' in cluster_info['special']:
@@ -428,29 +573,250 @@ def make_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item, cluste
             item_weights = cluster_info['resample_weights']
         except KeyError:
             item_weights = None
-        attr_vecs = [_resample_attr_vec_mat(mat, item_weights) for mat in attr_vecs]
+        attr_vecs = [_resample_attr_vec_mat(mat, item_weights, generator) for mat in attr_vecs]
 
     return attr_vecs
 
 
-def make_io_mats(ctx_per_domain=4, attrs_per_context=50, attrs_set_per_item=25,
-                 n_domains=4, cluster_info='4-2-2', last_domain_cluster_info=None,
-                 repeat_attrs_over_domains=False, **_extra):
+def _choose_set_bits_batch(mask, k, generator=None):
     """
-    Make the actual item, context, and attribute matrices, across a given number of domains.
-    If one_equidistant is true, replaces the last domain's attrs with equidistant attr vectors.
-    Cluster_info and last_domain_cluster_info should be valid inputs to normalize_cluster_info.
-    By default (when None), last_domain_clusters is the same as clusters.
-    repeat_attrs_over_domains - if True, don't regenerate attrs for each domain, just repeat them.
+    For each row of a boolean matrix, get a random permutation of k of the indices of its set entries,
+    all with one random draw. Each row must have at least k set entries.
     """
+    if torch.any(torch.sum(mask, dim=1) < k):
+        raise ValueError(f'Cannot pick {k} set entries from a row with fewer')
+    keys = torch.rand(mask.shape, dtype=torch.double, device='cpu', generator=generator)
+    keys[~mask] = 2  # unset entries sort last
+    return torch.argsort(keys, dim=1)[:, :k]
 
-    # First make it for a single domain, then use block_diag to replicate.
-    item_mat_1 = np.tile(np.eye(ITEMS_PER_DOMAIN), (ctx_per_domain, 1))
-    item_mat = block_diag(*[item_mat_1 for _ in range(n_domains)])
 
-    context_mat_1 = np.repeat(np.eye(ctx_per_domain), ITEMS_PER_DOMAIN, axis=0)
-    context_mat = block_diag(*[context_mat_1 for _ in range(n_domains)])
+def _random_centroids_batch(n_vecs, attrs_per_context, attrs_set_per_item, generator=None):
+    """n_vecs random attribute vectors with attrs_set_per_item attributes set (as a torch tensor)"""
+    set_bits = _choose_set_bits_batch(torch.ones((n_vecs, attrs_per_context), dtype=torch.bool, device='cpu'),
+                                      attrs_set_per_item, generator)
+    centroids = torch.zeros((n_vecs, attrs_per_context), dtype=torch.double, device='cpu')
+    return centroids.scatter_(1, set_bits, 1.)
+
+
+def _flip_bits_batch(centroids, n_flip, n_vecs=1, generator=None):
+    """
+    Make n_vecs copies of each centroid (row of centroids) and, over all the copies, turn n_flip
+    of the centroid's unset bits on and n_flip of its set bits off, split between copies as with
+    np.array_split so that each bit is flipped in at most one copy. Returns a batch x n_vecs x attrs tensor.
+    """
+    bits_on = _choose_set_bits_batch(centroids == 0, n_flip, generator)
+    bits_off = _choose_set_bits_batch(centroids == 1, n_flip, generator)
 
+    # which copy each flipped bit belongs to
+    owner = torch.tensor(np.concatenate([np.full(len(chunk), i, dtype=int)
+                                         for i, chunk in enumerate(np.array_split(np.arange(n_flip), n_vecs))]),
+                         dtype=torch.long, device='cpu')
+    batch_inds = torch.arange(len(centroids), device='cpu')[:, np.newaxis]
+
+    vecs = centroids[:, np.newaxis].repeat(1, n_vecs, 1)
+    vecs[batch_inds, owner, bits_on] = 1
+    vecs[batch_inds, owner, bits_off] = 0
+    return vecs
+
+
+def _make_n_dist_d_attr_vecs_batch(centroids, n=4, d=4, generator=None):
+    """Batched version of _make_n_dist_d_attr_vecs, for each row of centroids (returns batch x n x attrs)"""
+    if n == 1:
+        return centroids[:, np.newaxis].clone()
+
+    if (n * d) % 4 != 0:
+        raise ValueError('Distance times n must be a multiple of 4')
+
+    try:
+        return _flip_bits_batch(centroids, round(n * d // 4), n, generator)
+    except ValueError:
+        raise ValueError(f'Not enough attributes to make {n} vectors of dist {d} from each other')
+
+
+def _make_3_group_attr_vecs_batch(n_mats, attrs_per_context, attrs_set_per_item, clusters='4-2-2',
+                                  intragroup_dists=None, intergroup_dist=40, generator=None, **_extra):
+    """Same as _make_3_group_attr_vecs, for n_mats contexts at once (returns n_mats x 8 x attrs tensor)"""
+    clust_sizes, intragroup_dists = _check_3_group_params(attrs_per_context, attrs_set_per_item,
+                                                          clusters, intragroup_dists, intergroup_dist)
+    n_circles, n_squares, n_stars = clust_sizes
+    circ_dist, sqst_dist, square_dist, star_dist = intragroup_dists
+
+    circ_centroids = _random_centroids_batch(n_mats, attrs_per_context, attrs_set_per_item, generator)
+    other_centroids = _flip_bits_batch(circ_centroids, intergroup_dist // 2, generator=generator)[:, 0]
+    sqst_centroids = _make_n_dist_d_attr_vecs_batch(other_centroids, 2, sqst_dist, generator)
+
+    return torch.cat([
+        _make_n_dist_d_attr_vecs_batch(circ_centroids, n_circles, circ_dist, generator),
+        _make_n_dist_d_attr_vecs_batch(sqst_centroids[:, 0], n_squares, square_dist, generator),
+        _make_n_dist_d_attr_vecs_batch(sqst_centroids[:, 1], n_stars, star_dist, generator)
+    ], dim=1)
+
+
+def _make_2_group_attr_vecs_batch(n_mats, attrs_per_context, attrs_set_per_item, clusters='4-4',
+                                  intragroup_dists=None, intergroup_dist=40, generator=None, **_extra):
+    """Same as _make_2_group_attr_vecs, for n_mats contexts at once (returns n_mats x 8 x attrs tensor)"""
+    clust_sizes, intragroup_dists = _check_2_group_params(attrs_per_context, attrs_set_per_item,
+                                                          clusters, intragroup_dists, intergroup_dist)
+    n_circles, n_squares = clust_sizes
+    circ_dists, square_dists = intragroup_dists
+
+    circ_centroids = _random_centroids_batch(n_mats, attrs_per_context, attrs_set_per_item, generator)
+    square_centroids = _flip_bits_batch(circ_centroids, intergroup_dist // 2, generator=generator)[:, 0]
+
+    return torch.cat([
+        _make_n_dist_d_attr_vecs_batch(circ_centroids, n_circles, circ_dists, generator),
+        _make_n_dist_d_attr_vecs_batch(square_centroids, n_squares, square_dists, generator)
+    ], dim=1)
+
+
+def _make_equidistant_attr_vecs_batch(n_mats, attrs_per_context, attrs_set_per_item,
+                                      intragroup_dists=None, generator=None, **_extra):
+    """Same as _make_equidistant_attr_vecs, for n_mats contexts at once (returns n_mats x 8 x attrs tensor)"""
+    half_dist = _check_equidistant_params(attrs_per_context, attrs_set_per_item, intragroup_dists)
+    n_rot = half_dist * ITEMS_PER_DOMAIN
+    n_fixed_set = attrs_set_per_item - half_dist
+
+    inds = _choose_set_bits_batch(torch.ones((n_mats, attrs_per_context), dtype=torch.bool, device='cpu'),
+                                  n_fixed_set + n_rot, generator)
+    fixed_set_inds, rot_inds = inds.split([n_fixed_set, n_rot], dim=1)
+
+    mats = torch.zeros((n_mats, ITEMS_PER_DOMAIN, attrs_per_context), dtype=torch.double, device='cpu')
+    mats.scatter_(2, fixed_set_inds[:, np.newaxis].expand(-1, ITEMS_PER_DOMAIN, -1), 1.)
+    mats.scatter_(2, rot_inds.reshape(n_mats, ITEMS_PER_DOMAIN, half_dist), 1.)
+    return mats
+
+
+def _make_eq_freq_attr_vecs_batch(n_mats, attrs_per_context, attrs_set_per_item, generator=None, **cluster_info):
+    """eq-freq attributes are the same for every context, so just repeat them"""
+    template = _make_eq_freq_attr_vecs(1, attrs_per_context, attrs_set_per_item, **cluster_info)[0]
+    return torch.tensor(template, device='cpu').repeat(n_mats, 1, 1)
+
+
+def make_attr_vecs_batch(n_sets, ctx_per_domain, attrs_per_context, attrs_set_per_item, cluster_info,
+                         generator=None):
+    """
+    Make n_sets independent sets of attr vectors at once (each the same as from make_attr_vecs), e.g. for
+    all domains of a dataset or all replicates of a sweep. The random draws are done for all contexts of
+    all sets together, so this is much faster than calling make_attr_vecs n_sets times, but it uses the
+    RNG differently, so results for a given seed differ from those of make_attr_vecs.
+    Returns an n_sets x ctx_per_domain x ITEMS_PER_DOMAIN x attrs_per_context array.
+    """
+    if attrs_set_per_item > attrs_per_context:
+        raise ValueError('Cannot set more attrs per item than # allocated to each context')
+
+    cluster_info = normalize_cluster_info(cluster_info)
+    attr_vec_fn = _get_attr_vec_fn(cluster_info, batched=True)
+    mats = attr_vec_fn(n_sets * ctx_per_domain, attrs_per_context, attrs_set_per_item,
+                       generator=generator, **cluster_info).numpy()
+
+    if 'shuffled' in cluster_info['special']:
+        mats = shuffle_attr_vecs_batch(mats, generator)
+
+    if 'resample' in cluster_info['special']:
+        mats = resample_attr_vecs_batch(mats, cluster_info.get('resample_weights'), generator)
+
+    return mats.reshape(n_sets, ctx_per_domain, ITEMS_PER_DOMAIN, attrs_per_context)
+
+
+def pack_attrs(attrs):
+    """
+    Bit-pack 0/1 attribute vectors along the last axis (8 attributes per byte, as with np.packbits).
+    Use unpack_attrs with the number of attributes to get them back.
+    """
+    return np.packbits(np.asarray(attrs) != 0, axis=-1)
+
+
+def unpack_attrs(packed, n_attrs, dtype=np.float64):
+    """Inverse of pack_attrs - n_attrs is the length of the original last axis"""
+    return np.unpackbits(packed, axis=-1, count=n_attrs).astype(dtype)
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed):
+    """Number of set bits in each byte of a uint8 array"""
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+        return np.bitwise_count(packed)
+    return _POPCOUNT_TABLE[packed]
+
+
+def hamming_dists(packed_a, packed_b=None, max_block_size=2**24):
+    """
+    Hamming distances between each pair of rows of bit-packed attribute vectors (as from pack_attrs),
+    i.e. an (..., n_a, n_b) array for inputs of size (..., n_a, n_bytes) and (..., n_b, n_bytes).
+    If packed_b is None, the distances are between the rows of packed_a. To save memory, rows of packed_a
+    are done in blocks with at most max_block_size bytes to compare.
+    """
+    if packed_b is None:
+        packed_b = packed_a
+    *batch_shape, n_a, n_bytes = packed_a.shape
+    n_b = packed_b.shape[-2]
+
+    dists = np.empty((*np.broadcast_shapes(tuple(batch_shape), packed_b.shape[:-2]), n_a, n_b), dtype=np.int64)
+    block_rows = max(1, max_block_size // (max(1, np.prod(dists.shape[:-2], dtype=int)) * n_b * n_bytes))
+    for start in range(0, n_a, block_rows):
+        block = packed_a[..., start:start + block_rows, np.newaxis, :]
+        diff_bits = np.bitwise_xor(block, packed_b[..., np.newaxis, :, :])
+        dists[..., start:start + block_rows, :] = np.sum(popcount(diff_bits), axis=-1, dtype=np.int64)
+    return dists
+
+
+def _same_dist_p_value(a, b):
+    """p-value of a chi-square test of whether discrete samples a and b come from the same distribution"""
+    values = np.union1d(a, b)
+    if len(values) == 1:
+        return 1.
+    from scipy.stats import chi2_contingency
+
+    counts = np.stack([np.sum(x[:, np.newaxis] == values, axis=0) for x in [a, b]])
+    return chi2_contingency(counts)[1]
+
+
+def test_attr_vecs_batch(cluster_info='4-2-2', n_mats=2000, attrs_per_context=60, attrs_set_per_item=25,
+                         alpha=0.001):
+    """
+    Make sure attr vectors from make_attr_vecs_batch are statistically the same as those from make_attr_vecs:
+    the number of attributes set for each item and the Hamming distance between each pair of items should
+    have the same distributions over contexts (chi-square test for each, Bonferroni corrected).
+    Returns the p-values for the number of attributes of each item and the distance between each pair.
+    (For 'resample' clusters, the numbers of attributes are expected to differ - see resample_attr_vecs_batch.)
+    """
+    looped = np.stack(make_attr_vecs(n_mats, attrs_per_context, attrs_set_per_item, cluster_info))
+    batched = make_attr_vecs_batch(1, n_mats, attrs_per_context, attrs_set_per_item, cluster_info)[0]
+    pairs = list(zip(*np.triu_indices(ITEMS_PER_DOMAIN, 1)))
+    thresh = alpha / (ITEMS_PER_DOMAIN + len(pairs))
+
+    count_p_vals = np.array([_same_dist_p_value(np.sum(looped[:, i], axis=1), np.sum(batched[:, i], axis=1))
+                             for i in range(ITEMS_PER_DOMAIN)])
+    bad_items = np.flatnonzero(count_p_vals < thresh)
+    if len(bad_items) > 0:
+        print(f'Warning: numbers of attributes of items {list(bad_items)} have different distributions.')
+    else:
+        print(f'Numbers of attributes of each item have the same distributions (min p = {np.min(count_p_vals):.3g}).')
+
+    looped_dists = hamming_dists(pack_attrs(looped))
+    batched_dists = hamming_dists(pack_attrs(batched))
+    dist_p_vals = np.ones((ITEMS_PER_DOMAIN, ITEMS_PER_DOMAIN))
+    for i, j in pairs:
+        dist_p_vals[i, j] = dist_p_vals[j, i] = _same_dist_p_value(looped_dists[:, i, j], batched_dists[:, i, j])
+    bad_pairs = [(i, j) for i, j in pairs if dist_p_vals[i, j] < thresh]
+    if len(bad_pairs) > 0:
+        print(f'Warning: Hamming distances between items {bad_pairs} have different distributions.')
+    else:
+        print(f'Hamming distances between items have the same distributions (min p = {np.min(dist_p_vals):.3g}).')
+
+    return count_p_vals, dist_p_vals
+
+
+def make_domain_attrs(ctx_per_domain=4, attrs_per_context=50, attrs_set_per_item=25,
+                      n_domains=4, cluster_info='4-2-2', last_domain_cluster_info=None,
+                      repeat_attrs_over_domains=False, vectorized=False, generator=None, **_extra):
+    """
+    Generate the attribute vectors of each domain (see make_io_mats for parameters).
+    Returns a list of distinct sets of attr vectors (each a list of one matrix per context,
+    as from make_attr_vecs) and the index of the set used by each domain.
+    """
     if last_domain_cluster_info is None:
         last_domain_cluster_info = cluster_info
         last_is_same = True
@@ -460,27 +826,289 @@ def make_io_mats(ctx_per_domain=4, attrs_per_context=50, attrs_set_per_item=25,
     cluster_info = normalize_cluster_info(cluster_info)
     last_domain_cluster_info = normalize_cluster_info(last_domain_cluster_info)
 
-    if repeat_attrs_over_domains:
-        domain_attrs = make_attr_vecs(ctx_per_domain, attrs_per_context,
-                                      attrs_set_per_item, cluster_info)
+    if vectorized:
+        # make all sets with the same cluster info in one batch
+        if repeat_attrs_over_domains:
+            n_same = 1
+            domain_inds = [0] * n_domains if last_is_same else [0] * (n_domains - 1) + [1]
+        else:
+            n_same = n_domains if last_is_same else n_domains - 1
+            domain_inds = list(range(n_domains))
+
+        domain_attrs = []
+        if n_same > 0:
+            domain_attrs += [list(mats) for mats in make_attr_vecs_batch(
+                n_same, ctx_per_domain, attrs_per_context, attrs_set_per_item, cluster_info, generator)]
+        if not last_is_same:
+            domain_attrs += [list(mats) for mats in make_attr_vecs_batch(
+                1, ctx_per_domain, attrs_per_context, attrs_set_per_item, last_domain_cluster_info, generator)]
+
+    elif repeat_attrs_over_domains:
+        domain_attrs = [make_attr_vecs(ctx_per_domain, attrs_per_context,
+                                       attrs_set_per_item, cluster_info, generator)]
         if last_is_same:
-            attr_mat = block_diag(*([block_diag(*domain_attrs)] * n_domains))
+            domain_inds = [0] * n_domains
         else:
-            domain_attrs_last = make_attr_vecs(ctx_per_domain, attrs_per_context,
-                                               attrs_set_per_item, last_domain_cluster_info)
-            attr_mat = block_diag(*([block_diag(*domain_attrs)] * (n_domains - 1) + [block_diag(*domain_attrs_last)]))
+            domain_attrs.append(make_attr_vecs(ctx_per_domain, attrs_per_context,
+                                               attrs_set_per_item, last_domain_cluster_info, generator))
+            domain_inds = [0] * (n_domains - 1) + [1]
     else:
         # New behavior: generate a new set of attr vecs for each domain.
         domain_attrs = [make_attr_vecs(ctx_per_domain, attrs_per_context,
-                                       attrs_set_per_item, cluster_info)
+                                       attrs_set_per_item, cluster_info, generator)
                         for _ in range(n_domains - 1)]
         domain_attrs.append(make_attr_vecs(ctx_per_domain, attrs_per_context,
-                                           attrs_set_per_item, last_domain_cluster_info))
-        attr_mat = block_diag(*[block_diag(*attrs) for attrs in domain_attrs])
+                                           attrs_set_per_item, last_domain_cluster_info, generator))
+        domain_inds = list(range(n_domains))
+
+    return domain_attrs, domain_inds
+
+
+@lru_cache(maxsize=None)
+def _make_input_mats(ctx_per_domain, n_domains):
+    # First make it for a single domain, then use block_diag to replicate.
+    item_mat_1 = np.tile(np.eye(ITEMS_PER_DOMAIN), (ctx_per_domain, 1))
+    item_mat = block_diag(*[item_mat_1 for _ in range(n_domains)])
+
+    context_mat_1 = np.repeat(np.eye(ctx_per_domain), ITEMS_PER_DOMAIN, axis=0)
+    context_mat = block_diag(*[context_mat_1 for _ in range(n_domains)])
+
+    item_mat.setflags(write=False)
+    context_mat.setflags(write=False)
+    return item_mat, context_mat
+
+
+def make_input_mats(ctx_per_domain=4, n_domains=4, **_extra):
+    """
+    The item and context matrices of make_io_mats, which don't depend on the attributes or the RNG.
+    They are only made once for each size and shared, so they are read-only.
+    """
+    return _make_input_mats(ctx_per_domain, n_domains)
+
+
+def make_attr_mat(domain_attrs, domain_inds):
+    """The attribute matrix of make_io_mats, from the output of make_domain_attrs"""
+    return block_diag(*[block_diag(*domain_attrs[k]) for k in domain_inds])
+
+
+def make_io_mats(ctx_per_domain=4, attrs_per_context=50, attrs_set_per_item=25,
+                 n_domains=4, cluster_info='4-2-2', last_domain_cluster_info=None,
+                 repeat_attrs_over_domains=False, vectorized=False, generator=None, **_extra):
+    """
+    Make the actual item, context, and attribute matrices, across a given number of domains.
+    If one_equidistant is true, replaces the last domain's attrs with equidistant attr vectors.
+    Cluster_info and last_domain_cluster_info should be valid inputs to normalize_cluster_info.
+    By default (when None), last_domain_clusters is the same as clusters.
+    repeat_attrs_over_domains - if True, don't regenerate attrs for each domain, just repeat them.
+    vectorized - if True, make the attributes with make_attr_vecs_batch (faster, but the attributes
+    for a given seed are different).
+    generator - torch.Generator to draw from instead of the global torch RNG.
+    The item and context matrices are shared (see make_input_mats), so they are read-only.
+    """
+    item_mat, context_mat = make_input_mats(ctx_per_domain, n_domains)
+    domain_attrs, domain_inds = make_domain_attrs(ctx_per_domain, attrs_per_context, attrs_set_per_item,
+                                                  n_domains, cluster_info, last_domain_cluster_info,
+                                                  repeat_attrs_over_domains, vectorized, generator)
+    attr_mat = make_attr_mat(domain_attrs, domain_inds)
 
     return item_mat, context_mat, attr_mat
 
 
+class DatasetIndex:
+    """
+    Maps between the rows of a dataset (as from make_io_mats) and the item, context and domain of each,
+    using the fact that row r is item i in context c of domain d, where r = (d * ctx_per_domain + c) * 8 + i.
+    Items and contexts are numbered across all domains, as in get_items and get_contexts.
+
+    The *_rows methods get the rows of given items, contexts, domains or item/context pairs directly, and the
+    *_split methods also get all the other rows, as (train_rows, test_rows). Rows are returned as sorted long
+    tensors on the CPU, and are computed in time proportional to the number of rows (plus n_inputs for splits).
+    """
+
+    def __init__(self, n_domains, ctx_per_domain):
+        self.n_domains = n_domains
+        self.ctx_per_domain = ctx_per_domain
+        self.n_items = ITEMS_PER_DOMAIN * n_domains
+        self.n_contexts = ctx_per_domain * n_domains
+        self.inputs_per_domain = ITEMS_PER_DOMAIN * ctx_per_domain
+        self.n_inputs = self.n_contexts * ITEMS_PER_DOMAIN
+
+    @staticmethod
+    def _inds(inds):
+        return torch.atleast_1d(torch.as_tensor(inds, dtype=torch.long, device='cpu'))
+
+    @staticmethod
+    def _sorted_rows(rows):
+        """Flatten a matrix with the rows of one item/context/domain in each row, in order"""
+        return rows.flatten() if len(rows) <= 1 else torch.sort(rows.flatten()).values
+
+    def rows(self, targets=None):
+        """All rows if targets is None, else the rows given by targets as either indices or a boolean mask"""
+        if targets is None:
+            return torch.arange(self.n_inputs, device='cpu')
+        targets = torch.as_tensor(targets, device='cpu')
+        if targets.dtype == torch.bool:
+            if len(targets) != self.n_inputs:
+                raise ValueError(f'Mask has length {len(targets)}, expected {self.n_inputs}')
+            return torch.flatten(torch.nonzero(targets))
+        return self._inds(targets)
+
+    def item_inds(self, rows=None):
+        """Index of the item of each row"""
+        rows = self.rows(rows)
+        return rows // self.inputs_per_domain * ITEMS_PER_DOMAIN + rows % ITEMS_PER_DOMAIN
+
+    def context_inds(self, rows=None):
+        """Index of the context of each row"""
+        return self.rows(rows) // ITEMS_PER_DOMAIN
+
+    def domain_inds(self, rows=None):
+        """Index of the domain of each row"""
+        return self.rows(rows) // self.inputs_per_domain
+
+    def combo_rows(self, items, contexts):
+        """Rows of each pair of an item and a context (which must be in the same domain)"""
+        items, contexts = self._inds(items), self._inds(contexts)
+        if torch.any(items // ITEMS_PER_DOMAIN != contexts // self.ctx_per_domain):
+            raise ValueError('Each item must be paired with a context in the same domain')
+        return torch.sort(contexts * ITEMS_PER_DOMAIN + items % ITEMS_PER_DOMAIN).values
+
+    def item_rows(self, items):
+        """Rows of the given items (in all contexts of their domains)"""
+        items = self._inds(items)
+        first_rows = items // ITEMS_PER_DOMAIN * self.inputs_per_domain + items % ITEMS_PER_DOMAIN
+        ctx_offsets = torch.arange(self.ctx_per_domain, device='cpu') * ITEMS_PER_DOMAIN
+        return self._sorted_rows(first_rows[:, np.newaxis] + ctx_offsets)
+
+    def context_rows(self, contexts):
+        """Rows of the given contexts (with all items of their domains)"""
+        contexts = self._inds(contexts)
+        return self._sorted_rows(contexts[:, np.newaxis] * ITEMS_PER_DOMAIN +
+                                 torch.arange(ITEMS_PER_DOMAIN, device='cpu'))
+
+    def domain_rows(self, domains):
+        """Rows of the given domains"""
+        domains = self._inds(domains)
+        return self._sorted_rows(domains[:, np.newaxis] * self.inputs_per_domain +
+                                 torch.arange(self.inputs_per_domain, device='cpu'))
+
+    def mask_rows(self, mask):
+        """
+        Rows selected by a boolean mask, either over rows (of length n_inputs) or over
+        item/context pairs (n_items x n_contexts, True only for pairs in the same domain)
+        """
+        mask = torch.as_tensor(mask, device='cpu')
+        if mask.ndim == 1:
+            return self.rows(mask.to(torch.bool))
+        if mask.shape != (self.n_items, self.n_contexts):
+            raise ValueError(f'Mask has shape {tuple(mask.shape)}, expected {(self.n_items, self.n_contexts)}')
+        items, contexts = torch.nonzero(mask, as_tuple=True)
+        return self.combo_rows(items, contexts)
+
+    def complement(self, *index_sets, n=None):
+        """Indices in range(n) (default: all rows) that are not in any of index_sets"""
+        b_included = torch.ones(self.n_inputs if n is None else n, dtype=torch.bool, device='cpu')
+        for inds in index_sets:
+            b_included[self._inds(inds)] = False
+        return torch.flatten(torch.nonzero(b_included))
+
+    def _split(self, test_rows):
+        return self.complement(test_rows), test_rows
+
+    def item_split(self, items):
+        return self._split(self.item_rows(items))
+
+    def context_split(self, contexts):
+        return self._split(self.context_rows(contexts))
+
+    def domain_split(self, domains):
+        return self._split(self.domain_rows(domains))
+
+    def combo_split(self, items, contexts):
+        return self._split(self.combo_rows(items, contexts))
+
+    def mask_split(self, mask):
+        return self._split(self.mask_rows(mask))
+
+
+class BlockAttrs:
+    """
+    The attribute matrix of a dataset (as from make_io_mats), stored as just its nonzero blocks.
+    Row r of the full matrix is item i in context c of domain d, where r = (d * ctx_per_domain + c) * 8 + i,
+    and its attributes are the attrs_per_context columns starting at (d * ctx_per_domain + c) * attrs_per_context.
+    Domains that use the same attributes (repeat_attrs_over_domains) share one block.
+    
+    Rows of the full matrix can be gathered (gather) or the whole matrix made (dense) when needed.
+    """
+
+    def __init__(self, domain_attrs, domain_inds, dtype=None, device=None):
+        """domain_attrs and domain_inds are as returned by make_domain_attrs"""
+        # distinct domains x contexts x items x attrs
+        self.blocks = torch.tensor(np.stack([np.stack(attrs) for attrs in domain_attrs]),
+                                   dtype=dtype, device=device)
+        self.domain_inds = torch.tensor(domain_inds, dtype=torch.long, device=device)
+
+        self.n_domains = len(domain_inds)
+        self.ctx_per_domain, _, self.attrs_per_context = self.blocks.shape[1:]
+        self.n_rows = self.n_domains * self.ctx_per_domain * ITEMS_PER_DOMAIN
+        self.n_attributes = self.n_domains * self.ctx_per_domain * self.attrs_per_context
+        self.shape = (self.n_rows, self.n_attributes)
+
+    def __len__(self):
+        return self.n_rows
+
+    def _row_inds(self, rows):
+        """All rows if rows is None, else rows as a long tensor"""
+        if rows is None:
+            return torch.arange(self.n_rows, device=self.blocks.device)
+        return torch.as_tensor(rows, dtype=torch.long, device=self.blocks.device)
+
+    def item_inds(self, rows=None):
+        """Index of the item of each row (i.e. the column of its 1 in the item matrix)"""
+        rows = self._row_inds(rows)
+        domain = rows // (self.ctx_per_domain * ITEMS_PER_DOMAIN)
+        return domain * ITEMS_PER_DOMAIN + rows % ITEMS_PER_DOMAIN
+
+    def context_inds(self, rows=None):
+        """Index of the context of each row (i.e. the column of its 1 in the context matrix)"""
+        return self._row_inds(rows) // ITEMS_PER_DOMAIN
+
+    def gather_blocks(self, rows=None):
+        """
+        Get the nonzero part of each row: returns the attrs_per_context attributes of each row's
+        context and the column where they start in the full matrix.
+        """
+        contexts = self.context_inds(rows)
+        domain, context = contexts // self.ctx_per_domain, contexts % self.ctx_per_domain
+        item = self._row_inds(rows) % ITEMS_PER_DOMAIN
+        return self.blocks[self.domain_inds[domain], context, item], contexts * self.attrs_per_context
+
+    def gather(self, rows=None):
+        """Rows of the full attribute matrix"""
+        block_vals, col_starts = self.gather_blocks(rows)
+        cols = col_starts[:, np.newaxis] + torch.arange(self.attrs_per_context, device=self.blocks.device)
+        full = torch.zeros((len(block_vals), self.n_attributes), dtype=self.blocks.dtype, device=self.blocks.device)
+        return full.scatter_(1, cols, block_vals)
+
+    def dense(self):
+        """The full attribute matrix"""
+        return self.gather()
+
+
+def make_block_attrs(ctx_per_domain=4, attrs_per_context=50, attrs_set_per_item=25,
+                     n_domains=4, cluster_info='4-2-2', last_domain_cluster_info=None,
+                     repeat_attrs_over_domains=False, vectorized=False, generator=None, dtype=None, device=None,
+                     **_extra):
+    """
+    Same as the attribute matrix from make_io_mats (for the same RNG state),
+    but as a BlockAttrs object that doesn't store all the zeros.
+    """
+    domain_attrs, domain_inds = make_domain_attrs(ctx_per_domain, attrs_per_context, attrs_set_per_item,
+                                                  n_domains, cluster_info, last_domain_cluster_info,
+                                                  repeat_attrs_over_domains, vectorized, generator)
+    return BlockAttrs(domain_attrs, domain_inds, dtype=dtype, device=device)
+
+
 def get_io_corr_matrix(item_mat, attr_mat, n_domains):
     """
     Computes the input-output correlation matrix for each domain (defined in Saxe paper)
@@ -519,6 +1147,7 @@ def get_item_svd_loadings(item_mat, attr_mat, n_domains):
 def plot_item_attributes(ctx_per_domain=4, attrs_per_context=50,
                          attrs_set_per_item=25, cluster_info='4-2-2'):
     """Item and context inputs and attribute outputs for each input combination (regardless of domain)"""
+    import matplotlib.pyplot as plt
 
     item_mat, context_mat, attr_mat = make_io_mats(ctx_per_domain, attrs_per_context, attrs_set_per_item,
                                                    n_domains=1, cluster_info=cluster_info)
@@ -552,13 +1181,16 @@ def get_item_attribute_rdm(ctx_per_domain=4, attrs_per_context=50, attrs_set_per
     """Make RDM of similarities between the items' attributes, collapsed across contexts"""
 
     attrs = make_attr_vecs(ctx_per_domain, attrs_per_context, attrs_set_per_item, cluster_info)
-    mean_dist = np.mean(np.stack([distance.pdist(a) for a in attrs]), axis=0)
-    return distance.squareform(mean_dist)
+    # for 0/1 vectors, the euclidean distance is the square root of the Hamming distance
+    return np.mean(np.sqrt(hamming_dists(pack_attrs(np.stack(attrs)))), axis=0)
 
 
 def plot_item_attribute_dendrogram(ctx_per_domain=4, attrs_per_context=50, attrs_set_per_item=25,
                                    cluster_info='4-2-2', method='single', **_extra):
     """Dendrogram of similarities between the items' attributes, collapsed across contexts"""
+    import matplotlib.pyplot as plt
+    from scipy.cluster import hierarchy
+    from scipy.spatial import distance
 
     dist_mat = get_item_attribute_rdm(ctx_per_domain, attrs_per_context,
                                       attrs_set_per_item, cluster_info)
@@ -577,8 +1209,12 @@ def plot_item_attribute_dendrogram(ctx_per_domain=4, attrs_per_context=50, attrs
     return fig, ax
 
 
-def init_torch(device=None, torchfp=None, use_cuda_if_possible=True):
-    """Establish floating-point type and device to use with PyTorch"""
+def init_torch(device=None, torchfp=None, use_cuda_if_possible=True, set_default=True):
+    """
+    Establish floating-point type and device to use with PyTorch.
+    If set_default is True, they also become the process-wide default tensor type; DisjointDomainNet
+    doesn't need that, since it gives every tensor it makes its dtype and device explicitly.
+    """
 
     if device is None:
         if use_cuda_if_possible and torch.cuda.is_available():
@@ -597,12 +1233,15 @@ def init_torch(device=None, torchfp=None, use_cuda_if_possible=True):
         torchfp = torch.float
 
     if torchfp == torch.float:
-        torch.set_default_tensor_type(ttype_ns.FloatTensor)
+        ttype = ttype_ns.FloatTensor
     elif torchfp == torch.double:
-        torch.set_default_tensor_type(ttype_ns.DoubleTensor)
+        ttype = ttype_ns.DoubleTensor
     else:
         raise NotImplementedError(f'No tensor type known for dtype {torchfp}')
 
+    if set_default:
+        torch.set_default_tensor_type(ttype)
+
     return device, torchfp
 
 
@@ -642,28 +1281,34 @@ def get_domain_colors():
     ]
 
 
-def get_items(n_domains=4, cluster_info='4-2-2', last_domain_cluster_info=None, **_extra):
+@lru_cache(maxsize=None)
+def _get_item_names(n_domains, clusters, last_clusters):
+    all_clusters = [clusters] * (n_domains - 1) + [last_clusters]
+    return tuple(domain_name(d) + str(n + 1) + item_group_symbol(n, clst)
+                 for d, clst in enumerate(all_clusters)
+                 for n in range(ITEMS_PER_DOMAIN))
+
+
+@lru_cache(maxsize=None)
+def _get_context_names(n_domains, ctx_per_domain):
+    return tuple(domain_name(d) + str(n+1) for d in range(n_domains) for n in range(ctx_per_domain))
+
+
+def get_items(n_domains=4, cluster_info='4-2-2', last_domain_cluster_info=None, dtype=None, device=None, **_extra):
     """Get item tensors (without repetitions) and their corresponding names"""
     cluster_info = normalize_cluster_info(cluster_info)
     last_domain_cluster_info = (cluster_info if last_domain_cluster_info is None
                                 else normalize_cluster_info(last_domain_cluster_info))
 
-    items = torch.eye(ITEMS_PER_DOMAIN * n_domains)
-    all_clusters = [cluster_info['clusters']] * n_domains
-    if last_domain_cluster_info is not None:
-        last_domain_cluster_info = normalize_cluster_info(last_domain_cluster_info)
-        all_clusters[-1] = last_domain_cluster_info['clusters']
-
-    item_names = [domain_name(d) + str(n + 1) + item_group_symbol(n, clst)
-                  for d, clst in enumerate(all_clusters)
-                  for n in range(ITEMS_PER_DOMAIN)]
+    items = torch.eye(ITEMS_PER_DOMAIN * n_domains, dtype=dtype, device=device)
+    item_names = list(_get_item_names(n_domains, cluster_info['clusters'], last_domain_cluster_info['clusters']))
     return items, item_names
 
 
-def get_contexts(n_domains=4, ctx_per_domain=4, **_extra):
+def get_contexts(n_domains=4, ctx_per_domain=4, dtype=None, device=None, **_extra):
     """Get context tensors (without repetitions) and their corresponding names"""
-    contexts = torch.eye(ctx_per_domain * n_domains)
-    context_names = [domain_name(d) + str(n+1) for d in range(n_domains) for n in range(ctx_per_domain)]
+    contexts = torch.eye(ctx_per_domain * n_domains, dtype=dtype, device=device)
+    context_names = list(_get_context_names(n_domains, ctx_per_domain))
     return contexts, context_names
 
 